@@ -1,11 +1,19 @@
 import requests
 import time
 import os
-from typing import Generator, List
-
-import jwt
+import threading
+from typing import Generator, List, Optional, Dict, Tuple, TYPE_CHECKING
 
+from auth import generate_token, token_cache
 from data_types import TextMsg, ImageMsg, TextMsgList, MsgList, CharacterMeta
+from instrumentation import InstrumentedHTTPAdapter, metrics
+from response_cache import make_key, response_cache
+from retry import default_policy
+from scheduler import Priority, scheduler
+from sse import iter_sse_events
+
+if TYPE_CHECKING:
+    from zhipuai import ZhipuAI
 
 # 智谱开放平台API key，参考 https://open.bigmodel.cn/usercenter/apikeys
 API_KEY: str = os.getenv("API_KEY", "")
@@ -20,64 +28,175 @@ def verify_api_key_not_empty():
         raise ApiKeyNotSet
 
 
-def generate_token(apikey: str, exp_seconds: int) -> str:
+def set_api_key(key: str):
     """
-    生成智谱开放平台API的token
-    # reference: https://open.bigmodel.cn/dev/api#nosdk
-    :param apikey:
-    :param exp_seconds:
+    更新API_KEY
+    key发生变化时，将旧key对应的sdk client和token移出缓存
+    :param key:
     :return:
     """
+    global API_KEY
+    if key == API_KEY:
+        return
+    old_key, API_KEY = API_KEY, key
+    if old_key:
+        invalidate_zhipuai_client(old_key)
+        token_cache.invalidate(old_key)
+
+
+# http连接池配置，可通过环境变量调整
+# HTTP_POOL_CONNECTIONS: 缓存的host连接池个数
+# HTTP_POOL_MAXSIZE: 每个host最多保持的keep-alive连接数
+# HTTP_POOL_BLOCK: 连接数达到上限时是否阻塞等待（而不是新建一个用完即弃的连接）
+HTTP_POOL_CONNECTIONS: int = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))
+HTTP_POOL_MAXSIZE: int = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+HTTP_POOL_BLOCK: bool = os.getenv("HTTP_POOL_BLOCK", "no").lower() in ("1", "yes", "y", "true", "t", "on")
+# (连接超时, 读超时)，单位秒
+HTTP_TIMEOUT = (float(os.getenv("HTTP_CONNECT_TIMEOUT", "10")), float(os.getenv("HTTP_READ_TIMEOUT", "300")))
+
+# 智谱开放平台的接口地址，可通过环境变量ZHIPUAI_API_BASE指向本地的mock服务（见benchmarks/mock_server.py）
+ZHIPUAI_API_BASE: str = os.getenv("ZHIPUAI_API_BASE", "https://open.bigmodel.cn/api/paas").rstrip("/")
+CHARACTERGLM_URL = f"{ZHIPUAI_API_BASE}/v3/model-api/charglm-3/sse-invoke"
+CHATGLM_URL = f"{ZHIPUAI_API_BASE}/v4/chat/completions"
+COGVIEW_URL = f"{ZHIPUAI_API_BASE}/v4/images/generations"
+
+
+def set_api_base(base: str):
+    """
+    更新接口地址，已创建的sdk client全部移出缓存
+    :param base: 如 https://open.bigmodel.cn/api/paas
+    :return:
+    """
+    global ZHIPUAI_API_BASE, CHARACTERGLM_URL, CHATGLM_URL, COGVIEW_URL
+    ZHIPUAI_API_BASE = base.rstrip("/")
+    CHARACTERGLM_URL = f"{ZHIPUAI_API_BASE}/v3/model-api/charglm-3/sse-invoke"
+    CHATGLM_URL = f"{ZHIPUAI_API_BASE}/v4/chat/completions"
+    COGVIEW_URL = f"{ZHIPUAI_API_BASE}/v4/images/generations"
+    with _zhipuai_clients_lock:
+        _zhipuai_clients.clear()
 
-    try:
-        id, secret = apikey.split(".")
-    except Exception as e:
-        raise Exception("invalid apikey", e)
-
-    payload = {
-        "api_key": id,
-        "exp": int(round(time.time() * 1000)) + exp_seconds * 1000,
-        "timestamp": int(round(time.time() * 1000)),
-    }
-
-    return jwt.encode(
-        payload,
-        secret,
-        algorithm="HS256",
-        headers={"alg": "HS256", "sign_type": "SIGN"},
-    )
+
+_http_session: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """
+    获取进程内共享的http session
+    session自带连接池并保持keep-alive，多个streamlit会话共用同一组连接，避免每轮对话都重新做TCP+TLS握手。
+    线程安全：首次调用时加锁创建，之后直接返回。
+    :return:
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                # 新建连接时记录DNS/TCP/TLS耗时，见instrumentation.py
+                adapter = InstrumentedHTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                                  pool_maxsize=HTTP_POOL_MAXSIZE,
+                                                  pool_block=HTTP_POOL_BLOCK)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _http_session = session
+    return _http_session
+
+
+def close_http_session():
+    """ 关闭共享的http session，释放连接池中的所有连接 """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is not None:
+            _http_session.close()
+            _http_session = None
+
+
+# 按api key缓存的新版sdk client，每个client内部有自己的httpx连接池
+_zhipuai_clients: Dict[str, "ZhipuAI"] = {}
+_zhipuai_clients_lock = threading.Lock()
+
+
+def get_zhipuai_client(api_key: Optional[str] = None) -> "ZhipuAI":
+    """
+    获取api key对应的新版sdk client，不存在时创建，之后一直复用
+    :param api_key: 默认使用当前的API_KEY
+    :return:
+    """
+    # 需要安装新版zhipuai
+    from zhipuai import ZhipuAI
+    api_key = api_key or API_KEY
+    client = _zhipuai_clients.get(api_key)
+    if client is None:
+        with _zhipuai_clients_lock:
+            client = _zhipuai_clients.get(api_key)
+            if client is None:
+                client = ZhipuAI(api_key=api_key, base_url=f"{ZHIPUAI_API_BASE}/v4")
+                _zhipuai_clients[api_key] = client
+    return client
+
+
+def invalidate_zhipuai_client(api_key: str):
+    """
+    将api key对应的sdk client移出缓存，后续调用会创建新的client
+    不主动close：其他线程可能还在用它读流式响应，最后一个引用释放时client会自行关闭连接
+    :param api_key:
+    :return:
+    """
+    with _zhipuai_clients_lock:
+        _zhipuai_clients.pop(api_key, None)
 
 
-def get_characterglm_response(messages: TextMsgList, meta: CharacterMeta) -> Generator[str, None, None]:
-    """ 通过http调用characterglm """
+def close_zhipuai_client(api_key: Optional[str] = None):
+    """
+    关闭并移除sdk client
+    :param api_key: 为None时关闭所有client
+    :return:
+    """
+    with _zhipuai_clients_lock:
+        if api_key is None:
+            clients = list(_zhipuai_clients.values())
+            _zhipuai_clients.clear()
+        else:
+            client = _zhipuai_clients.pop(api_key, None)
+            clients = [client] if client is not None else []
+    for client in clients:
+        client.close()
+
+
+def get_characterglm_response(messages: TextMsgList, meta: CharacterMeta,
+                              priority: Priority = Priority.INTERACTIVE) -> Generator[str, None, None]:
+    """ 通过http调用characterglm，收到第一个token之前失败时按retry.default_policy重试 """
     # Reference: https://open.bigmodel.cn/dev/api#characterglm
     verify_api_key_not_empty()
-    url = "https://open.bigmodel.cn/api/paas/v3/model-api/charglm-3/sse-invoke"
-    resp = requests.post(
-        url,
-        headers={"Authorization": generate_token(API_KEY, 1800)},
-        json=dict(
-            model="charglm-3",
-            meta=meta,
-            prompt=messages,
-            incremental=True)
-    )
-    resp.raise_for_status()
-    
-    # 解析响应（非官方实现）
-    sep = b':'
-    last_event = None
-    for line in resp.iter_lines():
-        if not line or line.startswith(sep):
-            continue
-        field, value = line.split(sep, maxsplit=1)
-        if field == b'event':
-            last_event = value
-        elif field == b'data' and last_event == b'add':
-            yield value.decode()
-
-
-def get_characterglm_response_via_sdk(messages: TextMsgList, meta: CharacterMeta) -> Generator[str, None, None]:
+    url = CHARACTERGLM_URL
+
+    def stream():
+        # 流式响应读完之前一直占用调度器的并发名额
+        # stream=True: 边收边解析，不等整个响应下载完；with保证连接用完后归还连接池
+        with scheduler.slot("charglm-3", priority), get_http_session().post(
+            url,
+            headers={"Authorization": generate_token(API_KEY, 1800)},
+            json=dict(
+                model="charglm-3",
+                meta=meta,
+                prompt=messages,
+                incremental=True),
+            stream=True,
+            timeout=HTTP_TIMEOUT,
+        ) as resp:
+            resp.raise_for_status()
+
+            # chunk_size=None: 收到多少字节就交给解析器多少
+            for event in iter_sse_events(resp.iter_content(chunk_size=None)):
+                if event.event == 'add':
+                    yield event.data
+
+    call = metrics.start_call("charglm-3", "get_characterglm_response")
+    yield from call.stream(default_policy.stream(stream, on_retry=call.retry))
+
+
+def get_characterglm_response_via_sdk(messages: TextMsgList, meta: CharacterMeta,
+                                      priority: Priority = Priority.INTERACTIVE) -> Generator[str, None, None]:
     """ 通过旧版sdk调用characterglm """
     # 与get_characterglm_response等价
     # Reference: https://open.bigmodel.cn/dev/api#characterglm
@@ -85,45 +204,61 @@ def get_characterglm_response_via_sdk(messages: TextMsgList, meta: CharacterMeta
     import zhipuai
     verify_api_key_not_empty()
     zhipuai.api_key = API_KEY
-    response = zhipuai.model_api.sse_invoke(
-        model="charglm-3",
-        meta=meta,
-        prompt=messages,
-        incremental=True
-    )
-    for event in response.events():
-        if event.event == 'add':
-            yield event.data
 
+    def stream():
+        with scheduler.slot("charglm-3", priority):
+            response = zhipuai.model_api.sse_invoke(
+                model="charglm-3",
+                meta=meta,
+                prompt=messages,
+                incremental=True
+            )
+            for event in response.events():
+                if event.event == 'add':
+                    yield event.data
 
-def get_chatglm_response_via_sdk(messages: TextMsgList) -> Generator[str, None, None]:
+    call = metrics.start_call("charglm-3", "get_characterglm_response_via_sdk")
+    yield from call.stream(default_policy.stream(stream, on_retry=call.retry))
+
+
+def get_chatglm_response_via_sdk(messages: TextMsgList,
+                                 priority: Priority = Priority.BACKGROUND) -> Generator[str, None, None]:
     """ 通过sdk调用chatglm """
     # reference: https://open.bigmodel.cn/dev/api#glm-3-turbo  `GLM-3-Turbo`相关内容
-    # 需要安装新版zhipuai
-    from zhipuai import ZhipuAI
     verify_api_key_not_empty()
-    client = ZhipuAI(api_key=API_KEY)  # 请填写您自己的APIKey
-    response = client.chat.completions.create(
-        model="glm-3-turbo",  # 填写需要调用的模型名称
-        messages=messages,
-        stream=True,
-    )
-    for chunk in response:
-        yield chunk.choices[0].delta.content
+    client = get_zhipuai_client()
 
+    def stream():
+        with scheduler.slot("glm-3-turbo", priority):
+            response = client.chat.completions.create(
+                model="glm-3-turbo",  # 填写需要调用的模型名称
+                messages=messages,
+                stream=True,
+            )
+            for chunk in response:
+                yield chunk.choices[0].delta.content
 
-def get_chatglm_response_content_sdk(messages: TextMsgList, stream=False) -> Generator[str, None, None]:
+    call = metrics.start_call("glm-3-turbo", "get_chatglm_response_via_sdk")
+    yield from call.stream(default_policy.stream(stream, on_retry=call.retry))
+
+
+def get_chatglm_response_content_sdk(messages: TextMsgList, stream=False,
+                                     priority: Priority = Priority.BACKGROUND) -> Generator[str, None, None]:
     """ 通过sdk调用chatglm """
     # reference: https://open.bigmodel.cn/dev/api#glm-3-turbo  `GLM-3-Turbo`相关内容
-    # 需要安装新版zhipuai
-    from zhipuai import ZhipuAI
     verify_api_key_not_empty()
-    client = ZhipuAI(api_key=API_KEY)  # 请填写您自己的APIKey
-    response = client.chat.completions.create(
-        model="glm-3-turbo",  # 填写需要调用的模型名称
-        messages=messages,
-        stream=stream,
-    )
+    client = get_zhipuai_client()
+
+    def request():
+        with scheduler.slot("glm-3-turbo", priority):
+            return client.chat.completions.create(
+                model="glm-3-turbo",  # 填写需要调用的模型名称
+                messages=messages,
+                stream=stream,
+            )
+
+    call = metrics.start_call("glm-3-turbo", "get_chatglm_response_content_sdk")
+    response = call.run(lambda: default_policy.call(request, on_retry=call.retry))
     print(response)
     return response.choices[0].message.content
 
@@ -135,12 +270,8 @@ def deal_with_json_response(response: str) -> str:
     return "".join(resp_list[1:-1])
 
 
-def generate_role_info(role_desc: str) -> str:
-    """ 
-    用chatglm根据描述生成角色的人设信息
-    :param role_desc: 角色的描述文本
-    :return: 生成的人设信息.json字符串.包含name和info字段
-    """
+def build_role_info_messages(role_desc: str) -> TextMsgList:
+    """ 生成人设信息的prompt """
 
     instruction = f"""
     从下列<<描述文本>>中，抽取人物的人设信息。若文本中不包含人设信息，请推测人物的姓名, 性别、年龄、身高、体重、职业、性格等，并生成一段人设信息。要求：
@@ -155,20 +286,32 @@ def generate_role_info(role_desc: str) -> str:
     name: 人物姓名
     info: 人物所有人设信息
     """
-    response = get_chatglm_response_content_sdk(
-        messages=[
-            {
-                "role": "user",
-                "content": instruction.strip()
-            }
-        ],
-        stream=False
+    return [
+        {
+            "role": "user",
+            "content": instruction.strip()
+        }
+    ]
+
+
+def generate_role_info(role_desc: str, priority: Priority = Priority.BACKGROUND) -> str:
+    """ 
+    用chatglm根据描述生成角色的人设信息
+    :param role_desc: 角色的描述文本
+    :param priority: 调度优先级
+    :return: 生成的人设信息.json字符串.包含name和info字段
+    """
+    messages = build_role_info_messages(role_desc)
+    # 相同的描述直接复用上一次的结果
+    response = response_cache.cached_call(
+        make_key("glm-3-turbo", messages),
+        lambda: get_chatglm_response_content_sdk(messages=messages, stream=False, priority=priority)
     )
     return deal_with_json_response("".join(response))
 
 
-def generate_role_appearance(role_profile: str) -> Generator[str, None, None]:
-    """ 用chatglm生成角色的外貌描写 """
+def build_role_appearance_messages(role_profile: str) -> TextMsgList:
+    """ 生成外貌描写的prompt """
 
     instruction = f"""
 请从下列文本中，抽取人物的外貌描写。若文本中不包含外貌描写，请你推测人物的性别、年龄，并生成一段外貌描写。要求：
@@ -180,18 +323,31 @@ def generate_role_appearance(role_profile: str) -> Generator[str, None, None]:
 文本：
 {role_profile}
 """
-    return get_chatglm_response_via_sdk(
-        messages=[
-            {
-                "role": "user",
-                "content": instruction.strip()
-            }
-        ]
+    return [
+        {
+            "role": "user",
+            "content": instruction.strip()
+        }
+    ]
+
+
+def generate_role_appearance(role_profile: str,
+                             priority: Priority = Priority.BACKGROUND) -> Generator[str, None, None]:
+    """ 用chatglm生成角色的外貌描写，相同的人设命中缓存时一次性返回 """
+    messages = build_role_appearance_messages(role_profile)
+    return response_cache.cached_stream(
+        make_key("glm-3-turbo", messages),
+        lambda: get_chatglm_response_via_sdk(messages=messages, priority=priority)
     )
 
 
-def generate_chat_scene_prompt(messages: TextMsgList, meta: CharacterMeta) -> Generator[str, None, None]:
-    """ 调用chatglm生成cogview的prompt，描写对话场景 """
+def build_chat_scene_messages(messages: TextMsgList, meta: CharacterMeta, summary: str = "") -> TextMsgList:
+    """
+    生成对话场景描写的prompt
+    :param messages: 最近的对话
+    :param meta: 角色人设
+    :param summary: messages之前的情节概要，为空时不加入
+    """
     instruction = f"""
 阅读下面的角色人设与对话，生成一段文字描写场景。
 
@@ -206,6 +362,12 @@ def generate_chat_scene_prompt(messages: TextMsgList, meta: CharacterMeta) -> Ge
 {meta["user_info"]}
 """.rstrip()
 
+    if summary:
+        instruction += f"""
+
+之前的情节概要：
+{summary}"""
+
     if messages:
         instruction += "\n\n对话：" + '\n'.join(
             (meta['bot_name'] if msg['role'] == "assistant" else meta['user_name']) + '：' + msg['content'].strip() for
@@ -221,26 +383,81 @@ def generate_chat_scene_prompt(messages: TextMsgList, meta: CharacterMeta) -> Ge
 """.rstrip()
     # print(instruction)
 
-    return get_chatglm_response_via_sdk(
-        messages=[
-            {
-                "role": "user",
-                "content": instruction.strip()
-            }
-        ]
+    return [
+        {
+            "role": "user",
+            "content": instruction.strip()
+        }
+    ]
+
+
+def generate_chat_scene_prompt(messages: TextMsgList, meta: CharacterMeta, summary: str = "",
+                               priority: Priority = Priority.BACKGROUND) -> Generator[str, None, None]:
+    """ 调用chatglm生成cogview的prompt，描写对话场景，相同的人设、概要与对话命中缓存时一次性返回 """
+    prompt = build_chat_scene_messages(messages, meta, summary)
+    return response_cache.cached_stream(
+        make_key("glm-3-turbo", prompt),
+        lambda: get_chatglm_response_via_sdk(messages=prompt, priority=priority)
     )
 
 
-def generate_cogview_image(prompt: str) -> str:
+def build_summary_messages(messages: TextMsgList, names: Tuple[str, str], previous_summary: str = "") -> TextMsgList:
+    """
+    生成对话概要的prompt
+    :param messages: 需要概括的一段对话
+    :param names: (assistant的名字, user的名字)
+    :param previous_summary: 这段对话之前的概要，新的概要需要把它也包含进去
+    """
+    instruction = "阅读下面的对话，用第三人称概括其中发生的事情、人物的关系和状态变化。"
+    if previous_summary:
+        instruction += f"""
+
+之前的情节概要：
+{previous_summary}"""
+
+    instruction += "\n\n对话：" + '\n'.join(
+        (names[0] if msg['role'] == "assistant" else names[1]) + '：' + msg['content'].strip() for msg in messages)
+
+    instruction += """
+
+要求如下：
+1. 只生成概要，不要生成任何多余的内容
+2. 包含之前的情节概要中仍然重要的内容
+3. 不要超过200字
+"""
+    return [
+        {
+            "role": "user",
+            "content": instruction.strip()
+        }
+    ]
+
+
+def generate_summary(messages: TextMsgList, names: Tuple[str, str], previous_summary: str = "",
+                     priority: Priority = Priority.BACKGROUND) -> str:
+    """ 调用chatglm概括一段对话，用于压缩过长的对话历史 """
+    return get_chatglm_response_content_sdk(
+        messages=build_summary_messages(messages, names, previous_summary),
+        stream=False,
+        priority=priority
+    ).strip()
+
+
+def generate_cogview_image(prompt: str, priority: Priority = Priority.BACKGROUND) -> str:
     """ 调用cogview生成图片，返回url """
     # reference: https://open.bigmodel.cn/dev/api#cogview
-    from zhipuai import ZhipuAI
-    client = ZhipuAI(api_key=API_KEY)  # 请填写您自己的APIKey
+    verify_api_key_not_empty()
+    client = get_zhipuai_client()
 
-    response = client.images.generations(
-        model="cogview-3",  # 填写需要调用的模型名称
-        prompt=prompt
-    )
+    def request():
+        with scheduler.slot("cogview-3", priority):
+            return client.images.generations(
+                model="cogview-3",  # 填写需要调用的模型名称
+                prompt=prompt
+            )
+
+    call = metrics.start_call("cogview-3", "generate_cogview_image")
+    response = call.run(lambda: default_policy.call(request, on_retry=call.retry))
     return response.data[0].url
 
 
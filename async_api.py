@@ -0,0 +1,208 @@
+"""
+异步版本的api，基于aiohttp，由homework/sync_api.py整理而来
+
+与api.py一一对应，API_KEY沿用api.API_KEY。
+同一个事件循环内的所有请求共用一个长连接session，连接数由connector限制，
+适合在一个事件循环里驱动成百上千个并发对话。
+
+用法：
+```python
+import asyncio
+import async_api
+
+async def main():
+    try:
+        async for chunk in async_api.get_characterglm_response(messages, meta):
+            print(chunk)
+    finally:
+        await async_api.close_session()
+
+asyncio.run(main())
+```
+"""
+import asyncio
+import json
+import os
+import weakref
+from typing import AsyncGenerator
+
+import aiohttp
+
+import api
+from api import verify_api_key_not_empty, deal_with_json_response, build_role_info_messages, \
+    build_role_appearance_messages, build_chat_scene_messages
+from auth import generate_token
+from data_types import TextMsgList, CharacterMeta
+from instrumentation import aiohttp_trace_config, metrics
+from retry import default_policy
+from scheduler import Priority, scheduler
+from sse import aiter_sse_events
+
+# 接口地址沿用api.CHARACTERGLM_URL等，每次请求时读取，api.set_api_base之后立即生效
+
+# aiohttp连接池配置，可通过环境变量调整
+# AIOHTTP_LIMIT: 同时打开的连接总数上限
+# AIOHTTP_LIMIT_PER_HOST: 同一host的连接数上限
+AIOHTTP_LIMIT: int = int(os.getenv("AIOHTTP_LIMIT", "100"))
+AIOHTTP_LIMIT_PER_HOST: int = int(os.getenv("AIOHTTP_LIMIT_PER_HOST", "100"))
+AIOHTTP_KEEPALIVE_TIMEOUT: float = float(os.getenv("AIOHTTP_KEEPALIVE_TIMEOUT", "60"))
+
+# session绑定在创建它的事件循环上，每个事件循环各有一个
+_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = \
+    weakref.WeakKeyDictionary()
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """
+    获取当前事件循环共享的session，不存在时创建
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=AIOHTTP_LIMIT,
+                                         limit_per_host=AIOHTTP_LIMIT_PER_HOST,
+                                         keepalive_timeout=AIOHTTP_KEEPALIVE_TIMEOUT)
+        timeout = aiohttp.ClientTimeout(total=None,
+                                        sock_connect=api.HTTP_TIMEOUT[0],
+                                        sock_read=api.HTTP_TIMEOUT[1])
+        # 新建连接时记录DNS/连接耗时，见instrumentation.py
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                        trace_configs=[aiohttp_trace_config()])
+        _sessions[loop] = session
+    return session
+
+
+async def close_session():
+    """ 关闭当前事件循环的session，事件循环结束前调用 """
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+def _auth_headers() -> dict:
+    return {"Authorization": generate_token(api.API_KEY, 1800)}
+
+
+async def get_characterglm_response(messages: TextMsgList, meta: CharacterMeta,
+                                    priority: Priority = Priority.INTERACTIVE) -> AsyncGenerator[str, None]:
+    """ 通过http调用characterglm，收到第一个token之前失败时按retry.default_policy重试 """
+    # Reference: https://open.bigmodel.cn/dev/api#characterglm
+    verify_api_key_not_empty()
+    session = await get_session()
+
+    async def stream():
+        async with scheduler.aslot("charglm-3", priority), session.post(
+            api.CHARACTERGLM_URL,
+            headers=_auth_headers(),
+            json=dict(
+                model="charglm-3",
+                meta=meta,
+                prompt=messages,
+                incremental=True)
+        ) as resp:
+            resp.raise_for_status()
+            async for event in aiter_sse_events(resp.content.iter_any()):
+                if event.event == "add":
+                    yield event.data
+
+    call = metrics.start_call("charglm-3", "async_api.get_characterglm_response")
+    async for chunk in call.astream(default_policy.astream(stream, on_retry=call.retry)):
+        yield chunk
+
+
+async def get_chatglm_response(messages: TextMsgList,
+                               priority: Priority = Priority.BACKGROUND) -> AsyncGenerator[str, None]:
+    """ 通过http调用chatglm，流式返回 """
+    # reference: https://open.bigmodel.cn/dev/api#glm-3-turbo  `GLM-3-Turbo`相关内容
+    verify_api_key_not_empty()
+    session = await get_session()
+
+    async def stream():
+        async with scheduler.aslot("glm-3-turbo", priority), session.post(
+            api.CHATGLM_URL,
+            headers=_auth_headers(),
+            json=dict(
+                model="glm-3-turbo",
+                messages=messages,
+                stream=True)
+        ) as resp:
+            resp.raise_for_status()
+            async for event in aiter_sse_events(resp.content.iter_any()):
+                if event.data == "[DONE]":
+                    break
+                chunk = json.loads(event.data)
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    yield content
+
+    call = metrics.start_call("glm-3-turbo", "async_api.get_chatglm_response")
+    async for content in call.astream(default_policy.astream(stream, on_retry=call.retry)):
+        yield content
+
+
+async def get_chatglm_response_content(messages: TextMsgList, priority: Priority = Priority.BACKGROUND) -> str:
+    """ 通过http调用chatglm，一次性返回完整回复 """
+    verify_api_key_not_empty()
+    session = await get_session()
+
+    async def request():
+        async with scheduler.aslot("glm-3-turbo", priority), session.post(
+            api.CHATGLM_URL,
+            headers=_auth_headers(),
+            json=dict(
+                model="glm-3-turbo",
+                messages=messages,
+                stream=False)
+        ) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    call = metrics.start_call("glm-3-turbo", "async_api.get_chatglm_response_content")
+    response = await call.arun(lambda: default_policy.acall(request, on_retry=call.retry))
+    return response["choices"][0]["message"]["content"]
+
+
+async def generate_role_info(role_desc: str, priority: Priority = Priority.BACKGROUND) -> str:
+    """
+    用chatglm根据描述生成角色的人设信息
+    :param role_desc: 角色的描述文本
+    :param priority: 调度优先级
+    :return: 生成的人设信息.json字符串.包含name和info字段
+    """
+    response = await get_chatglm_response_content(build_role_info_messages(role_desc), priority)
+    return deal_with_json_response(response)
+
+
+def generate_role_appearance(role_profile: str,
+                             priority: Priority = Priority.BACKGROUND) -> AsyncGenerator[str, None]:
+    """ 用chatglm生成角色的外貌描写 """
+    return get_chatglm_response(build_role_appearance_messages(role_profile), priority)
+
+
+def generate_chat_scene_prompt(messages: TextMsgList, meta: CharacterMeta, summary: str = "",
+                               priority: Priority = Priority.BACKGROUND) -> AsyncGenerator[str, None]:
+    """ 调用chatglm生成cogview的prompt，描写对话场景 """
+    return get_chatglm_response(build_chat_scene_messages(messages, meta, summary), priority)
+
+
+async def generate_cogview_image(prompt: str, priority: Priority = Priority.BACKGROUND) -> str:
+    """ 调用cogview生成图片，返回url """
+    # reference: https://open.bigmodel.cn/dev/api#cogview
+    verify_api_key_not_empty()
+    session = await get_session()
+
+    async def request():
+        async with scheduler.aslot("cogview-3", priority), session.post(
+            api.COGVIEW_URL,
+            headers=_auth_headers(),
+            json=dict(
+                model="cogview-3",
+                prompt=prompt)
+        ) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    call = metrics.start_call("cogview-3", "async_api.generate_cogview_image")
+    response = await call.arun(lambda: default_policy.acall(request, on_retry=call.retry))
+    return response["data"][0]["url"]
@@ -0,0 +1,114 @@
+"""
+智谱开放平台API的鉴权token
+api.py与homework/sync_api.py共用这里的token缓存
+"""
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+import jwt
+
+# 距离token过期还剩多少秒时重新生成，可通过环境变量调整
+TOKEN_REFRESH_MARGIN: float = float(os.getenv("TOKEN_REFRESH_MARGIN", "60"))
+
+
+def sign_token(apikey: str, exp_seconds: int) -> Tuple[str, float]:
+    """
+    签发一个新的token
+    # reference: https://open.bigmodel.cn/dev/api#nosdk
+    :param apikey:
+    :param exp_seconds:
+    :return: (token, 过期时间戳，单位秒)
+    """
+
+    try:
+        id, secret = apikey.split(".")
+    except Exception as e:
+        raise Exception("invalid apikey", e)
+
+    now_ms = int(round(time.time() * 1000))
+    payload = {
+        "api_key": id,
+        "exp": now_ms + exp_seconds * 1000,
+        "timestamp": now_ms,
+    }
+
+    token = jwt.encode(
+        payload,
+        secret,
+        algorithm="HS256",
+        headers={"alg": "HS256", "sign_type": "SIGN"},
+    )
+    return token, payload["exp"] / 1000
+
+
+class TokenCache(object):
+    """
+    按(apikey, exp_seconds)缓存token，在过期前refresh_margin秒内才重新签发
+
+    同一个key的刷新由一把锁串行化，并发请求中只有一个会真正签发，其余的直接拿到新token。
+    签发是纯同步计算，不会在协程中途让出事件循环，所以协程之间也不会重复签发。
+    """
+
+    def __init__(self, refresh_margin: float = TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._tokens: Dict[Tuple[str, int], Tuple[str, float]] = {}
+        self._key_locks: Dict[Tuple[str, int], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _margin(self, exp_seconds: int) -> float:
+        # margin不能超过有效期的一半，否则每次都会重新签发
+        return min(self.refresh_margin, exp_seconds / 2)
+
+    def _get_fresh(self, key: Tuple[str, int]):
+        entry = self._tokens.get(key)
+        if entry is not None and time.time() < entry[1] - self._margin(key[1]):
+            return entry[0]
+        return None
+
+    def _key_lock(self, key: Tuple[str, int]) -> threading.Lock:
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def get(self, apikey: str, exp_seconds: int) -> str:
+        key = (apikey, exp_seconds)
+        token = self._get_fresh(key)
+        if token is not None:
+            return token
+
+        with self._key_lock(key):
+            # 等锁期间可能已经被其他线程刷新过
+            token = self._get_fresh(key)
+            if token is not None:
+                return token
+            token, expire_at = sign_token(apikey, exp_seconds)
+            self._tokens[key] = (token, expire_at)
+            return token
+
+    def invalidate(self, apikey: str):
+        """ 丢弃apikey对应的所有token """
+        with self._lock:
+            for key in [k for k in self._tokens if k[0] == apikey]:
+                self._tokens.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+token_cache = TokenCache()
+
+
+def generate_token(apikey: str, exp_seconds: int) -> str:
+    """
+    生成智谱开放平台API的token
+    有效期内直接返回缓存的token
+    :param apikey:
+    :param exp_seconds:
+    :return:
+    """
+    return token_cache.get(apikey, exp_seconds)
@@ -0,0 +1,245 @@
+"""
+角色扮演对话的批量生成引擎（不依赖streamlit）
+
+给定若干(角色A, 角色B, 开场话题)任务，自动交替调用CharacterGLM生成N轮对话，
+多个对话在同一个事件循环里并发进行，并发数可配置。
+生成的对话与characterglm_autochat.py保存的history.json格式相同，
+也可以传入dialogue_store.DialogueWriter，逐条消息追加写入jsonl数据集；
+传入job_store.JobStore时每条消息写入检查点，中断后从检查点继续（见cli.py）。
+
+用法：
+```python
+from autochat_engine import generate_dialogues, save_dialogues
+
+dialogues = generate_dialogues(jobs, rounds=5, concurrency=20)
+save_dialogues(dialogues, "output")
+```
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+from typing import Callable, Dict, List, Optional, TypedDict
+
+import async_api
+from context_window import context_window
+from data_types import TextMsg, MsgList, CharacterMeta, filter_text_msg
+from dialogue_store import DialogueWriter
+from job_store import JobStore
+from message_store import MessageStore
+
+logger = logging.getLogger(__name__)
+
+
+class AutoChatJob(TypedDict):
+    """批量生成的一个对话任务，其余可选字段（bot_a_source、bot_a_image_style等）原样写入结果"""
+    bot_a_name: str
+    """角色A的名字"""
+    bot_a_info: str
+    """角色A人设"""
+    bot_b_name: str
+    """角色B的名字"""
+    bot_b_info: str
+    """角色B人设"""
+    topic: str
+    """开场话题，作为对话的第一条消息"""
+
+
+# 保存的对话中，除history外的字段
+META_KEYS = (
+    "bot_a_source", "bot_a_name", "bot_a_info", "bot_a_image_style",
+    "bot_b_source", "bot_b_name", "bot_b_info", "bot_b_image_style",
+)
+
+
+def get_session_meta(meta, reserve=False) -> CharacterMeta:
+    """
+    由角色A/B的设定得到CharacterGLM所需的meta
+    :param meta: 包含bot_a_*、bot_b_*字段
+    :param reserve: False时由角色A回复，True时由角色B回复
+    :return:
+    """
+    if reserve:
+        return {
+            "bot_name": meta["bot_b_name"],
+            "bot_info": meta["bot_b_info"],
+            "user_name": meta["bot_a_name"],
+            "user_info": meta["bot_a_info"],
+        }
+    else:
+        return {
+            "bot_name": meta["bot_a_name"],
+            "bot_info": meta["bot_a_info"],
+            "user_name": meta["bot_b_name"],
+            "user_info": meta["bot_b_info"],
+        }
+
+
+def make_meta(meta) -> Dict:
+    """ 取出需要保存的人设等字段 """
+    return {key: meta.get(key, "") for key in META_KEYS}
+
+
+def make_dialogue(meta, history: MsgList) -> Dict:
+    """ 组装成与history.json相同格式的对话 """
+    dialogue = make_meta(meta)
+    dialogue["history"] = history
+    return dialogue
+
+
+async def generate_turn(history: MsgList, meta, reverse: bool) -> TextMsg:
+    """
+    生成一轮回复，与characterglm_autochat.deal_talk相同：角色A回复记为assistant，角色B回复记为user
+    :param history:
+    :param meta:
+    :param reverse: False时由角色A回复，True时由角色B回复
+    :return:
+    """
+    # 按token预算裁剪/概括对话历史，角色A的回复记为assistant，角色B的回复记为user
+    context = context_window.build(filter_text_msg(history), (meta["bot_a_name"], meta["bot_b_name"]))
+    chunks = []
+    async for chunk in async_api.get_characterglm_response(context.messages, meta=get_session_meta(meta, reverse)):
+        chunks.append(chunk)
+    content = "".join(chunks)
+    if not content:
+        raise RuntimeError(f"角色{'B' if reverse else 'A'}回复生成出错")
+    return TextMsg({"role": "user" if reverse else "assistant", "content": content})
+
+
+async def run_dialogue(job: AutoChatJob, rounds: int, store: Optional[DialogueWriter] = None,
+                       dialogue_id: Optional[str] = None, history: Optional[MsgList] = None,
+                       on_turn: Optional[Callable[[int, TextMsg], None]] = None) -> Dict:
+    """
+    以开场话题开始，角色A、角色B交替回复，每人rounds次
+    :param job:
+    :param rounds:
+    :param store: 传入时每完成一条消息就追加写入，对话完成时写入end记录
+    :param dialogue_id: 写入store时的对话id，默认随机生成
+    :param history: 中断的对话已生成的部分，从下一条消息继续生成
+    :param on_turn: 每生成一条消息（包括开场话题）回调一次，参数为(下标, 消息)，用于写入检查点
+    :return:
+    """
+    if history:
+        history = MessageStore(history)
+        if store is not None:
+            # 已生成的部分可能来自任务库的检查点，重新写入对话头和消息（同一index覆盖，重复写入不影响读取）
+            dialogue_id = store.begin_dialogue(make_meta(job), dialogue_id)
+            for i, message in enumerate(history):
+                store.write_turn(dialogue_id, i, message)
+    else:
+        history = MessageStore([TextMsg({"role": "user", "content": job["topic"]})])
+        if on_turn is not None:
+            on_turn(0, history[0])
+        if store is not None:
+            dialogue_id = store.begin_dialogue(make_meta(job), dialogue_id)
+            store.write_turn(dialogue_id, 0, history[0])
+    # 第1、3、5...条由角色A回复，第2、4、6...条由角色B回复
+    while len(history) < 1 + 2 * rounds:
+        reverse = len(history) % 2 == 0
+        history.append(await generate_turn(history, job, reverse))
+        if on_turn is not None:
+            on_turn(len(history) - 1, history[-1])
+        if store is not None:
+            store.write_turn(dialogue_id, len(history) - 1, history[-1])
+    if store is not None:
+        store.end_dialogue(dialogue_id, len(history))
+    return make_dialogue(job, history.to_list())
+
+
+async def run_batch(jobs: List[AutoChatJob], rounds: int, concurrency: int = 10,
+                    on_dialogue: Optional[Callable[[int, Dict], None]] = None,
+                    store: Optional[DialogueWriter] = None,
+                    dialogue_ids: Optional[List[Optional[str]]] = None,
+                    histories: Optional[List[Optional[MsgList]]] = None,
+                    job_store: Optional[JobStore] = None) -> List[Optional[Dict]]:
+    """
+    并发生成多个对话
+    :param jobs:
+    :param rounds: 每个对话的轮数
+    :param concurrency: 同时进行的对话数上限
+    :param on_dialogue: 每完成一个对话回调一次，参数为(任务下标, 对话)，可用于边生成边落盘
+    :param store: 传入时逐条消息追加写入jsonl数据集
+    :param dialogue_ids: 与jobs一一对应，写入store时的对话id
+    :param histories: 与jobs一一对应，中断的对话已生成的部分，见run_dialogue
+    :param job_store: 传入时dialogue_ids为任务库中的job_id（需已添加），每条消息写入检查点，
+        完成/失败时更新任务状态；未传入histories时从检查点继续
+    :return: 与jobs一一对应，失败的任务为None
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(index: int, job: AutoChatJob) -> Optional[Dict]:
+        dialogue_id = dialogue_ids[index] if dialogue_ids else None
+        async with semaphore:
+            history, on_turn = histories[index] if histories else None, None
+            if job_store is not None:
+                if histories is None:
+                    history = job_store.history(dialogue_id)
+                job_store.begin(dialogue_id)
+                on_turn = functools.partial(job_store.checkpoint, dialogue_id)
+            try:
+                dialogue = await run_dialogue(job, rounds, store, dialogue_id, history, on_turn)
+            except Exception as e:
+                # aiohttp的异常里带着请求头（含鉴权token），只记录类型和状态码
+                logger.warning("对话任务%d生成失败: %s %s", index, type(e).__name__, getattr(e, "status", ""))
+                if job_store is not None:
+                    job_store.fail(dialogue_id, type(e).__name__)
+                return None
+            if job_store is not None:
+                job_store.finish(dialogue_id)
+        if on_dialogue is not None:
+            on_dialogue(index, dialogue)
+        return dialogue
+
+    return await asyncio.gather(*(worker(i, job) for i, job in enumerate(jobs)))
+
+
+def generate_dialogues(jobs: List[AutoChatJob], rounds: int, concurrency: int = 10,
+                       on_dialogue: Optional[Callable[[int, Dict], None]] = None,
+                       store: Optional[DialogueWriter] = None) -> List[Optional[Dict]]:
+    """ run_batch的同步入口，自行创建并关闭事件循环 """
+
+    async def main():
+        try:
+            return await run_batch(jobs, rounds, concurrency, on_dialogue, store)
+        finally:
+            await async_api.close_session()
+
+    return asyncio.run(main())
+
+
+def save_dialogue(dialogue: Dict, file_path: str):
+    """ 保存单个对话，格式同characterglm_autochat.save_meta """
+    with open(file_path, "w") as f:
+        json.dump(dialogue, f, indent=4, ensure_ascii=False)
+
+
+def save_dialogues(dialogues: List[Optional[Dict]], output_dir: str) -> List[str]:
+    """
+    每个对话保存为output_dir下的一个json文件，跳过失败的任务
+    :return: 保存的文件路径
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i, dialogue in enumerate(dialogues):
+        if dialogue is None:
+            continue
+        file_path = os.path.join(output_dir, f"dialogue_{i:05d}.json")
+        save_dialogue(dialogue, file_path)
+        paths.append(file_path)
+    return paths
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+    import api
+    api.API_KEY = os.getenv("API_KEY", "")
+
+    logging.basicConfig(level=logging.INFO)
+    with open("history.json") as f:
+        example = json.load(f)
+    example_jobs = [AutoChatJob(bot_a_name=example["bot_a_name"], bot_a_info=example["bot_a_info"],
+                                bot_b_name=example["bot_b_name"], bot_b_info=example["bot_b_info"],
+                                topic=example["history"][0]["content"])]
+    print(save_dialogues(generate_dialogues(example_jobs, rounds=2), "output"))
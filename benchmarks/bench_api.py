@@ -0,0 +1,224 @@
+"""
+api层的端到端benchmark，请求发往本地的mock服务（benchmarks/mock_server.py），不消耗真实API额度
+
+客户端：
+- requests: api.get_characterglm_response（requests + 增量sse解析）
+- sdk: api.get_chatglm_response_via_sdk（新版zhipuai sdk，httpx）
+- aiohttp: async_api.get_characterglm_response（homework/sync_api.py也是调用它）
+- aiohttp-chatglm: async_api.get_chatglm_response
+
+场景：
+- ttft: 单个请求重复--repeat次，首token延迟（TTFT）和tokens/s的分位数
+- concurrency: 按--concurrency中的每个并发数同时发起请求，总tokens/s、TTFT分位数随并发的变化
+- parse: mock服务不限速、不延迟，回复--parse-tokens个token，和只读字节不解析的基线比，得出解析开销
+
+默认放开scheduler.py中的限额（否则测到的是限流），--respect-limits保留。
+
+运行方式（仓库根目录）：
+```bash
+python -m benchmarks.bench_api --latency 0.2 --token-rate 50 --concurrency 1,8,32,128
+python -m benchmarks.bench_api --scenarios parse --clients requests,aiohttp
+python -m benchmarks.bench_api --scenarios concurrency --error-rate 0.05 --rate-limit-rate 0.1
+```
+"""
+import argparse
+import asyncio
+import dataclasses
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import api
+import async_api
+from benchmarks.mock_server import MockServer, add_config_arguments, config_from_args
+from instrumentation import metrics
+from scheduler import scheduler
+
+META = {
+    "user_info": "我是陆星辰，是一个男性，是一位知名导演。",
+    "bot_info": "苏梦远，本名苏远心，是一位当红的国内女歌手及演员。",
+    "bot_name": "苏梦远",
+    "user_name": "陆星辰",
+}
+MESSAGES = [{"role": "user", "content": "你好，好久不见。"}]
+
+SYNC_CLIENTS: Dict[str, Callable] = {
+    "requests": lambda: api.get_characterglm_response(MESSAGES, META),
+    "sdk": lambda: api.get_chatglm_response_via_sdk(MESSAGES),
+}
+ASYNC_CLIENTS: Dict[str, Callable] = {
+    "aiohttp": lambda: async_api.get_characterglm_response(MESSAGES, META),
+    "aiohttp-chatglm": lambda: async_api.get_chatglm_response(MESSAGES),
+}
+
+
+@dataclasses.dataclass
+class Sample:
+    ttft: float
+    elapsed: float
+    tokens: int
+    error: bool = False
+
+
+def run_sync(make_stream: Callable) -> Sample:
+    start = time.perf_counter()
+    ttft, tokens = None, 0
+    try:
+        for _ in make_stream():
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            tokens += 1
+    except Exception:
+        return Sample(time.perf_counter() - start, time.perf_counter() - start, tokens, True)
+    elapsed = time.perf_counter() - start
+    return Sample(elapsed if ttft is None else ttft, elapsed, tokens)
+
+
+async def run_async(make_stream: Callable) -> Sample:
+    start = time.perf_counter()
+    ttft, tokens = None, 0
+    try:
+        async for _ in make_stream():
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            tokens += 1
+    except Exception:
+        return Sample(time.perf_counter() - start, time.perf_counter() - start, tokens, True)
+    elapsed = time.perf_counter() - start
+    return Sample(elapsed if ttft is None else ttft, elapsed, tokens)
+
+
+def run_batch(client: str, concurrency: int, total: int) -> List[Sample]:
+    """ 以concurrency的并发执行total个请求 """
+    if client in SYNC_CLIENTS:
+        make_stream = SYNC_CLIENTS[client]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(lambda _: run_sync(make_stream), range(total)))
+
+    make_stream = ASYNC_CLIENTS[client]
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                return await run_async(make_stream)
+
+        try:
+            return await asyncio.gather(*(one() for _ in range(total)))
+        finally:
+            await async_api.close_session()
+
+    return asyncio.run(main())
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def report(label: str, samples: List[Sample], wall: float):
+    ok = [s for s in samples if not s.error]
+    ttfts = [s.ttft * 1000 for s in ok]
+    rates = [s.tokens / (s.elapsed - s.ttft) for s in ok if s.elapsed > s.ttft and s.tokens > 1]
+    tokens = sum(s.tokens for s in ok)
+    print(f"{label:<28} ttft p50 {percentile(ttfts, 50):8.1f} ms  p95 {percentile(ttfts, 95):8.1f} ms  "
+          f"p99 {percentile(ttfts, 99):8.1f} ms  per-stream {statistics.median(rates) if rates else 0:8.1f} tok/s  "
+          f"total {tokens / wall:9.1f} tok/s  errors {len(samples) - len(ok)}")
+
+
+def bench_ttft(server: MockServer, clients: List[str], repeat: int):
+    print("== ttft")
+    for client in clients:
+        run_batch(client, 1, 1)  # 预热连接池和sdk client
+        start = time.perf_counter()
+        samples = run_batch(client, 1, repeat)
+        report(client, samples, time.perf_counter() - start)
+
+
+def bench_concurrency(server: MockServer, clients: List[str], levels: List[int], rounds: int):
+    print("== concurrency")
+    for client in clients:
+        run_batch(client, 1, 1)
+        for level in levels:
+            server.max_in_flight = 0
+            start = time.perf_counter()
+            samples = run_batch(client, level, level * rounds)
+            report(f"{client} x{level}", samples, time.perf_counter() - start)
+            print(f"{'':<28} server max_in_flight {server.max_in_flight}")
+
+
+def read_raw(server: MockServer) -> float:
+    """ 只读取charglm的sse字节，不解析，作为解析开销的基线 """
+    start = time.perf_counter()
+    with api.get_http_session().post(api.CHARACTERGLM_URL, headers={"Authorization": "mock"},
+                                     json={"prompt": MESSAGES, "meta": META}, stream=True) as resp:
+        for _ in resp.iter_content(chunk_size=None):
+            pass
+    return time.perf_counter() - start
+
+
+def bench_parse(server: MockServer, clients: List[str], tokens: int, repeat: int):
+    print("== parse")
+    config = server.config
+    saved = (config.latency, config.token_rate, config.tokens, config.error_rate, config.rate_limit_rate)
+    config.latency, config.token_rate, config.tokens, config.error_rate, config.rate_limit_rate = 0, 0, tokens, 0, 0
+    try:
+        read_raw(server)
+        raw = min(read_raw(server) for _ in range(repeat))
+        print(f"{'raw bytes (requests)':<28} {raw * 1000:8.1f} ms  {tokens / raw:10.0f} tok/s")
+        for client in clients:
+            run_batch(client, 1, 1)
+            best = min(run_batch(client, 1, 1)[0].elapsed for _ in range(repeat))
+            print(f"{client:<28} {best * 1000:8.1f} ms  {tokens / best:10.0f} tok/s  "
+                  f"overhead {(best - raw) / tokens * 1e6:6.2f} us/token")
+    finally:
+        config.latency, config.token_rate, config.tokens, config.error_rate, config.rate_limit_rate = saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="ttft,concurrency,parse")
+    parser.add_argument("--clients", default=",".join(list(SYNC_CLIENTS) + list(ASYNC_CLIENTS)))
+    parser.add_argument("--concurrency", default="1,8,32,128")
+    parser.add_argument("--rounds", type=int, default=2, help="并发场景中每个并发数执行几轮")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--parse-tokens", type=int, default=20000)
+    parser.add_argument("--respect-limits", action="store_true", help="保留scheduler.py中的限额")
+    parser.add_argument("--metrics", choices=["json", "prometheus"], help="结束时输出instrumentation.py记录的指标")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    clients = args.clients.split(",")
+    for client in clients:
+        if client not in SYNC_CLIENTS and client not in ASYNC_CLIENTS:
+            parser.error(f"unknown client: {client}")
+    if not args.respect_limits:
+        for model in ("charglm-3", "glm-3-turbo", "cogview-3"):
+            scheduler.configure(model, rps=1e9, burst=1e9, max_concurrency=1 << 20)
+
+    with MockServer(config_from_args(args)) as server:
+        api.set_api_key("mock.secret")
+        api.set_api_base(server.api_base)
+        print(f"mock server {server.api_base}, {server.config}")
+        scenarios = args.scenarios.split(",")
+        if "ttft" in scenarios:
+            bench_ttft(server, clients, args.repeat)
+        if "concurrency" in scenarios:
+            bench_concurrency(server, clients, [int(level) for level in args.concurrency.split(",")], args.rounds)
+        if "parse" in scenarios:
+            bench_parse(server, clients, args.parse_tokens, max(1, args.repeat // 4))
+        print(f"server stats {server.stats()}")
+    if args.metrics == "json":
+        print(metrics.to_json())
+    elif args.metrics == "prometheus":
+        print(metrics.to_prometheus())
+    api.close_http_session()
+    api.close_zhipuai_client()
+
+
+if __name__ == "__main__":
+    main()
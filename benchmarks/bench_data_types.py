@@ -0,0 +1,106 @@
+"""
+消息数据类型的解析/校验耗时benchmark
+
+构造--messages条消息的json（每隔--image-every条一张图片消息），比较从json字节串得到消息对象的几种方式：
+- TypedDict: json.loads，得到的dict直接当作data_types.TextMsg/ImageMsg使用，不校验
+- dataclass: json.loads后逐条构造dataclass，不校验
+- pydantic逐条: json.loads后逐条调用model_validate
+- pydantic TypeAdapter: json.loads后整个列表一次validate_python
+- pydantic validate_json: 直接从字节串解析并校验，不生成中间的dict
+- pydantic model_construct: json.loads后逐条model_construct，不校验，只用于可信来源
+
+运行方式（仓库根目录）：
+```bash
+python -m benchmarks.bench_data_types --messages 1000000
+```
+"""
+import argparse
+import dataclasses
+import json
+import time
+from typing import Callable, List, Optional, Union
+
+from homework.data_types_hw import (ImageMsg, TextMsg, construct_messages, validate_messages,
+                                    validate_messages_json)
+
+
+@dataclasses.dataclass
+class TextMsgDC:
+    role: str
+    content: str
+
+
+@dataclasses.dataclass
+class ImageMsgDC:
+    role: str
+    image: str
+    caption: Optional[Union[str, List[str]]]
+
+
+def build_json(n_messages: int, image_every: int) -> bytes:
+    messages = []
+    for i in range(n_messages):
+        if image_every and i % image_every == image_every - 1:
+            messages.append({"role": "image", "image": f"https://example.com/{i}.png", "caption": "场景"})
+        else:
+            messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": f"第{i}句话，你好呀。"})
+    return json.dumps(messages, ensure_ascii=False).encode()
+
+
+def parse_typeddict(data: bytes) -> list:
+    return json.loads(data)
+
+
+def parse_dataclass(data: bytes) -> list:
+    return [ImageMsgDC(**m) if m["role"] == "image" else TextMsgDC(**m) for m in json.loads(data)]
+
+
+def parse_pydantic_each(data: bytes) -> list:
+    return [ImageMsg.model_validate(m) if m["role"] == "image" else TextMsg.model_validate(m)
+            for m in json.loads(data)]
+
+
+def parse_pydantic_adapter(data: bytes) -> list:
+    return validate_messages(json.loads(data))
+
+
+def parse_pydantic_json(data: bytes) -> list:
+    return validate_messages_json(data)
+
+
+def parse_pydantic_construct(data: bytes) -> list:
+    return construct_messages(json.loads(data))
+
+
+def bench(name: str, func: Callable[[bytes], list], data: bytes, repeat: int, baseline: Optional[float]) -> float:
+    best = float("inf")
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = len(func(data))
+        best = min(best, time.perf_counter() - start)
+    ratio = f"  x{best / baseline:5.1f}" if baseline else ""
+    print(f"{name:<24} {best * 1000:9.1f} ms  {count / best:12.0f} msgs/s{ratio}")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--image-every", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    data = build_json(args.messages, args.image_every)
+    print(f"{args.messages} messages, {len(data) / 1024 / 1024:.1f} MB json")
+    baseline = bench("TypedDict (json.loads)", parse_typeddict, data, args.repeat, None)
+    for name, func in (("dataclass", parse_dataclass),
+                       ("pydantic model_validate", parse_pydantic_each),
+                       ("pydantic TypeAdapter", parse_pydantic_adapter),
+                       ("pydantic validate_json", parse_pydantic_json),
+                       ("pydantic model_construct", parse_pydantic_construct)):
+        bench(name, func, data, args.repeat, baseline)
+
+
+if __name__ == "__main__":
+    main()
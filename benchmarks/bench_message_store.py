@@ -0,0 +1,103 @@
+"""
+对话历史存储的内存与耗时benchmark
+
+构造--turns轮的对话历史（每隔--image-every条插入一张图片消息），对比：
+- list: 原先的TypedDict列表，filter_text_msg每次复制出文本消息列表
+- MessageStore: 按列存储，text_view()不复制
+
+输出历史本身占用的内存（tracemalloc统计，包含消息内容）、每次取文本消息的耗时和额外内存，
+以及转回json格式（to_list + json.dumps）的耗时。
+
+运行方式（仓库根目录）：
+```bash
+python -m benchmarks.bench_message_store --turns 100000
+```
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from typing import Callable, Tuple
+
+from data_types import ImageMsg, MsgList, TextMsg, filter_text_msg
+from message_store import MessageStore
+
+SENTENCES = [
+    "哥哥，你终于回来了！我等了你好久。",
+    "外面下雨了，你有没有带伞？",
+    "今天的晚饭是你最喜欢的红烧肉哦。",
+    "Let's go to the library tomorrow.",
+    "我做了一个很奇怪的梦，梦里我们在海边。",
+]
+
+
+def build_history(turns: int, image_every: int) -> MsgList:
+    history: MsgList = []
+    for i in range(turns):
+        if image_every and i % image_every == image_every - 1:
+            history.append(ImageMsg({"role": "image", "image": f"https://example.com/{i}.png", "caption": "场景"}))
+        # 每条内容都是新的字符串对象，与实际对话一样不共享
+        content = f"{SENTENCES[i % len(SENTENCES)]}（{i}）"
+        history.append(TextMsg({"role": "user" if i % 2 == 0 else "assistant", "content": content}))
+    return history
+
+
+def measure(func: Callable[[], object]) -> Tuple[object, int, float]:
+    """ :return: (结果, 新分配且仍存活的字节数, 耗时秒数) """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def mb(size: int) -> str:
+    return f"{size / 1024 / 1024:8.1f} MB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=100000)
+    parser.add_argument("--image-every", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    history, list_size, _ = measure(lambda: build_history(args.turns, args.image_every))
+    store, store_size, _ = measure(lambda: MessageStore(build_history(args.turns, args.image_every)))
+    n_text = len(store.text_view())
+    print(f"{len(history)} messages ({n_text} text)")
+    # MessageStore构造时会先建出list再转换，tracemalloc只统计最后仍存活的部分
+    print(f"list          history {mb(list_size)}  ({list_size / len(history):6.1f} B/message)")
+    print(f"MessageStore  history {mb(store_size)}  ({store_size / len(store):6.1f} B/message)")
+
+    for name, func in (("filter_text_msg(list)", lambda: filter_text_msg(history)),
+                       ("text_view()", lambda: filter_text_msg(store))):
+        best, extra = float("inf"), 0
+        for _ in range(args.repeat):
+            _, extra, elapsed = measure(func)
+            best = min(best, elapsed)
+        print(f"{name:<22} {best * 1000:8.3f} ms  extra {mb(extra)}")
+
+    # 每轮对话追加两条消息后取一次文本消息
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        for i in range(1000):
+            store.append(TextMsg({"role": "user", "content": str(i)}))
+            filter_text_msg(store)
+        best = min(best, time.perf_counter() - start)
+    print(f"append+text_view x1000 {best * 1000:7.3f} ms")
+
+    for name, func in (("json.dumps(list)", lambda: json.dumps(history, ensure_ascii=False)),
+                       ("json.dumps(to_list())", lambda: json.dumps(store.to_list(), ensure_ascii=False))):
+        start = time.perf_counter()
+        func()
+        print(f"{name:<22} {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+streamlit每次rerun的耗时随对话历史长度的变化
+
+用streamlit.testing的AppTest在进程内运行characterglm_autochat.py，对话历史为--lengths中的每个长度
+（每隔--image-every条一张已下载到本地缓存的图片），测量每次rerun执行脚本的耗时（中位数），
+以及本次rerun产生的元素个数。不包含浏览器渲染和websocket传输的时间，元素个数可以作为传输量的参考。
+--show-older时展开history_view.py中折叠的较早消息。
+
+运行方式（仓库根目录）：
+```bash
+python -m benchmarks.bench_rerun --lengths 10,100,1000,5000
+```
+"""
+import argparse
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# 图片缓存放在临时目录，需要在导入image_cache之前设置
+os.environ.setdefault("IMAGE_CACHE_DIR", tempfile.mkdtemp(prefix="bench_rerun_"))
+os.environ.setdefault("SUMMARY_STORE_PATH", "")
+os.environ.setdefault("DEBUG", "no")
+
+from PIL import Image
+from streamlit.testing.v1 import AppTest
+
+from data_types import ImageMsg, TextMsg
+from image_cache import image_cache
+from message_store import MessageStore
+
+META = {
+    "bot_a_source": "", "bot_a_name": "苏梦远", "bot_a_info": "当红的国内女歌手及演员。", "bot_a_image_style": "二次元风格",
+    "bot_b_source": "", "bot_b_name": "陆星辰", "bot_b_info": "知名导演。", "bot_b_image_style": "写实风格",
+}
+
+
+def make_image(size: int) -> bytes:
+    """ 带噪点的png，大小与cogview生成的图片相近 """
+    rng = random.Random(0)
+    image = Image.frombytes("RGB", (size, size), bytes(rng.getrandbits(8) for _ in range(size * size * 3)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def build_history(length: int, image_every: int, image_ref: str) -> MessageStore:
+    history = MessageStore()
+    for i in range(length):
+        if image_every and i % image_every == image_every - 1:
+            history.append(ImageMsg({"role": "image", "image": f"https://example.com/{i}.png", "caption": f"场景{i}",
+                                     "local_image": image_ref}))
+        else:
+            history.append(TextMsg({"role": "user" if i % 2 == 0 else "assistant",
+                                    "content": f"第{i}句话。哥哥，你终于回来了！外面下雨了，你有没有带伞？"}))
+    return history
+
+
+def count_elements(node) -> int:
+    children = getattr(node, "children", None)
+    if not children:
+        return 1
+    return 1 + sum(count_elements(child) for child in children.values())
+
+
+def bench(length: int, image_every: int, image_ref: str, repeat: int, show_older: bool):
+    at = AppTest.from_file(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                        "characterglm_autochat.py"), default_timeout=120)
+    at.session_state["meta"] = dict(META)
+    at.session_state["history"] = build_history(length, image_every, image_ref)
+    at.session_state["history_show_older"] = show_older
+    at.run()
+    if at.exception:
+        raise RuntimeError(at.exception)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        at.run()
+        times.append(time.perf_counter() - start)
+    print(f"history {length:6d}  rerun {statistics.median(times) * 1000:9.1f} ms  "
+          f"elements {count_elements(at._tree):6d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", default="10,100,1000,5000")
+    parser.add_argument("--image-every", type=int, default=20)
+    parser.add_argument("--image-size", type=int, default=1024, help="图片的边长（像素）")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--show-older", action="store_true", help="展开折叠的较早消息")
+    args = parser.parse_args()
+
+    content = make_image(args.image_size)
+    image_ref = "bench.png"
+    with open(image_cache.local_path(image_ref), "wb") as f:
+        f.write(content)
+    print(f"image {args.image_size}x{args.image_size}, {len(content) / 1024 / 1024:.1f} MB")
+    for length in (int(n) for n in args.lengths.split(",")):
+        bench(length, args.image_every, image_ref, args.repeat, args.show_older)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+sse解析吞吐量的micro-benchmark
+
+构造一段charglm-3风格的sse字节流，按固定大小切块喂给解析器，输出MB/s。
+对比对象是原先api.py（iter_lines逐行split）和homework/sync_api.py（逐行decode再split）的解析方式。
+
+运行方式（仓库根目录）：
+```bash
+python -m benchmarks.bench_sse --events 200000 --chunk-size 4096
+```
+"""
+import argparse
+import time
+from typing import Callable, Iterator
+
+from sse import SSEDecoder
+
+
+def build_stream(n_events: int) -> bytes:
+    """ 构造sse字节流，每个add事件一个token，token中混有冒号和中文 """
+    tokens = ["你好", "，", "哥哥", "：", "我", "会", "死", "吗", "？", "time: 12:30", "ok"]
+    parts = []
+    for i in range(n_events):
+        parts.append(f"event: add\nid: {i}\ndata: {tokens[i % len(tokens)]}\n\n")
+    parts.append("event: finish\ndata: \n\n")
+    return "".join(parts).encode()
+
+
+def iter_chunks(stream: bytes, chunk_size: int) -> Iterator[memoryview]:
+    view = memoryview(stream)
+    for i in range(0, len(view), chunk_size):
+        yield view[i:i + chunk_size]
+
+
+def parse_with_decoder(stream: bytes, chunk_size: int) -> int:
+    decoder = SSEDecoder()
+    count = 0
+    for chunk in iter_chunks(stream, chunk_size):
+        for event in decoder.feed(chunk):
+            if event.event == "add":
+                count += 1
+    return count
+
+
+def iter_lines(chunks: Iterator[memoryview]) -> Iterator[bytes]:
+    """ 与requests.Response.iter_lines相同的切行方式 """
+    pending = None
+    for chunk in chunks:
+        chunk = bytes(chunk)
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        yield from lines
+    if pending is not None:
+        yield pending
+
+
+def parse_with_iter_lines(stream: bytes, chunk_size: int) -> int:
+    """ 原api.py的解析方式：resp.iter_lines()逐行split """
+    count = 0
+    sep = b':'
+    last_event = None
+    for line in iter_lines(iter_chunks(stream, chunk_size)):
+        if not line or line.startswith(sep):
+            continue
+        field, value = line.split(sep, maxsplit=1)
+        if field == b'event':
+            last_event = value
+        elif field == b'data' and last_event == b' add':
+            value.decode()
+            count += 1
+    return count
+
+
+def parse_with_decoded_lines(stream: bytes, chunk_size: int) -> int:
+    """ 原homework/sync_api.py的解析方式：每行先decode成str再split（冒号多于一个的行会被丢掉） """
+    count = 0
+    last_event = None
+    for line in iter_lines(iter_chunks(stream, chunk_size)):
+        line = line.decode()
+        if not line or line.startswith(':'):
+            continue
+        ret = line.split(':')
+        if len(ret) != 2:
+            continue
+        field = ret[0]
+        value = ret[1]
+        if field == 'event':
+            last_event = value.strip()
+        elif field == 'data' and last_event == 'add':
+            value.strip()
+            count += 1
+    return count
+
+
+def bench(name: str, func: Callable[[bytes, int], int], stream: bytes, chunk_size: int, repeat: int):
+    best = float("inf")
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = func(stream, chunk_size)
+        best = min(best, time.perf_counter() - start)
+    mb = len(stream) / 1024 / 1024
+    print(f"{name:<14} {mb / best:8.1f} MB/s  {count / best:12.0f} events/s  ({count} events, {mb:.1f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    stream = build_stream(args.events)
+    bench("SSEDecoder", parse_with_decoder, stream, args.chunk_size, args.repeat)
+    bench("iter_lines", parse_with_iter_lines, stream, args.chunk_size, args.repeat)
+    bench("decode+split", parse_with_decoded_lines, stream, args.chunk_size, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+本地的智谱开放平台mock服务，用于在不调用真实API的情况下测量性能
+
+模拟的接口（路径与真实接口相同，api.set_api_base或环境变量ZHIPUAI_API_BASE指向它即可）：
+- POST /api/paas/v3/model-api/charglm-3/sse-invoke   charglm-3的sse流式回复
+- POST /api/paas/v4/chat/completions                 glm-3-turbo，支持stream=True/False，
+                                                     生成人设的请求（api.build_role_info_messages）返回json
+- POST /api/paas/v4/images/generations               cogview-3，返回指向本服务的图片url
+- GET  /images/{name}.png                            图片内容
+
+可调的参数（MockConfig）：首token延迟、每秒token数、每次回复的token数、5xx错误率、429比例（带Retry-After）。
+不校验token的签名，只要求带有Authorization头。
+
+单独运行（仓库根目录）：
+```bash
+python -m benchmarks.mock_server --port 8787 --token-rate 50 --latency 0.3 --error-rate 0.05
+ZHIPUAI_API_BASE=http://127.0.0.1:8787/api/paas API_KEY=mock.secret streamlit run characterglm_autochat.py
+```
+在benchmark中使用：
+```python
+with MockServer(MockConfig(token_rate=0)) as server:
+    api.set_api_base(server.api_base)
+```
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+
+from aiohttp import web
+
+# 模拟回复中循环使用的token
+TOKENS = ["哥哥", "，", "我", "今天", "去", "了", "海边", "。", "你", "呢", "？", "（", "笑", "）"]
+
+
+@dataclasses.dataclass
+class MockConfig:
+    latency: float = 0.0
+    """收到请求到返回第一个token的延迟（秒）"""
+    token_rate: float = 0.0
+    """每秒输出的token数，0表示不限速"""
+    tokens: int = 100
+    """每次回复的token数"""
+    error_rate: float = 0.0
+    """返回500的比例"""
+    rate_limit_rate: float = 0.0
+    """返回429的比例"""
+    retry_after: float = 0.1
+    """429响应中Retry-After的秒数"""
+    image_latency: float = 0.0
+    """cogview生成图片的耗时（秒）"""
+    seed: Optional[int] = None
+
+
+def _png(width: int = 8, height: int = 8) -> bytes:
+    """ 一张纯色的小png """
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    raw = b"".join(b"\x00" + b"\x80\x40\xc0" * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+
+class MockServer(object):
+    """ 在后台线程的事件循环中运行的mock服务 """
+
+    def __init__(self, config: Optional[MockConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or MockConfig()
+        self.host = host
+        self.port = port
+        self._random = random.Random(self.config.seed)
+        self._png = _png()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+        self._started = threading.Event()
+        self._lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.errors = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.bytes_sent = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def api_base(self) -> str:
+        """ 交给api.set_api_base的地址 """
+        return f"{self.base_url}/api/paas"
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/paas/v3/model-api/charglm-3/sse-invoke", self.charglm)
+        app.router.add_post("/api/paas/v4/chat/completions", self.chat_completions)
+        app.router.add_post("/api/paas/v4/images/generations", self.images)
+        app.router.add_get("/images/{name}", self.image_file)
+        return app
+
+    # ---------- 公共逻辑 ----------
+
+    def _count(self, name: str):
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def _failure(self, request: web.Request) -> Optional[web.Response]:
+        """ 按配置的比例返回401/429/500，正常时返回None """
+        if "Authorization" not in request.headers:
+            return web.json_response({"error": {"code": "1000", "message": "身份验证失败"}}, status=401)
+        roll = self._random.random()
+        if roll < self.config.rate_limit_rate:
+            with self._lock:
+                self.rate_limited += 1
+            return web.json_response({"error": {"code": "1302", "message": "并发数过高"}}, status=429,
+                                     headers={"Retry-After": str(self.config.retry_after)})
+        if roll < self.config.rate_limit_rate + self.config.error_rate:
+            with self._lock:
+                self.errors += 1
+            return web.json_response({"error": {"code": "500", "message": "mock error"}}, status=500)
+        return None
+
+    async def _stream(self, request: web.Request, events) -> web.StreamResponse:
+        """ 按配置的延迟和速率写出sse事件，events为(是否计入token, 字节)的迭代器 """
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await resp.prepare(request)
+        if self.config.latency:
+            await asyncio.sleep(self.config.latency)
+        interval = 1 / self.config.token_rate if self.config.token_rate else 0
+        start = time.monotonic()
+        n = 0
+        for is_token, payload in events:
+            if is_token and interval:
+                # 按绝对时间对齐，不累积sleep的误差
+                delay = start + n * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            n += is_token
+            await resp.write(payload)
+            with self._lock:
+                self.bytes_sent += len(payload)
+        await resp.write_eof()
+        return resp
+
+    async def _guard(self, name: str, request: web.Request, handler):
+        self._count(name)
+        failure = self._failure(request)
+        if failure is not None:
+            return failure
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await handler()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    # ---------- 接口 ----------
+
+    async def charglm(self, request: web.Request) -> web.StreamResponse:
+        async def handler():
+            await request.json()
+
+            def events():
+                for i in range(self.config.tokens):
+                    yield True, f"event: add\nid: {i}\ndata: {TOKENS[i % len(TOKENS)]}\n\n".encode()
+                usage = {"prompt_tokens": 10, "completion_tokens": self.config.tokens,
+                         "total_tokens": 10 + self.config.tokens}
+                yield False, f"event: finish\nid: {self.config.tokens}\ndata: \nmeta: " \
+                             f"{json.dumps({'usage': usage})}\n\n".encode()
+
+            return await self._stream(request, events())
+
+        return await self._guard("charglm-3", request, handler)
+
+    def _completion_chunk(self, content: Optional[str], finish_reason: Optional[str] = None) -> Dict:
+        delta = {"role": "assistant"}
+        if content is not None:
+            delta["content"] = content
+        return {"id": "mock", "created": int(time.time()), "model": "glm-3-turbo",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        async def handler():
+            body = await request.json()
+            if not body.get("stream"):
+                if self.config.latency:
+                    await asyncio.sleep(self.config.latency)
+                if self.config.token_rate:
+                    await asyncio.sleep(self.config.tokens / self.config.token_rate)
+                prompt = body["messages"][-1]["content"] if body.get("messages") else ""
+                if "返回格式:json" in prompt:
+                    # 与真实模型一样包在```json代码块里，名字由prompt的哈希得到
+                    role = {"name": f"角色{zlib.crc32(prompt.encode()) % 10000:04d}", "info": "mock人设。"}
+                    content = f"```json\n{json.dumps(role, ensure_ascii=False)}\n```"
+                else:
+                    content = "".join(TOKENS[i % len(TOKENS)] for i in range(self.config.tokens))
+                return web.json_response({
+                    "id": "mock", "created": int(time.time()), "model": "glm-3-turbo",
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": {"prompt_tokens": 10, "completion_tokens": self.config.tokens,
+                              "total_tokens": 10 + self.config.tokens},
+                })
+
+            def events():
+                for i in range(self.config.tokens):
+                    chunk = self._completion_chunk(TOKENS[i % len(TOKENS)])
+                    yield True, f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode()
+                yield False, f"data: {json.dumps(self._completion_chunk('', 'stop'))}\n\n".encode()
+                yield False, b"data: [DONE]\n\n"
+
+            return await self._stream(request, events())
+
+        return await self._guard("glm-3-turbo", request, handler)
+
+    async def images(self, request: web.Request) -> web.Response:
+        async def handler():
+            await request.json()
+            if self.config.image_latency:
+                await asyncio.sleep(self.config.image_latency)
+            n = sum(self.requests.values())
+            return web.json_response({"created": int(time.time()),
+                                      "data": [{"url": f"{self.base_url}/images/{n}.png"}]})
+
+        return await self._guard("cogview-3", request, handler)
+
+    async def image_file(self, request: web.Request) -> web.Response:
+        self._count("image")
+        return web.Response(body=self._png, content_type="image/png")
+
+    # ---------- 启动/停止 ----------
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, self.host, self.port, backlog=1024)
+        self._loop.run_until_complete(site.start())
+        # port=0时由系统分配端口
+        self.port = self._runner.addresses[0][1]
+        self._started.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def start(self) -> "MockServer":
+        self._thread = threading.Thread(target=self._run, name="mock_server", daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self) -> "MockServer":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "requests": dict(self.requests),
+                "errors": self.errors,
+                "rate_limited": self.rate_limited,
+                "max_in_flight": self.max_in_flight,
+                "bytes_sent": self.bytes_sent,
+            }
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", type=float, default=0.0, help="首token延迟（秒）")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="每秒token数，0表示不限速")
+    parser.add_argument("--tokens", type=int, default=100, help="每次回复的token数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回500的比例")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="返回429的比例")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="429响应中Retry-After的秒数")
+    parser.add_argument("--image-latency", type=float, default=0.0, help="生成图片的耗时（秒）")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(latency=args.latency, token_rate=args.token_rate, tokens=args.tokens,
+                      error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                      retry_after=args.retry_after, image_latency=args.image_latency, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockServer(config_from_args(args), args.host, args.port)
+    print(f"mock server: ZHIPUAI_API_BASE={server.api_base}")
+    web.run_app(server.make_app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
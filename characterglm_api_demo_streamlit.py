@@ -14,7 +14,6 @@ streamlit run characterglm_api_demo_streamlit.py
 ```
 """
 import os
-import itertools
 from typing import Iterator, Optional
 
 import streamlit as st
@@ -26,6 +25,11 @@ load_dotenv()
 import api
 from api import generate_chat_scene_prompt, generate_role_appearance, get_characterglm_response, generate_cogview_image
 from data_types import TextMsg, ImageMsg, TextMsgList, MsgList, filter_text_msg
+from image_cache import image_cache
+from history_view import history_view
+from message_store import MessageStore
+from stream_render import render_stream
+from context_window import SCENE_CONTEXT_BUDGET, context_window
 
 st.set_page_config(page_title="CharacterGLM API Demo", page_icon="🤖", layout="wide")
 debug = os.getenv("DEBUG", "yes").lower() in ("1", "yes", "y", "true", "t", "on")
@@ -36,7 +40,7 @@ def update_api_key(key: Optional[str] = None):
         print(f'update_api_key. st.session_state["API_KEY"] = {st.session_state["API_KEY"]}, key = {key}')
     key = key or st.session_state["API_KEY"]
     if key:
-        api.API_KEY = key
+        api.set_api_key(key)
 
 # 设置API KEY
 api_key = st.sidebar.text_input("API_KEY", value=os.getenv("API_KEY", ""), key="API_KEY", type="password", on_change=update_api_key)
@@ -45,7 +49,7 @@ update_api_key(api_key)
 
 # 初始化
 if "history" not in st.session_state:
-    st.session_state["history"] = []
+    st.session_state["history"] = MessageStore()
 if "meta" not in st.session_state:
     st.session_state["meta"] = {
         "user_info": "",
@@ -57,7 +61,7 @@ if "meta" not in st.session_state:
 
 
 def init_session():
-    st.session_state["history"] = []
+    st.session_state["history"] = MessageStore()
 
 
 # 4个输入框，设置meta的4个字段
@@ -103,13 +107,13 @@ def draw_new_image():
     if not verify_meta():
         return
     text_messages = filter_text_msg(st.session_state["history"])
+    meta = st.session_state["meta"]
     if text_messages:
-        # 若有对话历史，则结合角色人设和对话历史生成图片
+        # 若有对话历史，则结合角色人设和对话历史生成图片，较早的对话用已有的概要代替
+        context = context_window.build(text_messages, (meta["bot_name"], meta["user_name"]),
+                                       budget=SCENE_CONTEXT_BUDGET)
         image_prompt = "".join(
-            generate_chat_scene_prompt(
-                text_messages[-10: ],
-                meta=st.session_state["meta"]
-            )
+            generate_chat_scene_prompt(context.recent, meta=meta, summary=context.summary)
         )
     else:
         # 若没有对话历史，则根据角色人设生成图片
@@ -124,26 +128,32 @@ def draw_new_image():
     image_prompt = f'生成风格: {image_style}。' + image_prompt.strip()
     
     print(f"image_prompt = {image_prompt}")
-    n_retry = 3
-    st.markdown("正在生成图片，请稍等...")
-    for i in range(n_retry):
-        try:
-            img_url = generate_cogview_image(image_prompt)
-        except Exception as e:
-            if i < n_retry - 1:
-                st.error("遇到了一点小问题，重试中...")
-            else:
-                st.error("又失败啦，点击【生成图片】按钮可再次重试")
-                return
-        else:
-            break
+    placeholder = st.empty()
+    placeholder.markdown("正在生成图片，请稍等...")
+    try:
+        # 暂时性的错误已在api层按退避策略重试过
+        img_url = generate_cogview_image(image_prompt)
+    except Exception as e:
+        print(f"generate_cogview_image failed: {e!r}")
+        st.error("又失败啦，点击【生成图片】按钮可再次重试")
+        return
+    # 在后台下载到本地，之后rerun时不再从远程拉取
+    image_cache.prefetch(img_url)
     img_msg = ImageMsg({"role": "image", "image": img_url, "caption": image_prompt})
     # 若history的末尾有图片消息，则替换它，（重新生成）
     # 否则，append（新增）
-    while st.session_state["history"] and st.session_state["history"][-1]["role"] == "image":
-        st.session_state["history"].pop()
-    st.session_state["history"].append(img_msg)
-    st.rerun()
+    history = st.session_state["history"]
+    replaced = False
+    while history and history[-1]["role"] == "image":
+        history.pop()
+        replaced = True
+    history.append(img_msg)
+    if replaced:
+        # 旧的图片已经画在上面了，需要重画整个历史
+        st.rerun()
+    # 新图片直接画在当前位置，不需要rerun重画整个历史
+    with placeholder.container():
+        history_view.draw_message(history, len(history) - 1)
 
 
 button_labels = {
@@ -178,8 +188,8 @@ with st.container():
     with button_key_to_col["clear_history"]:
         clear_history = st.button(button_labels["clear_history"], key="clear_history")
         if clear_history:
+            # 对话历史在按钮之后才绘制，不需要rerun
             init_session()
-            st.rerun()
     
     with button_key_to_col["gen_picture"]:
         gen_picture = st.button(button_labels["gen_picture"], key="gen_picture")
@@ -201,19 +211,9 @@ with st.container():
                 print(f"history = {st.session_state['history']}")
 
 
-# 展示对话历史
-for msg in st.session_state["history"]:
-    if msg["role"] == "user":
-        with st.chat_message(name="user", avatar="user"):
-            st.markdown(msg["content"])
-    elif msg["role"] == "assistant":
-        with st.chat_message(name="assistant", avatar="assistant"):
-            st.markdown(msg["content"])
-    elif msg["role"] == "image":
-        with st.chat_message(name="assistant", avatar="assistant"):
-            st.image(msg["image"], caption=msg.get("caption", None))
-    else:
-        raise Exception("Invalid role")
+# 展示对话历史，较早的消息折叠起来
+history_view.draw(st.session_state["history"], names={"assistant": st.session_state["meta"]["bot_name"],
+                                                      "user": st.session_state["meta"]["user_name"]})
 
 
 if gen_picture:
@@ -227,10 +227,11 @@ with st.chat_message(name="assistant", avatar="assistant"):
 
 
 def output_stream_response(response_stream: Iterator[str], placeholder):
-    content = ""
-    for content in itertools.accumulate(response_stream):
-        placeholder.markdown(content)
-    return content
+    renderer = render_stream(response_stream, placeholder)
+    if debug:
+        print(f"output_stream_response. chunks = {renderer.chunk_count}, renders = {renderer.render_count}, "
+              f"bytes_pushed = {renderer.bytes_pushed}")
+    return renderer.text
 
 
 def start_chat():
@@ -246,7 +247,14 @@ def start_chat():
         input_placeholder.markdown(query)
         st.session_state["history"].append(TextMsg({"role": "user", "content": query}))
         
-        response_stream = get_characterglm_response(filter_text_msg(st.session_state["history"]), meta=st.session_state["meta"])
+        meta = st.session_state["meta"]
+        # 按token预算裁剪/概括对话历史
+        context = context_window.build(filter_text_msg(st.session_state["history"]),
+                                       (meta["bot_name"], meta["user_name"]))
+        if debug:
+            print(f"start_chat. tokens = {context.original_tokens} -> {context.tokens}, "
+                  f"payload_bytes = {context.payload_bytes}")
+        response_stream = get_characterglm_response(context.messages, meta=meta)
         bot_response = output_stream_response(response_stream, message_placeholder)
         if not bot_response:
             message_placeholder.markdown("生成出错")
@@ -15,8 +15,8 @@ streamlit run characterglm_api_demo_streamlit.py
 """
 import json
 import os
-import itertools
-from typing import Iterator, Optional
+import uuid
+from typing import Dict, Iterator, List, Optional
 
 import streamlit as st
 from dotenv import load_dotenv
@@ -26,12 +26,28 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import api
-from api import generate_chat_scene_prompt, generate_role_appearance, get_characterglm_response, \
-    generate_cogview_image, generate_role_info
+from api import get_characterglm_response, generate_role_info
 from data_types import TextMsg, ImageMsg, TextMsgList, MsgList, filter_text_msg
+from message_store import MessageStore
+from image_cache import image_cache
+from image_pipeline import image_pipeline
+from history_view import history_view
+from speculative import history_fingerprint, speculator
+from context_window import context_window, summary_store
+from stream_render import render_stream
+from autochat_engine import get_session_meta, make_meta
+from dialogue_store import DialogueWriter, is_jsonl_path, iter_dialogues, segment_paths, get_compression
+from dialogue_index import open_archive
+from instrumentation import metrics
+from response_cache import response_cache
+from scheduler import scheduler
 
 st.set_page_config(page_title="CharacterGLM API Demo", page_icon="🤖", layout="wide")
 debug = os.getenv("DEBUG", "yes").lower() in ("1", "yes", "y", "true", "t", "on")
+# 有图片在后台生成时，单独刷新进度的间隔（秒）
+IMAGE_POLL_INTERVAL = 0.5
+# 侧边栏性能面板开启自动刷新时的刷新间隔（秒）
+PERF_REFRESH_INTERVAL = float(os.getenv("PERF_REFRESH_INTERVAL", "2"))
 
 
 class Tools(object):
@@ -41,22 +57,84 @@ class Tools(object):
             print(f'update_api_key. st.session_state["API_KEY"] = {st.session_state["API_KEY"]}, key = {key}')
         key = key or st.session_state["API_KEY"]
         if key:
-            api.API_KEY = key
+            api.set_api_key(key)
+
+    @staticmethod
+    def bind_metrics_session():
+        """ 之后的api调用计入本会话的性能统计；回调与脚本可能不在同一个线程，每次调用前都要绑定 """
+        metrics.bind_session(st.session_state.get("session_id"))
 
     @staticmethod
     def output_stream_response(response_stream: Iterator[str], placeholder):
-        content = ""
-        for content in itertools.accumulate(response_stream):
-            placeholder.markdown(content)
-        return content
+        renderer = render_stream(response_stream, placeholder)
+        if debug:
+            print(f"output_stream_response. chunks = {renderer.chunk_count}, renders = {renderer.render_count}, "
+                  f"bytes_pushed = {renderer.bytes_pushed}")
+        return renderer.text
+
+    @staticmethod
+    def get_reply_stream(messages: TextMsgList, reverse: bool) -> Iterator[str]:
+        """
+        获取角色的回复，有对应的预生成结果时直接取用
+        :param messages: 对话历史
+        :param reverse: False时由角色A回复，True时由角色B回复
+        :return:
+        """
+        Tools.bind_metrics_session()
+        meta = get_session_meta(st.session_state["meta"], reverse)
+        speculation = st.session_state.pop("speculation", None)
+        if speculation is not None:
+            if speculation.key == history_fingerprint(messages, meta) and not speculation.failed:
+                if debug:
+                    print(f"get_reply_stream. speculation hit, chunks = {len(speculation.chunks)}")
+                return speculation.stream()
+            speculation.cancel()
+        return get_characterglm_response(Tools.build_context(messages), meta=meta)
+
+    @staticmethod
+    def build_context(messages: TextMsgList) -> TextMsgList:
+        """ 按token预算裁剪/概括对话历史 """
+        meta = st.session_state["meta"]
+        # autochat中角色A的回复记为assistant，角色B的回复记为user
+        context = context_window.build(messages, (meta["bot_a_name"], meta["bot_b_name"]))
+        if debug:
+            print(f"build_context. messages = {len(messages)} -> {len(context.messages)}, "
+                  f"tokens = {context.original_tokens} -> {context.tokens}, payload_bytes = {context.payload_bytes}, "
+                  f"summarized = {context.summarized}, dropped = {context.dropped}")
+        return context.messages
+
+
+    @staticmethod
+    def put_image(history: MsgList, previous: Optional[ImageMsg], img_msg: ImageMsg):
+        """
+        若history的末尾有同一角色上次生成的图片previous，则替换它（重新生成），否则append（新增）
+        按图片url和说明比较：history_view画出图片后会把消息换成带local_image的新对象，不能比较对象本身
+        """
+        tail = len(history)
+        while tail and history[tail - 1]["role"] == "image":
+            tail -= 1
+        if previous is not None:
+            for i in range(tail, len(history)):
+                if history[i]["image"] == previous["image"] and history[i].get("caption") == previous.get("caption"):
+                    del history[i]
+                    break
+        history.append(img_msg)
 
 
 class SessionHelper(object):
     @staticmethod
     def init_session_state():
         # 初始化
+        if "session_id" not in st.session_state:
+            # 性能面板中按会话统计
+            st.session_state["session_id"] = uuid.uuid4().hex
         if "history" not in st.session_state:
-            st.session_state["history"] = []
+            st.session_state["history"] = MessageStore()
+        if "image_jobs" not in st.session_state:
+            # 角色("a"/"b") -> 正在后台生成的图片
+            st.session_state["image_jobs"] = {}
+            # 角色 -> 最近一次生成的图片消息
+            st.session_state["image_msgs"] = {}
         if "meta" not in st.session_state:
             st.session_state["meta"] = {
                 # 角色a
@@ -77,13 +155,13 @@ class SessionHelper(object):
             st.error("请填写角色A人设来源素材")
             return
 
+        Tools.bind_metrics_session()
         role_json = generate_role_info(st.session_state["meta"]["bot_a_source"])
         role_info = json.loads(role_json)
         st.session_state["meta"]["bot_a_name"] = role_info["name"]
         st.session_state["meta"]["bot_a_info"] = role_info["info"]
         st.session_state["bot_a_name"] = role_info["name"]
         st.session_state["bot_a_info"] = role_info["info"]
-        st.rerun()
 
     @staticmethod
     def gen_bot_b_role():
@@ -91,6 +169,7 @@ class SessionHelper(object):
             st.error("请填写角色B人设来源素材2344")
             return
 
+        Tools.bind_metrics_session()
         try:
             role_json = generate_role_info(st.session_state["meta"]["bot_b_source"])
             role_info = json.loads(role_json)
@@ -98,14 +177,12 @@ class SessionHelper(object):
             st.session_state["meta"]["bot_b_info"] = role_info["info"]
             st.session_state["bot_b_name"] = role_info["name"]
             st.session_state["bot_b_info"] = role_info["info"]
-            # 指定
-            st.rerun()
         except Exception as e:
             st.error(f"生成角色B人设失败: {e}")
 
     @staticmethod
     def init_session_history():
-        st.session_state["history"] = []
+        st.session_state["history"] = MessageStore()
 
     @staticmethod
     def verify_meta() -> bool:
@@ -140,7 +217,6 @@ class SessionHelper(object):
             "bot_b_info": "",
             "bot_b_image_style": "",
         }
-        st.rerun()
 
     @staticmethod
     def clean_history():
@@ -148,8 +224,42 @@ class SessionHelper(object):
         清空对话历史
         :return:
         """
-        st.session_state["history"] = []
-        st.rerun()
+        st.session_state["history"] = MessageStore()
+        # 之后保存到jsonl数据集时作为一个新对话
+        st.session_state["dialogue_id"] = None
+        # 未完成的图片不再加入新的对话
+        st.session_state["image_jobs"] = {}
+
+    @staticmethod
+    def update_speculation():
+        """
+        开启预生成时，在后台提前生成下一位角色的回复：上一条是角色A的回复时预生成角色B，否则预生成角色A
+        对话历史或人设变化后，旧的预生成被丢弃
+        """
+        speculation = st.session_state.get("speculation")
+        meta = st.session_state["meta"]
+        text_messages = filter_text_msg(st.session_state["history"])
+        if not st.session_state.get("speculative") or not text_messages or not api.API_KEY or \
+                not all(meta[key] for key in ("bot_a_name", "bot_a_info", "bot_b_name", "bot_b_info")):
+            if speculation is not None:
+                speculation.cancel()
+                del st.session_state["speculation"]
+            return
+        session_meta = get_session_meta(meta, reserve=text_messages[-1]["role"] == "assistant")
+        if speculation is not None:
+            if speculation.key == history_fingerprint(text_messages, session_meta):
+                return
+            speculation.cancel()
+        st.session_state["speculation"] = speculator.start(Tools.build_context(text_messages), session_meta,
+                                                           key=history_fingerprint(text_messages, session_meta))
+
+    @staticmethod
+    def mark_saved(file_path, dialogue_id):
+        """ 记录已保存到jsonl数据集的内容，下次保存只追加变化部分 """
+        st.session_state["dialogue_path"] = file_path
+        st.session_state["dialogue_id"] = dialogue_id
+        st.session_state["saved_meta"] = make_meta(get_meta())
+        st.session_state["saved_history"] = st.session_state["history"].copy()
 
     @staticmethod
     def show_api_key():
@@ -227,6 +337,36 @@ class ViewDrawer(object):
                               on_change=lambda: st.session_state["meta"].update(
                                   meta_path=st.session_state["meta_path"]),
                               help="对话历史文件路径")
+                ViewDrawer.draw_dialogue_select()
+
+    @staticmethod
+    def draw_dialogue_select():
+        """
+        路径为jsonl数据集时，分页列出其中的对话供选择加载
+        通过索引只读取当前页对话的人设，不加载整个文件
+        :return:
+        """
+        file_path = st.session_state.get("meta_path", "")
+        if not is_jsonl_path(file_path) or get_compression(file_path) or not segment_paths(file_path):
+            return
+        archive = open_archive(file_path)
+        # 最新的对话排在前面
+        ids = archive.ids()[::-1]
+        if not ids:
+            return
+
+        page_size = 50
+        n_page = (len(ids) + page_size - 1) // page_size
+        page = st.number_input(label=f"对话列表页码（共{len(ids)}个对话）", min_value=1, max_value=n_page, value=1,
+                               key="dialogue_page")
+        page_ids = ids[(page - 1) * page_size: page * page_size]
+        labels = {}
+        for dialogue_id in page_ids:
+            meta = archive.get_meta(dialogue_id)
+            labels[dialogue_id] = f'{meta.get("bot_a_name", "")} & {meta.get("bot_b_name", "")}' \
+                                  f'（{archive.num_turns(dialogue_id)}条）{dialogue_id[:8]}'
+        st.selectbox(label="选择对话", options=page_ids, key="dialogue_select", format_func=labels.get,
+                     help="点击加载记录时加载选中的对话")
 
     @staticmethod
     def draw_help_buttons():
@@ -309,19 +449,10 @@ class ViewDrawer(object):
 
     @staticmethod
     def draw_history():
-        # 展示对话历史
-        for msg in st.session_state["history"]:
-            if msg["role"] == "user":
-                with st.chat_message(name="user", avatar="user"):
-                    st.markdown(msg["content"])
-            elif msg["role"] == "assistant":
-                with st.chat_message(name="assistant", avatar="assistant"):
-                    st.markdown(msg["content"])
-            elif msg["role"] == "image":
-                with st.chat_message(name="assistant", avatar="assistant"):
-                    st.image(msg["image"], caption=msg.get("caption", None))
-            else:
-                raise Exception("Invalid role")
+        # 展示对话历史，较早的消息折叠起来
+        meta = st.session_state["meta"]
+        history_view.draw(st.session_state["history"], names={"assistant": meta["bot_a_name"],
+                                                              "user": meta["bot_b_name"]})
 
     @staticmethod
     def draw_empty_chat_message():
@@ -338,51 +469,134 @@ class ViewDrawer(object):
         return query
 
     @staticmethod
-    def draw_new_image():
-        """生成一张图片，并展示在页面上"""
+    def start_new_image(character: str):
+        """
+        在后台开始生成一张角色图片，不阻塞页面
+        :param character: "a"或"b"
+        :return:
+        """
         if not SessionHelper.verify_meta():
             return
-        text_messages = filter_text_msg(st.session_state["history"])
-        if text_messages:
-            # 若有对话历史，则结合角色人设和对话历史生成图片
-            image_prompt = "".join(
-                generate_chat_scene_prompt(
-                    text_messages[-10:],
-                    meta=st.session_state["meta"]
-                )
-            )
-        else:
-            # 若没有对话历史，则根据角色人设生成图片
-            image_prompt = "".join(generate_role_appearance(st.session_state["meta"]["bot_info"]))
-
-        if not image_prompt:
-            st.error("调用chatglm生成Cogview prompt出错")
+        jobs = st.session_state["image_jobs"]
+        if character in jobs and not jobs[character].done:
+            # 上一张还在生成中
             return
+        meta = st.session_state["meta"]
+        jobs[character] = image_pipeline.submit(
+            character,
+            filter_text_msg(st.session_state["history"]),
+            get_session_meta(meta, reserve=character == "b"),
+            meta.get(f"bot_{character}_image_style", ""),
+            names=(meta["bot_a_name"], meta["bot_b_name"]),
+        )
+
+    @staticmethod
+    def collect_new_images() -> List[str]:
+        """
+        把已完成的图片加入对话历史，取出出错的任务
+        :return: 出错信息
+        """
+        errors = []
+        jobs = st.session_state["image_jobs"]
+        for character, job in list(jobs.items()):
+            if job.status == "error":
+                del jobs[character]
+                errors.append(f'{st.session_state["meta"][f"bot_{character}_name"]}的图片：{job.error}')
+                continue
+            if job.status != "done":
+                continue
+            del jobs[character]
+            img_msg = ImageMsg({"role": "image", "image": job.image_url, "caption": job.prompt})
+            Tools.put_image(st.session_state["history"], st.session_state["image_msgs"].get(character), img_msg)
+            st.session_state["image_msgs"][character] = img_msg
+        return errors
+
+    @staticmethod
+    def draw_image_jobs(errors: List[str]):
+        """
+        展示出错的任务和正在生成的图片的进度
+        有未完成的任务时，进度放在fragment里每IMAGE_POLL_INTERVAL秒单独刷新，不rerun整个页面
+        """
+        for error in errors:
+            st.error(error)
+        if st.session_state["image_jobs"]:
+            st.fragment(run_every=IMAGE_POLL_INTERVAL)(ViewDrawer.draw_image_progress)()
 
-        image_style = st.session_state["meta"].get("image_style", "二次元风格")
-        image_prompt = f'生成风格: {image_style}。' + image_prompt.strip()
-
-        print(f"image_prompt = {image_prompt}")
-        n_retry = 3
-        st.markdown("正在生成图片，请稍等...")
-        for i in range(n_retry):
-            try:
-                img_url = generate_cogview_image(image_prompt)
-            except Exception as e:
-                if i < n_retry - 1:
-                    st.error("遇到了一点小问题，重试中...")
+    @staticmethod
+    def draw_image_progress():
+        """ 有任务完成或出错时才rerun整个页面，把图片加入对话历史 """
+        jobs = st.session_state["image_jobs"]
+        if any(job.done for job in jobs.values()):
+            st.rerun()
+        for character, job in jobs.items():
+            name = st.session_state["meta"][f"bot_{character}_name"]
+            with st.chat_message(name="assistant", avatar="assistant"):
+                if job.status == "image":
+                    st.markdown(f"正在生成{name}的图片，请稍等...\n\n{job.prompt}")
                 else:
-                    st.error("又失败啦，点击【生成图片】按钮可再次重试")
-                    return
-            else:
-                break
-        img_msg = ImageMsg({"role": "image", "image": img_url, "caption": image_prompt})
-        # 若history的末尾有图片消息，则替换它，（重新生成）
-        # 否则，append（新增）
-        while st.session_state["history"] and st.session_state["history"][-1]["role"] == "image":
-            st.session_state["history"].pop()
-        st.session_state["history"].append(img_msg)
-        st.rerun()
+                    st.markdown(f"正在构思{name}的图片...\n\n{job.prompt}")
+
+    @staticmethod
+    def draw_model_stats(models: Dict[str, Dict]):
+        if not models:
+            st.caption("暂无调用")
+            return
+        st.table([{
+            "模型": model,
+            "调用": stats["calls"],
+            "进行中": stats["in_flight"],
+            "错误": stats["errors"],
+            "TTFT p50/p95/p99 (ms)": f'{stats["ttft_p50"] * 1000:.0f} / {stats["ttft_p95"] * 1000:.0f} / '
+                                     f'{stats["ttft_p99"] * 1000:.0f}',
+            "tokens/s": f'{stats["tokens_per_second"]:.1f}',
+        } for model, stats in sorted(models.items())])
+
+    @staticmethod
+    def draw_performance_panel():
+        """
+        侧边栏的性能面板：本会话/全局的首token延迟、tokens/s、进行中的调用，缓存命中率，各模型的排队情况
+        数据来自instrumentation.metrics和各模块的stats()，放在fragment里，刷新时只重画面板，
+        不rerun整个页面（也就不会因为刷新产生额外的调用，影响统计）
+        """
+        with st.sidebar.expander("性能", expanded=False):
+            # 勾选框放在fragment外，切换时rerun整个页面，按新的设置创建fragment
+            autorefresh = st.checkbox("自动刷新", key="perf_autorefresh",
+                                      help=f"每{PERF_REFRESH_INTERVAL:g}秒刷新一次")
+            st.fragment(run_every=PERF_REFRESH_INTERVAL if autorefresh else None)(ViewDrawer.draw_performance_stats)()
+
+    @staticmethod
+    def draw_performance_stats():
+        if not st.session_state.get("perf_autorefresh"):
+            # 点击只重画面板
+            st.button("刷新", key="perf_refresh")
+        st.markdown("**本会话**")
+        ViewDrawer.draw_model_stats(metrics.live(st.session_state["session_id"]))
+        st.markdown("**全局**")
+        ViewDrawer.draw_model_stats(metrics.live())
+
+        st.markdown("**排队**")
+        st.table([{
+            "模型": model,
+            "排队": stats["queue_depth"],
+            "进行中/上限": f'{stats["in_flight"]}/{stats["max_concurrency"]}',
+            "平均等待 (ms)": f'{stats["wait_seconds_avg"] * 1000:.0f}',
+        } for model, stats in sorted(scheduler.stats().items())])
+
+        st.markdown("**缓存命中率**")
+        image_stats = image_cache.stats()
+        image_hits = image_stats["memory_hits"] + image_stats["disk_hits"]
+        image_lookups = image_hits + image_stats["misses"]
+        caches = {
+            "人设/场景描写": response_cache.stats()["hit_ratio"],
+            "对话概要": summary_store.stats()["hit_ratio"],
+            "图片": image_hits / image_lookups if image_lookups else 0.0,
+        }
+        st.table([{"缓存": name, "命中率": f"{ratio:.0%}"} for name, ratio in caches.items()])
+
+        if debug:
+            st.markdown("**调试**")
+            st.caption(f'对话历史{len(st.session_state["history"])}条，会话{st.session_state["session_id"][:8]}')
+            st.json(st.session_state["meta"], expanded=False)
 
 
 def init_session():
@@ -390,9 +604,12 @@ def init_session():
     api_key = st.sidebar.text_input("API_KEY", value=os.getenv("API_KEY", ""), key="API_KEY", type="password",
                                     on_change=Tools.update_api_key)
     Tools.update_api_key(api_key)
+    st.sidebar.checkbox("预生成下一轮回复", key="speculative",
+                        help="一轮回复完成后，在后台提前生成下一位角色的回复，点击时直接展示（会额外消耗调用次数）")
 
     # 初始化
     SessionHelper.init_session_state()
+    Tools.bind_metrics_session()
 
     # print(st.session_state)
 
@@ -410,23 +627,6 @@ def init_drawer_history():
     ViewDrawer.draw_history()
 
 
-def get_session_meta(meta, reserve=False):
-    if reserve:
-        return {
-            "bot_name": meta["bot_b_name"],
-            "bot_info": meta["bot_b_info"],
-            "user_name": meta["bot_a_name"],
-            "user_info": meta["bot_a_info"],
-        }
-    else:
-        return {
-            "bot_name": meta["bot_a_name"],
-            "bot_info": meta["bot_a_info"],
-            "user_name": meta["bot_b_name"],
-            "user_info": meta["bot_b_info"],
-        }
-
-
 def get_meta():
     return {
         "bot_a_source": st.session_state["bot_a_source"],
@@ -437,43 +637,85 @@ def get_meta():
         "bot_b_name": st.session_state["bot_b_name"],
         "bot_b_info": st.session_state["bot_b_info"],
         "bot_b_image_style": st.session_state["bot_b_image_style"],
-        "history": st.session_state["history"],
+        "history": st.session_state["history"].to_list(),
+    }
+
+
+def set_session_meta(meta):
+    """ 用加载的对话设置人设和对话历史 """
+    st.session_state["bot_a_source"] = meta["bot_a_source"]
+    st.session_state["bot_a_name"] = meta["bot_a_name"]
+    st.session_state["bot_a_info"] = meta["bot_a_info"]
+    st.session_state["bot_a_image_style"] = meta["bot_a_image_style"]
+    st.session_state["bot_b_source"] = meta["bot_b_source"]
+    st.session_state["bot_b_name"] = meta["bot_b_name"]
+    st.session_state["bot_b_info"] = meta["bot_b_info"]
+    st.session_state["bot_b_image_style"] = meta["bot_b_image_style"]
+    st.session_state["history"] = MessageStore(meta["history"])
+    # 设置meta
+    st.session_state["meta"] = {
+        "bot_a_source": meta["bot_a_source"],
+        "bot_a_name": meta["bot_a_name"],
+        "bot_a_info": meta["bot_a_info"],
+        "bot_a_image_style": meta["bot_a_image_style"],
+        "bot_b_source": meta["bot_b_source"],
+        "bot_b_name": meta["bot_b_name"],
+        "bot_b_info": meta["bot_b_info"],
+        "bot_b_image_style": meta["bot_b_image_style"],
     }
+    # 之前概括过的对话直接复用保存的概要，没有的在后台开始概括，不必等到下一轮
+    context_window.warm(filter_text_msg(st.session_state["history"]), (meta["bot_a_name"], meta["bot_b_name"]))
 
 
 def load_meta():
     file_path = st.session_state["meta_path"]
+    if is_jsonl_path(file_path):
+        load_dialogue(file_path)
+        return
+
     if not os.path.exists(file_path):
         st.error("文件不存在")
         return
 
     with open(file_path, "r") as f:
         meta = json.load(f)
-        st.session_state["bot_a_source"] = meta["bot_a_source"]
-        st.session_state["bot_a_name"] = meta["bot_a_name"]
-        st.session_state["bot_a_info"] = meta["bot_a_info"]
-        st.session_state["bot_a_image_style"] = meta["bot_a_image_style"]
-        st.session_state["bot_b_source"] = meta["bot_b_source"]
-        st.session_state["bot_b_name"] = meta["bot_b_name"]
-        st.session_state["bot_b_info"] = meta["bot_b_info"]
-        st.session_state["bot_b_image_style"] = meta["bot_b_image_style"]
-        st.session_state["history"] = meta["history"]
-        # 设置meta
-        st.session_state["meta"] = {
-            "bot_a_source": meta["bot_a_source"],
-            "bot_a_name": meta["bot_a_name"],
-            "bot_a_info": meta["bot_a_info"],
-            "bot_a_image_style": meta["bot_a_image_style"],
-            "bot_b_source": meta["bot_b_source"],
-            "bot_b_name": meta["bot_b_name"],
-            "bot_b_info": meta["bot_b_info"],
-            "bot_b_image_style": meta["bot_b_image_style"],
-        }
-        st.rerun()
+        set_session_meta(meta)
+
+
+def load_dialogue(file_path):
+    """ 从jsonl数据集加载选中的对话（默认最后一个），之后保存时继续追加到这个对话 """
+    if not segment_paths(file_path):
+        st.error("文件不存在")
+        return
+
+    dialogue_id, meta = None, None
+    if get_compression(file_path):
+        # 压缩文件只能顺序读取
+        for dialogue_id, meta in iter_dialogues(file_path, include_incomplete=True):
+            pass
+    else:
+        archive = open_archive(file_path)
+        ids = archive.ids()
+        dialogue_id = st.session_state.get("dialogue_select")
+        if dialogue_id not in archive:
+            dialogue_id = ids[-1] if ids else None
+        if dialogue_id is not None:
+            meta = archive.get(dialogue_id)
+    if meta is None:
+        st.error("文件中没有对话")
+        return
+
+    set_session_meta(meta)
+    SessionHelper.mark_saved(file_path, dialogue_id)
 
 
 def save_meta():
     file_path = st.session_state["meta_path"]
+    if is_jsonl_path(file_path):
+        save_dialogue(file_path)
+        st.success("保存成功")
+        return
+
     print("xxxxxxxxxxxx")
     ret = get_meta()
     print(json.dumps(ret))
@@ -485,6 +727,35 @@ def save_meta():
 
     st.success("保存成功")
 
+
+def save_dialogue(file_path):
+    """
+    追加保存到jsonl数据集
+    只写入上次保存之后新增或被替换的消息，不重写整个对话
+    :param file_path:
+    :return:
+    """
+    meta = make_meta(get_meta())
+    history = st.session_state["history"]
+    saved = st.session_state.get("saved_history", [])
+    dialogue_id = st.session_state.get("dialogue_id")
+    with DialogueWriter(file_path) as writer:
+        if dialogue_id is None or st.session_state.get("dialogue_path") != file_path:
+            dialogue_id = writer.begin_dialogue(meta)
+            saved = []
+        elif meta != st.session_state.get("saved_meta"):
+            # 人设有改动，重新写入对话头
+            writer.begin_dialogue(meta, dialogue_id)
+
+        if len(history) < len(saved):
+            writer.truncate(dialogue_id, len(history))
+        for i, msg in enumerate(history):
+            # 文本消息每次读取都是新构造的dict，按内容比较；图片消息仍是同一对象，比较时直接命中
+            if i >= len(saved) or saved[i] != msg:
+                writer.write_turn(dialogue_id, i, msg)
+    SessionHelper.mark_saved(file_path, dialogue_id)
+
+
 def deal_talk(reverse=False):
     input_placeholder, message_placeholder = ViewDrawer.draw_empty_chat_message()
     if not SessionHelper.verify_meta():
@@ -498,8 +769,7 @@ def deal_talk(reverse=False):
         return
 
     # 获取回复
-    response_stream = get_characterglm_response(filter_text_msg(st.session_state["history"]),
-                                                meta=get_session_meta(st.session_state["meta"], reverse))
+    response_stream = Tools.get_reply_stream(filter_text_msg(st.session_state["history"]), reverse)
 
     bot_response = Tools.output_stream_response(response_stream, message_placeholder)
 
@@ -531,8 +801,7 @@ def init_draw_user_input():
         print(st.session_state["history"])
 
         # 获取回复
-        response_stream = get_characterglm_response(filter_text_msg(st.session_state["history"]),
-                                                    meta=get_session_meta(st.session_state["meta"]))
+        response_stream = Tools.get_reply_stream(filter_text_msg(st.session_state["history"]), False)
 
         bot_response = Tools.output_stream_response(response_stream, message_placeholder)
 
@@ -550,19 +819,29 @@ def main():
     # 绘制设定框
     gen_a_picture, gen_b_picture = init_drawer_setting()
 
-    # 绘制历史
-    init_drawer_history()
-
-    # 绘制新图片, 以防卡主放历史后面
+    # 图片在后台生成，A、B可以同时进行
     if gen_a_picture:
-        ViewDrawer.draw_new_image()
+        ViewDrawer.start_new_image("a")
 
     if gen_b_picture:
-        ViewDrawer.draw_new_image()
+        ViewDrawer.start_new_image("b")
+    image_errors = ViewDrawer.collect_new_images()
+
+    # 绘制历史
+    init_drawer_history()
+
+    # 绘制图片生成进度
+    ViewDrawer.draw_image_jobs(image_errors)
 
     # 绘制用户输入框
     init_draw_user_input()
 
+    # 预生成下一轮回复
+    SessionHelper.update_speculation()
+
+    # 性能面板，放在最后以包含本次rerun中的调用
+    ViewDrawer.draw_performance_panel()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,332 @@
+"""
+命令行入口：从人设素材批量生成角色人设和对话，不依赖streamlit，可用于定时任务和批量生成
+
+人设素材为markdown（或txt）文件，每个文件是一个角色的来源素材（同界面中的"人设来源素材"），
+传入目录时读取其中所有的.md文件。用chatglm从素材生成角色名和人设（同界面中的"生成角色人设"），
+生成的人设按素材内容的哈希保存在人设文件中，再次运行时直接复用，也可以手动修改后再生成对话。
+
+对话任务为素材两两配对（--pairing）与开场话题（--topic）的组合，角色A、角色B交替回复，每人--rounds次。
+任务记录在任务库（job_store.py，默认放在输出旁边）中，任务id为两个角色的人设、话题和轮数的哈希，
+相同的任务只生成一次；每生成一条消息写入一次检查点。进程崩溃或被杀后加--resume重新运行，
+跳过已完成的对话，中断的对话从检查点继续生成，已生成的消息不会重新请求。
+
+输出格式：
+- jsonl: 逐条消息追加写入dialogue_store.py格式的数据集（.jsonl/.jsonl.gz/.jsonl.zst），界面中可直接加载
+- json: 每个对话完成后保存为目录下的一个json文件，格式同history.json
+
+运行方式（仓库根目录，API_KEY通过环境变量或.env文件设置）：
+```bash
+python cli.py roles personas/ -o personas.json
+python cli.py dialogues personas/ --topic "好久不见，最近在忙什么？" --rounds 5 --concurrency 20 -o output/dialogues.jsonl
+python cli.py dialogues personas/ --topic "好久不见，最近在忙什么？" --rounds 5 -o output/dialogues.jsonl --resume
+```
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("cli")
+
+# 人设素材的文件类型
+SOURCE_SUFFIXES = (".md", ".markdown", ".txt")
+
+
+def content_hash(*parts: str) -> str:
+    return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+
+
+def read_sources(paths: List[str]) -> List[Tuple[str, str]]:
+    """
+    读取人设素材，目录按文件名排序读取其中的素材文件
+    :return: [(文件路径, 素材内容)]
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.endswith(SOURCE_SUFFIXES))
+        else:
+            files.append(path)
+    sources = []
+    for file_path in files:
+        with open(file_path, encoding="utf-8") as f:
+            text = f.read().strip()
+        if text:
+            sources.append((file_path, text))
+        else:
+            logger.warning("跳过空的人设素材: %s", file_path)
+    return sources
+
+
+def load_personas(file_path: str) -> Dict[str, Dict]:
+    """ 素材内容的哈希 -> {"path": ..., "name": ..., "info": ...} """
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_personas(personas: Dict[str, Dict], file_path: str):
+    """ 先写临时文件再替换，中途被杀时不会留下半个文件 """
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(personas, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, file_path)
+
+
+async def generate_personas(sources: List[Tuple[str, str]], personas: Dict[str, Dict],
+                            concurrency: int) -> Dict[str, Dict]:
+    """
+    为还没有人设的素材生成人设，结果合并进personas
+    :return: 本次新生成的人设
+    """
+    import asyncio
+
+    import async_api
+
+    semaphore = asyncio.Semaphore(concurrency)
+    generated: Dict[str, Dict] = {}
+
+    async def worker(path: str, text: str):
+        key = content_hash(text)
+        async with semaphore:
+            try:
+                role_info = json.loads(await async_api.generate_role_info(text))
+                persona = {"path": path, "name": role_info["name"], "info": role_info["info"]}
+            except Exception as e:
+                # aiohttp的异常里带着请求头（含鉴权token），只记录类型
+                logger.warning("生成人设失败: %s %s", path, type(e).__name__)
+                return
+        generated[key] = personas[key] = persona
+        logger.info("生成人设: %s -> %s", path, persona["name"])
+
+    pending = {content_hash(text): (path, text) for path, text in sources if content_hash(text) not in personas}
+    await asyncio.gather(*(worker(path, text) for path, text in pending.values()))
+    return generated
+
+
+def make_jobs(sources: List[Tuple[str, str]], personas: Dict[str, Dict], topics: List[str],
+              pairing: str, rounds: int) -> List[Tuple[str, Dict]]:
+    """
+    素材配对与话题组合成对话任务，跳过没有人设的素材，相同的任务只保留一个
+    :return: [(任务id, AutoChatJob)]
+    """
+    from job_store import job_key
+
+    if pairing == "all":
+        pairs = itertools.combinations(sources, 2)
+    else:
+        pairs = zip(sources[0::2], sources[1::2])
+    jobs: Dict[str, Dict] = {}
+    for (path_a, text_a), (path_b, text_b) in pairs:
+        persona_a, persona_b = personas.get(content_hash(text_a)), personas.get(content_hash(text_b))
+        if persona_a is None or persona_b is None:
+            logger.warning("缺少人设，跳过: %s & %s", path_a, path_b)
+            continue
+        for topic in topics:
+            job = {
+                "bot_a_source": text_a, "bot_a_name": persona_a["name"], "bot_a_info": persona_a["info"],
+                "bot_b_source": text_b, "bot_b_name": persona_b["name"], "bot_b_info": persona_b["info"],
+                "topic": topic,
+            }
+            jobs.setdefault(job_key(job, rounds), job)
+    return list(jobs.items())
+
+
+def default_sidecar_path(output: str, output_format: str, name: str) -> str:
+    """ 人设文件、任务库的默认路径：dialogues.jsonl -> dialogues.personas.json，json格式时放在输出目录下 """
+    if output_format == "json":
+        return os.path.join(output, name)
+    for suffix in (".jsonl.gz", ".jsonl.zst", ".jsonl"):
+        if output.endswith(suffix):
+            output = output[:-len(suffix)]
+            break
+    return f"{output}.{name}"
+
+
+def init_api():
+    from dotenv import load_dotenv
+
+    # 通过.env文件设置环境变量
+    load_dotenv()
+    import api
+    api.set_api_key(os.getenv("API_KEY", ""))
+    if not api.API_KEY:
+        sys.exit("未设置API_KEY（环境变量或.env文件）")
+
+
+def cmd_roles(args: argparse.Namespace) -> int:
+    import asyncio
+
+    import async_api
+
+    init_api()
+    sources = read_sources(args.sources)
+    personas = load_personas(args.output)
+
+    async def main():
+        try:
+            return await generate_personas(sources, personas, args.concurrency)
+        finally:
+            await async_api.close_session()
+
+    generated = asyncio.run(main())
+    save_personas(personas, args.output)
+    missing = sum(content_hash(text) not in personas for _, text in sources)
+    print(f"{len(sources)} sources, {len(generated)} generated, {missing} failed -> {args.output}")
+    return 1 if missing else 0
+
+
+def cmd_dialogues(args: argparse.Namespace) -> int:
+    topics = list(args.topic or [])
+    if args.topics_file:
+        with open(args.topics_file, encoding="utf-8") as f:
+            topics.extend(line.strip() for line in f if line.strip())
+    if not topics:
+        print("至少需要一个开场话题（--topic或--topics-file）", file=sys.stderr)
+        return 2
+
+    import asyncio
+
+    import async_api
+    from autochat_engine import make_dialogue, run_batch, save_dialogue
+    from dialogue_store import DialogueWriter, is_jsonl_path, load_progress, segment_paths
+    from job_store import DONE, JobStore
+
+    if args.format == "jsonl" and not is_jsonl_path(args.output):
+        print(f"jsonl格式的输出路径需要以.jsonl/.jsonl.gz/.jsonl.zst结尾: {args.output}", file=sys.stderr)
+        return 2
+    job_store_path = args.job_store or default_sidecar_path(args.output, args.format, "jobs.sqlite3")
+    if args.format == "jsonl":
+        exists = bool(segment_paths(args.output))
+    else:
+        exists = os.path.isdir(args.output) and any(name.startswith("dialogue_") for name in os.listdir(args.output))
+    if (exists or os.path.exists(job_store_path)) and not args.resume:
+        print(f"{args.output}或任务库{job_store_path}已存在，使用--resume续写，或换一个输出路径", file=sys.stderr)
+        return 2
+
+    init_api()
+    sources = read_sources(args.sources)
+    personas_path = args.personas or default_sidecar_path(args.output, args.format, "personas.json")
+    personas = load_personas(personas_path)
+
+    # 输出中已完成的对话id，用于和任务库对账
+    written = set()
+    if exists:
+        if args.format == "jsonl":
+            written = load_progress(args.output)[0]
+        else:
+            written = {name[len("dialogue_"):-len(".json")] for name in os.listdir(args.output)
+                       if name.startswith("dialogue_") and name.endswith(".json")}
+
+    def export(job_id: str):
+        """ 任务库中已完成、输出中没有的对话（写入输出前进程被杀），从任务库补写 """
+        job, _, history = job_store.load(job_id)
+        dialogue = make_dialogue(job, history)
+        if store is not None:
+            store.write_dialogue(dialogue, job_id)
+        else:
+            save_dialogue(dialogue, os.path.join(args.output, f"dialogue_{job_id}.json"))
+
+    async def main():
+        try:
+            if await generate_personas(sources, personas, args.concurrency):
+                save_personas(personas, personas_path)
+            all_jobs = make_jobs(sources, personas, topics, args.pairing, args.rounds)
+            for job_id, job in all_jobs:
+                job_store.add(job, args.rounds)
+                if job_id in written and job_store.status(job_id) != DONE:
+                    # 输出中已完成，结束任务前进程被杀
+                    job_store.finish(job_id)
+            done = job_store.job_ids(DONE)
+            exported = [job_id for job_id, _ in all_jobs if job_id in done and job_id not in written]
+            for job_id in exported:
+                export(job_id)
+            jobs = [(job_id, job) for job_id, job in all_jobs if job_id not in done]
+            print(f"{len(sources)} sources, {len(jobs)} dialogues to generate "
+                  f"({len(all_jobs) - len(jobs)} done, {sum(job_store.turns(job_id) > 0 for job_id, _ in jobs)} "
+                  f"resumed from checkpoints, {len(exported)} exported)")
+            if not jobs:
+                return []
+            job_ids = [job_id for job_id, _ in jobs]
+            progress = {"done": 0}
+
+            def on_dialogue(index: int, dialogue: Dict):
+                if args.format == "json":
+                    save_dialogue(dialogue, os.path.join(args.output, f"dialogue_{job_ids[index]}.json"))
+                progress["done"] += 1
+                logger.info("对话完成 %d/%d: %s & %s", progress["done"], len(jobs),
+                            dialogue["bot_a_name"], dialogue["bot_b_name"])
+
+            return await run_batch([job for _, job in jobs], args.rounds, args.concurrency, on_dialogue,
+                                   store=store, dialogue_ids=job_ids, job_store=job_store)
+        finally:
+            await async_api.close_session()
+
+    store: Optional[DialogueWriter] = None
+    if args.format == "jsonl":
+        store = DialogueWriter(args.output)
+    else:
+        os.makedirs(args.output, exist_ok=True)
+    job_store = JobStore(job_store_path)
+    started = time.perf_counter()
+    try:
+        results = asyncio.run(main())
+    finally:
+        job_store.close()
+        if store is not None:
+            store.close()
+    failed = sum(dialogue is None for dialogue in results)
+    missing = sum(content_hash(text) not in personas for _, text in sources)
+    print(f"{len(results) - failed} dialogues generated, {failed} failed, {missing} personas missing "
+          f"in {time.perf_counter() - started:.1f}s -> {args.output}")
+    return 1 if failed or missing else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-v", "--verbose", action="store_true", help="输出每个人设、对话的进度")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    roles = subparsers.add_parser("roles", parents=[common], help="从人设素材生成角色人设")
+    roles.add_argument("sources", nargs="+", help="人设素材文件或目录")
+    roles.add_argument("-o", "--output", default="personas.json", help="人设文件，已有的人设不再重新生成")
+    roles.add_argument("--concurrency", type=int, default=10, help="同时生成的人设数")
+    roles.set_defaults(func=cmd_roles)
+
+    dialogues = subparsers.add_parser("dialogues", parents=[common], help="生成人设并批量生成对话")
+    dialogues.add_argument("sources", nargs="+", help="人设素材文件或目录")
+    dialogues.add_argument("--topic", action="append", help="开场话题，可以指定多次")
+    dialogues.add_argument("--topics-file", help="开场话题文件，每行一个")
+    dialogues.add_argument("--pairing", choices=["adjacent", "all"], default="adjacent",
+                           help="adjacent: 按顺序每两个素材一组；all: 所有素材两两组合")
+    dialogues.add_argument("--rounds", type=int, default=5, help="每个角色回复的次数")
+    dialogues.add_argument("--concurrency", type=int, default=10, help="同时进行的对话数")
+    dialogues.add_argument("--format", choices=["jsonl", "json"], default="jsonl")
+    dialogues.add_argument("-o", "--output",
+                           help="jsonl格式为数据集路径（默认output/dialogues.jsonl），json格式为输出目录（默认output）")
+    dialogues.add_argument("--personas", help="人设文件，默认放在输出旁边")
+    dialogues.add_argument("--job-store", help="任务库（SQLite），记录任务状态和每条消息的检查点，默认放在输出旁边")
+    dialogues.add_argument("--resume", action="store_true", help="跳过已完成的对话，从检查点续写中断的对话")
+    dialogues.set_defaults(func=cmd_dialogues)
+
+    args = parser.parse_args(argv)
+    if args.command == "dialogues" and not args.output:
+        args.output = "output/dialogues.jsonl" if args.format == "jsonl" else "output"
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
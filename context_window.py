@@ -0,0 +1,302 @@
+"""
+按token预算组织发送给模型的对话历史
+
+对话越长，每轮请求要发送的历史就越多。这里把历史控制在token预算之内：
+- 没超出预算时原样发送
+- 超出时，较早的消息按固定大小分块，在后台用chatglm滚动概括（第k块的概要 = 概括(第k-1块的概要 + 第k块)），
+  概要以"前情提要"的形式放在最前面，替代被概括的消息
+- 概要还没生成好、或仍然超出预算时，从最早的消息开始丢弃
+
+概要以对话前缀的哈希（逐块链式计算）为键缓存（设置SUMMARY_STORE_PATH后同时保存在SQLite中），同一段历史只概括一次，之后每轮、生成场景描写、
+重新加载保存的对话时都直接复用。历史超过预算的3/4时就开始在后台概括，超出预算时概要通常已经准备好了。
+token数用本地的估算，不调用分词器：中文约每字0.7个token，其他字符约每4个一个token。
+
+可通过环境变量调整：
+CONTEXT_TOKEN_BUDGET: 对话历史的token预算
+CONTEXT_SUMMARY_BLOCK: 每次概括的消息条数
+CONTEXT_MIN_RECENT: 最近的多少条消息不参与概括
+CONTEXT_SUMMARIZE: 是否概括，为no时超出预算只丢弃
+SCENE_CONTEXT_BUDGET: 生成场景描写（图片prompt）时对话历史的token预算
+CONTEXT_SUMMARY_THRESHOLD: 对话历史超过多少token时开始在后台概括
+SUMMARY_STORE_PATH: 保存概要的SQLite文件，为空时只保存在内存中
+SUMMARY_STORE_TTL: 概要的有效期（秒）
+"""
+import collections
+import hashlib
+import json
+import math
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import api
+from data_types import TextMsg, TextMsgList
+from response_cache import RESPONSE_CACHE_MAX_BYTES, ResponseCache
+
+CONTEXT_TOKEN_BUDGET: int = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_SUMMARY_BLOCK: int = int(os.getenv("CONTEXT_SUMMARY_BLOCK", "8"))
+CONTEXT_MIN_RECENT: int = int(os.getenv("CONTEXT_MIN_RECENT", "6"))
+CONTEXT_SUMMARIZE: bool = os.getenv("CONTEXT_SUMMARIZE", "yes").lower() in ("1", "yes", "y", "true", "t", "on")
+SCENE_CONTEXT_BUDGET: int = int(os.getenv("SCENE_CONTEXT_BUDGET", "800"))
+CONTEXT_SUMMARY_THRESHOLD: Optional[int] = int(os.getenv("CONTEXT_SUMMARY_THRESHOLD")) \
+    if os.getenv("CONTEXT_SUMMARY_THRESHOLD") else None
+# 概要持久化保存的SQLite文件，默认为空，只保存在内存中；设置后第一次读写概要时才创建文件
+SUMMARY_STORE_PATH: str = os.getenv("SUMMARY_STORE_PATH", "")
+SUMMARY_STORE_TTL: float = float(os.getenv("SUMMARY_STORE_TTL", str(30 * 24 * 3600)))
+
+CJK_TOKENS_PER_CHAR = 0.7
+OTHER_TOKENS_PER_CHAR = 0.25
+# 每条消息的role等固定开销
+MESSAGE_OVERHEAD_TOKENS = 4
+# 内存中缓存的概要条数
+SUMMARY_CACHE_SIZE = 1024
+# 记住上一轮前缀哈希的对话数
+PREFIX_CHAIN_CACHE_SIZE = 64
+
+SUMMARY_TEMPLATE = "（前情提要：{summary}）"
+
+
+# 概要以对话前缀的哈希为键保存，进程重启、重新加载保存的对话后仍可复用
+summary_store = ResponseCache(SUMMARY_CACHE_SIZE, SUMMARY_STORE_TTL, SUMMARY_STORE_PATH or None,
+                              max_bytes=RESPONSE_CACHE_MAX_BYTES)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的token数
+    utf-8下中文等字符占3字节、ascii占1字节，由字节数和字符数之差即可算出非ascii字符数，不用逐字判断
+    """
+    n_chars = len(text)
+    n_wide = (len(text.encode("utf-8")) - n_chars) // 2
+    return math.ceil(n_wide * CJK_TOKENS_PER_CHAR + (n_chars - n_wide) * OTHER_TOKENS_PER_CHAR)
+
+
+def estimate_message_tokens(msg: TextMsg) -> int:
+    return estimate_tokens(msg["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def payload_bytes(messages: TextMsgList) -> int:
+    """ 对话历史在请求体中的大小 """
+    return len(json.dumps(messages, ensure_ascii=False).encode())
+
+
+def fit_messages(messages: TextMsgList, budget: int) -> TextMsgList:
+    """ 只保留预算内最近的消息（至少保留最后一条） """
+    total = 0
+    start = len(messages)
+    while start > 0:
+        total += estimate_message_tokens(messages[start - 1])
+        if total > budget and start < len(messages):
+            break
+        start -= 1
+    return messages[start:]
+
+
+def prefix_keys(messages: TextMsgList, names: Tuple[str, str], block_size: int, n_blocks: int,
+                known: Sequence[str] = ()) -> List[str]:
+    """
+    前n_blocks块对话前缀的链式哈希，第k个键由第k-1个键和第k块的内容算出
+    :param known: 已经算出的前若干块的键，从其后一块继续计算
+    """
+    keys = list(known[:n_blocks])
+    key = keys[-1] if keys else hashlib.sha256(json.dumps(names, ensure_ascii=False).encode()).hexdigest()
+    for k in range(len(keys), n_blocks):
+        block = messages[k * block_size:(k + 1) * block_size]
+        payload = key + json.dumps(block, ensure_ascii=False, sort_keys=True)
+        key = hashlib.sha256(payload.encode()).hexdigest()
+        keys.append(key)
+    return keys
+
+
+class ContextResult(NamedTuple):
+    messages: TextMsgList
+    """实际发送的对话历史"""
+    summary: str
+    """使用的概要，没有时为空"""
+    recent: TextMsgList
+    """messages中概要之后的原始消息"""
+    summarized: int
+    """被概要替代的消息数"""
+    dropped: int
+    """被丢弃的消息数"""
+    tokens: int
+    """发送的对话历史的估算token数"""
+    original_tokens: int
+    """完整对话历史的估算token数"""
+    payload_bytes: int
+    """发送的对话历史的字节数"""
+
+
+class ContextWindow(object):
+    """
+    ```python
+    context = context_window.build(filter_text_msg(history), (meta["bot_name"], meta["user_name"]))
+    get_characterglm_response(context.messages, meta)
+    ```
+    """
+
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET, block_size: int = CONTEXT_SUMMARY_BLOCK,
+                 min_recent: int = CONTEXT_MIN_RECENT, summarize: bool = CONTEXT_SUMMARIZE,
+                 summary_threshold: Optional[int] = CONTEXT_SUMMARY_THRESHOLD,
+                 store: Optional[ResponseCache] = None):
+        """
+        :param budget: 对话历史的token预算
+        :param block_size: 每次概括的消息条数
+        :param min_recent: 最近的多少条消息不参与概括
+        :param summarize: 是否概括，False时超出预算只丢弃
+        :param summary_threshold: 对话历史超过多少token时开始在后台概括，默认为预算的3/4，
+            这样在超出预算之前概要就已经准备好了
+        :param store: 保存概要的缓存，默认为summary_store
+        """
+        self.budget = budget
+        self.block_size = block_size
+        self.min_recent = min_recent
+        self.summarize = summarize
+        self.summary_threshold = summary_threshold if summary_threshold is not None else budget * 3 // 4
+        self.store = store if store is not None else summary_store
+        self._lock = threading.Lock()
+        # 链末尾的前缀哈希 -> 正在进行的概括任务
+        self._pending: Dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="context_summary")
+        self._recent: Deque[ContextResult] = collections.deque(maxlen=1000)
+        # 每个对话上一轮的 (各块的内容, 前缀哈希)，下一轮只为内容变化和新增的块重新哈希
+        self._chains: "collections.OrderedDict[Tuple[str, str], Tuple[List[Tuple], List[str]]]" = \
+            collections.OrderedDict()
+        self.summary_calls = 0
+
+    def _summarize_chain(self, messages: TextMsgList, names: Tuple[str, str], keys: List[str], start: int):
+        """ 从第start块开始，逐块生成滚动概要直到最后一块 """
+        try:
+            summary = self.store.get(keys[start - 1]) if start else ""
+            for k in range(start, len(keys)):
+                block = messages[k * self.block_size:(k + 1) * self.block_size]
+                summary = api.generate_summary(block, names, summary)
+                # 概括任务在线程池中并发执行
+                with self._lock:
+                    self.summary_calls += 1
+                if not summary:
+                    return
+                self.store.put(keys[k], summary)
+        finally:
+            with self._lock:
+                self._pending.pop(keys[-1], None)
+
+    def _schedule(self, messages: TextMsgList, names: Tuple[str, str], keys: List[str], start: int):
+        with self._lock:
+            if keys[-1] in self._pending:
+                return
+            self._pending[keys[-1]] = self._executor.submit(
+                self._summarize_chain, messages[:len(keys) * self.block_size], names, keys, start)
+
+    def _prefix_keys(self, messages: TextMsgList, names: Tuple[str, str], n_blocks: int) -> List[str]:
+        """
+        prefix_keys，复用这个对话上一轮算出的键
+        块的内容只转成tuple比较（消息内容是同一批字符串对象，比较很快），不再每轮json序列化、sha256整个前缀
+        """
+        size = self.block_size
+        blocks = [tuple(tuple(msg.items()) for msg in messages[k * size:(k + 1) * size]) for k in range(n_blocks)]
+        with self._lock:
+            old_blocks, old_keys = self._chains.get(names, ([], []))
+        same = 0
+        for old, new in zip(old_blocks, blocks):
+            if old != new:
+                break
+            same += 1
+        keys = prefix_keys(messages, names, size, n_blocks, old_keys[:same])
+        with self._lock:
+            self._chains[names] = (blocks, keys)
+            self._chains.move_to_end(names)
+            while len(self._chains) > PREFIX_CHAIN_CACHE_SIZE:
+                self._chains.popitem(last=False)
+        return keys
+
+    def latest_summary(self, messages: TextMsgList, names: Tuple[str, str], schedule: bool = True) -> Tuple[str, int]:
+        """
+        已有的覆盖最长前缀的概要
+        :param messages: 完整的对话历史
+        :param names: (assistant的名字, user的名字)
+        :param schedule: 是否在后台补上缺少的概要
+        :return: (概要, 概要覆盖的消息数)，没有时为("", 0)
+        """
+        n_blocks = max(0, len(messages) - self.min_recent) // self.block_size
+        if not self.summarize or not n_blocks:
+            return "", 0
+        keys = self._prefix_keys(messages, names, n_blocks)
+        # 每次只按覆盖全部块的概要计一次命中/未命中；没有时用不计数的peek往前找已有的较短的概要
+        summary, covered = "", 0
+        cached = self.store.get(keys[-1])
+        if cached is not None:
+            summary, covered = cached, n_blocks * self.block_size
+        else:
+            for k in range(n_blocks - 1, 0, -1):
+                cached = self.store.peek(keys[k - 1])
+                if cached is not None:
+                    summary, covered = cached, k * self.block_size
+                    break
+        if schedule and covered < n_blocks * self.block_size:
+            self._schedule(messages, names, keys, covered // self.block_size)
+        return summary, covered
+
+    def warm(self, messages: TextMsgList, names: Tuple[str, str]):
+        """ 历史足够长时在后台准备好概要，如加载了保存的对话之后 """
+        if sum(estimate_message_tokens(msg) for msg in messages) > self.summary_threshold:
+            self.latest_summary(messages, names)
+
+    def build(self, messages: TextMsgList, names: Tuple[str, str], budget: Optional[int] = None) -> ContextResult:
+        """
+        :param messages: 完整的对话历史
+        :param names: (assistant的名字, user的名字)，用于概括
+        :param budget: 本次请求的token预算，默认为self.budget；概要与预算无关，不同预算的请求共用
+        :return:
+        """
+        budget = self.budget if budget is None else budget
+        tokens = [estimate_message_tokens(msg) for msg in messages]
+        original_tokens = sum(tokens)
+        summary, covered = "", 0
+        if original_tokens > self.summary_threshold:
+            summary, covered = self.latest_summary(messages, names)
+        if original_tokens <= budget:
+            # messages可能是MessageStore的只读视图，切片得到要发送的list
+            sent = messages[:]
+            return self._record(ContextResult(sent, "", sent, 0, 0, original_tokens, original_tokens,
+                                              payload_bytes(sent)))
+
+        head: TextMsgList = []
+        if summary:
+            head = [TextMsg({"role": "user", "content": SUMMARY_TEMPLATE.format(summary=summary)})]
+            budget -= estimate_message_tokens(head[0])
+        # 概要之后的消息，从最早的开始丢弃直到满足预算
+        start = covered
+        total = sum(tokens[start:])
+        while total > budget and start < len(messages) - 1:
+            total -= tokens[start]
+            start += 1
+        recent = messages[start:]
+        sent = head + recent
+        head_tokens = estimate_message_tokens(head[0]) if head else 0
+        return self._record(ContextResult(sent, summary, recent, covered, start - covered,
+                                          total + head_tokens, original_tokens, payload_bytes(sent)))
+
+    def _record(self, result: ContextResult) -> ContextResult:
+        self._recent.append(result)
+        return result
+
+    def stats(self) -> Dict:
+        """ 最近若干次请求的对话历史大小 """
+        recent = list(self._recent)
+        n = len(recent)
+        return {
+            "requests": n,
+            "avg_tokens": sum(r.tokens for r in recent) / n if n else 0.0,
+            "avg_original_tokens": sum(r.original_tokens for r in recent) / n if n else 0.0,
+            "avg_payload_bytes": sum(r.payload_bytes for r in recent) / n if n else 0.0,
+            "max_payload_bytes": max((r.payload_bytes for r in recent), default=0),
+            "summarized_requests": sum(1 for r in recent if r.summary),
+            "trimmed_requests": sum(1 for r in recent if r.dropped),
+            "summary_calls": self.summary_calls,
+            "summary_store": self.store.stats(),
+        }
+
+
+context_window = ContextWindow()
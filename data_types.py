@@ -3,6 +3,8 @@
 """
 from typing import Literal, TypedDict, List, Union, Optional, TYPE_CHECKING
 
+from typing_extensions import NotRequired
+
 if TYPE_CHECKING:
     import streamlit.elements.image
 
@@ -28,6 +30,8 @@ class ImageMsg(BaseMsg):
     """图片内容"""
     caption: Optional[Union[str, List[str]]]
     """说明文字"""
+    local_image: NotRequired[str]
+    """图片下载到本地缓存后的文件名（见image_cache.py），远程url过期后仍可展示"""
 
 
 Msg = Union[TextMsg, ImageMsg]
@@ -48,6 +52,10 @@ class CharacterMeta(TypedDict):
 
 
 def filter_text_msg(messages: MsgList) -> TextMsgList:
+    """ 只保留文本消息；messages为message_store.MessageStore时返回不复制的只读视图 """
+    text_view = getattr(messages, "text_view", None)
+    if text_view is not None:
+        return text_view()
     return [m for m in messages if m["role"] != "image"]
 
 
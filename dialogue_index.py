@@ -0,0 +1,240 @@
+"""
+jsonl对话数据集（dialogue_store.py写入的格式）的索引与按需读取
+
+第一次打开时扫描一遍文件，记录每个对话的对话头和每条消息所在的(文件序号, 偏移量)，
+并保存为旁路索引文件（<path>.idx.json）。数据集只追加写入，之后再打开时只扫描新增的部分。
+读取时用mmap直接定位到对应的行，只解析请求的对话/消息，不加载整个文件。
+
+压缩的数据集（.jsonl.gz/.jsonl.zst）无法随机访问，只能用dialogue_store.iter_dialogues顺序读取。
+"""
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+
+from data_types import MsgList
+from dialogue_store import segment_paths, get_compression
+
+INDEX_SUFFIX = ".idx.json"
+INDEX_VERSION = 1
+
+# DialogueWriter写出的记录，键的顺序是固定的，直接用正则取出type和dialogue_id，不必解析整行
+_RECORD_PREFIX = re.compile(rb'\{"type": "(\w+)", "dialogue_id": "([^"\\]*)"(?:, "(?:index|length)": (\d+))?')
+
+
+def _head_digest(m, length: int) -> str:
+    """ 文件开头的摘要，用于发现文件被替换 """
+    return hashlib.sha1(m[:length]).hexdigest()
+
+
+class DialogueArchive(object):
+    """
+    可随机访问的对话数据集
+
+    ```python
+    archive = DialogueArchive("dialogues.jsonl")
+    for dialogue_id in archive.ids()[-20:]:
+        print(archive.get_meta(dialogue_id))
+    turns = archive.get_turns(dialogue_id, 0, 10)
+    ```
+    """
+
+    def __init__(self, path: str, use_sidecar: bool = True):
+        if get_compression(path):
+            raise ValueError("压缩的数据集不支持随机访问")
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX if use_sidecar else None
+        self._lock = threading.RLock()
+        self._segments: List[Dict] = []
+        # dialogue_id -> {"meta": [[seg, off], ...], "turns": [[seg, off], ...], "complete": bool}
+        self._dialogues: Dict[str, Dict] = {}
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._load_index()
+        self.refresh()
+
+    def _load_index(self):
+        if not self.index_path or not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        if index.get("version") == INDEX_VERSION:
+            self._segments = index["segments"]
+            self._dialogues = index["dialogues"]
+
+    def _save_index(self):
+        if not self.index_path:
+            return
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": INDEX_VERSION, "segments": self._segments, "dialogues": self._dialogues}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _map(self, seg: int) -> Optional[mmap.mmap]:
+        m = self._maps.get(seg)
+        if m is None:
+            path = os.path.join(os.path.dirname(self.path), self._segments[seg]["path"])
+            if not os.path.getsize(path):
+                return None
+            with open(path, "rb") as f:
+                m = self._maps[seg] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return m
+
+    def _reset(self):
+        self._close_maps()
+        self._segments = []
+        self._dialogues = {}
+
+    def refresh(self) -> bool:
+        """
+        扫描数据集新增的部分，更新索引
+        :return: 索引是否有变化
+        """
+        with self._lock:
+            paths = [os.path.basename(p) for p in segment_paths(self.path)]
+            known = [s["path"] for s in self._segments]
+            if paths[:len(known)] != known:
+                self._reset()
+
+            changed = False
+            for seg, name in enumerate(paths):
+                if seg == len(self._segments):
+                    self._segments.append({"path": name, "scanned": 0, "head": "", "head_len": 0})
+                segment = self._segments[seg]
+                size = os.path.getsize(os.path.join(os.path.dirname(self.path), name))
+                if size == segment["scanned"]:
+                    continue
+                # 文件变大后需要重新mmap
+                old = self._maps.pop(seg, None)
+                if old is not None:
+                    old.close()
+                m = self._map(seg)
+                if m is None:
+                    continue
+                if segment["head_len"]:
+                    if size < segment["scanned"] or _head_digest(m, segment["head_len"]) != segment["head"]:
+                        # 文件被截断或替换，整个重建
+                        self._reset()
+                        return self.refresh() or True
+                else:
+                    segment["head_len"] = min(size, 256)
+                    segment["head"] = _head_digest(m, segment["head_len"])
+                segment["scanned"] = self._scan(seg, m, segment["scanned"])
+                changed = True
+            if changed:
+                self._save_index()
+            return changed
+
+    def _scan(self, seg: int, m: mmap.mmap, pos: int) -> int:
+        """ 从pos开始扫描完整的行，返回扫描到的位置 """
+        dialogues = self._dialogues
+        while True:
+            end = m.find(b"\n", pos)
+            if end < 0:
+                # 最后半行还没写完，下次再扫
+                return pos
+            match = _RECORD_PREFIX.match(m, pos, end)
+            if match:
+                record_type = match.group(1).decode()
+                dialogue_id = match.group(2).decode()
+                number = match.group(3)
+            else:
+                try:
+                    record = json.loads(m[pos:end])
+                except ValueError:
+                    pos = end + 1
+                    continue
+                record_type = record["type"]
+                dialogue_id = record["dialogue_id"]
+                number = record.get("index", record.get("length"))
+
+            entry = dialogues.get(dialogue_id)
+            if record_type == "dialogue":
+                if entry is None:
+                    entry = dialogues[dialogue_id] = {"meta": [], "turns": [], "complete": False}
+                entry["meta"].append([seg, pos])
+            elif entry is not None:
+                if record_type == "turn":
+                    index = int(number)
+                    if index < len(entry["turns"]):
+                        entry["turns"][index] = [seg, pos]
+                    else:
+                        entry["turns"].append([seg, pos])
+                elif record_type == "truncate":
+                    del entry["turns"][int(number):]
+                elif record_type == "end":
+                    entry["complete"] = True
+            pos = end + 1
+
+    def _read(self, loc: List[int]) -> Dict:
+        seg, pos = loc
+        m = self._map(seg)
+        return json.loads(m[pos:m.find(b"\n", pos)])
+
+    def ids(self, complete_only: bool = False) -> List[str]:
+        """ 所有对话的id，按第一次写入的顺序 """
+        with self._lock:
+            if complete_only:
+                return [k for k, v in self._dialogues.items() if v["complete"]]
+            return list(self._dialogues)
+
+    def __len__(self) -> int:
+        return len(self._dialogues)
+
+    def __contains__(self, dialogue_id: str) -> bool:
+        return dialogue_id in self._dialogues
+
+    def num_turns(self, dialogue_id: str) -> int:
+        return len(self._dialogues[dialogue_id]["turns"])
+
+    def is_complete(self, dialogue_id: str) -> bool:
+        return self._dialogues[dialogue_id]["complete"]
+
+    def get_meta(self, dialogue_id: str) -> Dict:
+        """ 对话的人设等字段（不含history） """
+        with self._lock:
+            meta = {}
+            for loc in self._dialogues[dialogue_id]["meta"]:
+                meta.update(self._read(loc)["meta"])
+            return meta
+
+    def get_turns(self, dialogue_id: str, start: int = 0, stop: Optional[int] = None) -> MsgList:
+        """ 只读取[start, stop)范围内的消息 """
+        with self._lock:
+            return [self._read(loc)["message"] for loc in self._dialogues[dialogue_id]["turns"][start:stop]]
+
+    def get(self, dialogue_id: str) -> Dict:
+        """ history.json格式的完整对话 """
+        dialogue = self.get_meta(dialogue_id)
+        dialogue["history"] = self.get_turns(dialogue_id)
+        return dialogue
+
+    def _close_maps(self):
+        for m in self._maps.values():
+            m.close()
+        self._maps.clear()
+
+    def close(self):
+        with self._lock:
+            self._close_maps()
+
+
+_archives: Dict[str, DialogueArchive] = {}
+_archives_lock = threading.Lock()
+
+
+def open_archive(path: str) -> DialogueArchive:
+    """ 获取path对应的数据集，同一进程内复用，每次获取时扫描新增的部分 """
+    path = os.path.abspath(path)
+    with _archives_lock:
+        archive = _archives.get(path)
+        if archive is None:
+            archive = _archives[path] = DialogueArchive(path)
+            return archive
+    archive.refresh()
+    return archive
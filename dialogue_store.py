@@ -0,0 +1,341 @@
+"""
+追加写入的对话数据集（JSONL格式，可选gzip/zstd压缩）
+
+每行一条记录，同一个对话的记录通过dialogue_id关联，多个对话的记录可以交错写入：
+- {"type": "dialogue", "dialogue_id": ..., "meta": {...}}  对话开始，meta为人设等字段（同history.json中除history外的部分），
+  同一对话再次出现时表示更新人设
+- {"type": "turn", "dialogue_id": ..., "index": i, "message": {...}}  第i条消息，同一index后写入的覆盖先写入的
+- {"type": "truncate", "dialogue_id": ..., "length": n}  对话历史被截断为前n条
+- {"type": "end", "dialogue_id": ..., "turns": n}  对话完成，之后仍可能追加记录（加载保存的对话后继续聊天）
+
+写入只追加，不重写已有内容；读取是惰性的生成器，适合百万级别的消息。
+"""
+import gzip
+import io
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from typing import Dict, IO, Iterator, List, Optional, Set, Tuple
+
+from data_types import Msg, MsgList
+
+# 写入多少条记录或间隔多少秒后fsync一次
+FSYNC_EVERY: int = int(os.getenv("DIALOGUE_STORE_FSYNC_EVERY", "100"))
+FSYNC_INTERVAL: float = float(os.getenv("DIALOGUE_STORE_FSYNC_INTERVAL", "1.0"))
+
+JSONL_SUFFIXES = (".jsonl", ".jsonl.gz", ".jsonl.zst")
+
+
+def is_jsonl_path(path: str) -> bool:
+    return path.endswith(JSONL_SUFFIXES)
+
+
+def _split_suffix(path: str) -> Tuple[str, str]:
+    """ dialogues.jsonl.gz -> (dialogues, .jsonl.gz) """
+    for suffix in JSONL_SUFFIXES[::-1]:
+        if path.endswith(suffix):
+            return path[:-len(suffix)], suffix
+    return os.path.splitext(path)
+
+
+def get_compression(path: str) -> Optional[str]:
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".zst"):
+        return "zstd"
+    return None
+
+
+def segment_path(path: str, n: int) -> str:
+    """ 按大小切分时第n个文件的路径：dialogues.jsonl -> dialogues.00001.jsonl """
+    stem, suffix = _split_suffix(path)
+    return f"{stem}.{n:05d}{suffix}"
+
+
+def segment_paths(path: str) -> List[str]:
+    """ path对应的所有数据文件，按写入顺序排列 """
+    stem, suffix = _split_suffix(path)
+    directory = os.path.dirname(stem) or "."
+    pattern = re.compile(re.escape(os.path.basename(stem)) + r"\.(\d{5})" + re.escape(suffix) + "$")
+    segments = []
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            match = pattern.match(name)
+            if match:
+                segments.append((int(match.group(1)), os.path.join(directory, name)))
+    if segments:
+        return [p for _, p in sorted(segments)]
+    return [path] if os.path.exists(path) else []
+
+
+def _open_binary(path: str, mode: str) -> IO[bytes]:
+    """ 按后缀打开（解）压缩流，mode为rb或ab """
+    compression = get_compression(path)
+    if compression == "gzip":
+        return gzip.open(path, mode)
+    if compression == "zstd":
+        # 需要安装zstandard
+        import zstandard
+        raw = open(path, mode)
+        if mode.startswith("r"):
+            return io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True))
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+    return open(path, mode)
+
+
+class DialogueWriter(object):
+    """
+    对话数据集的写入端，线程安全
+
+    fsync按批进行：每fsync_every条记录或每fsync_interval秒一次，进程崩溃最多丢失最近一批。
+    设置max_bytes后按大小切分文件，文件名为dialogues.00000.jsonl、dialogues.00001.jsonl...
+    """
+
+    def __init__(self, path: str, max_bytes: Optional[int] = None,
+                 fsync_every: int = FSYNC_EVERY, fsync_interval: float = FSYNC_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._file: Optional[IO[bytes]] = None
+        self._segment = 0
+        self._segment_bytes = 0
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        if max_bytes:
+            existing = segment_paths(path)
+            if existing and existing[0] != path:
+                self._segment = len(existing) - 1
+        self._open()
+
+    def _current_path(self) -> str:
+        return segment_path(self.path, self._segment) if self.max_bytes else self.path
+
+    def _open(self):
+        current = self._current_path()
+        directory = os.path.dirname(current)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 压缩文件按压缩后大小估算，续写时从已有大小开始计
+        self._segment_bytes = os.path.getsize(current) if os.path.exists(current) else 0
+        self._file = _open_binary(current, "ab")
+        if self._segment_bytes and not get_compression(current):
+            # 进程被杀时最后一行可能只写了一半，续写前补上换行，不让新记录接在半行后面
+            with open(current, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write(b"\n")
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        self._segment += 1
+        self._open()
+
+    def _sync(self):
+        self._file.flush()
+        try:
+            os.fsync(self._file.fileno())
+        except (OSError, io.UnsupportedOperation):
+            pass
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def write_record(self, record: Dict):
+        line = json.dumps(record, ensure_ascii=False).encode() + b"\n"
+        with self._lock:
+            if self.max_bytes and self._segment_bytes and self._segment_bytes + len(line) > self.max_bytes:
+                self._rotate()
+            self._file.write(line)
+            self._segment_bytes += len(line)
+            self._pending += 1
+            if self._pending >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def begin_dialogue(self, meta: Dict, dialogue_id: Optional[str] = None) -> str:
+        """
+        开始一个对话
+        :param meta: 人设等字段
+        :param dialogue_id: 默认随机生成
+        :return: dialogue_id
+        """
+        dialogue_id = dialogue_id or uuid.uuid4().hex
+        self.write_record({"type": "dialogue", "dialogue_id": dialogue_id, "meta": meta})
+        return dialogue_id
+
+    def write_turn(self, dialogue_id: str, index: int, message: Msg):
+        self.write_record({"type": "turn", "dialogue_id": dialogue_id, "index": index, "message": message})
+
+    def truncate(self, dialogue_id: str, length: int):
+        self.write_record({"type": "truncate", "dialogue_id": dialogue_id, "length": length})
+
+    def end_dialogue(self, dialogue_id: str, turns: int):
+        self.write_record({"type": "end", "dialogue_id": dialogue_id, "turns": turns})
+
+    def write_dialogue(self, dialogue: Dict, dialogue_id: Optional[str] = None) -> str:
+        """
+        写入一个完整的对话（history.json格式）
+        :return: dialogue_id
+        """
+        meta = {key: value for key, value in dialogue.items() if key != "history"}
+        dialogue_id = self.begin_dialogue(meta, dialogue_id)
+        for i, message in enumerate(dialogue["history"]):
+            self.write_turn(dialogue_id, i, message)
+        self.end_dialogue(dialogue_id, len(dialogue["history"]))
+        return dialogue_id
+
+    def flush(self):
+        """ 立即写盘并fsync """
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _iter_lines(path: str) -> Iterator[bytes]:
+    """ 按写入顺序读取所有非空行（未解析），按大小切分的文件依次读取 """
+    for segment in segment_paths(path):
+        with _open_binary(segment, "rb") as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        yield line
+            except EOFError:
+                # 压缩流没有正常结束（写入端没有close）
+                pass
+
+
+def _parse(line: bytes) -> Optional[Dict]:
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError:
+        # 进程崩溃时最后一行可能只写了一半
+        return None
+
+
+def iter_records(path: str) -> Iterator[Dict]:
+    """ 惰性读取所有记录，按大小切分的文件依次读取 """
+    for line in _iter_lines(path):
+        record = _parse(line)
+        if record is not None:
+            yield record
+
+
+def apply_record(history: MsgList, record: Dict):
+    """ 把turn/truncate记录应用到对话历史上 """
+    if record["type"] == "turn":
+        index = record["index"]
+        if index < len(history):
+            history[index] = record["message"]
+        elif index == len(history):
+            history.append(record["message"])
+        else:
+            raise ValueError(f"dialogue {record['dialogue_id']}: turn {index} written after "
+                             f"only {len(history)} messages")
+    elif record["type"] == "truncate":
+        del history[record["length"]:]
+
+
+def _apply_to(dialogues: Dict[str, Dict], record: Dict) -> bool:
+    """
+    把一条记录应用到对话（dialogue_id -> history.json格式的对话）上
+    :return: 是否是end记录
+    """
+    dialogue_id = record["dialogue_id"]
+    dialogue = dialogues.get(dialogue_id)
+    if record["type"] == "dialogue":
+        if dialogue is None:
+            dialogues[dialogue_id] = dict(record["meta"], history=[])
+        else:
+            # 同一个对话再次写入的对话头表示人设有更新，已有的消息保留
+            dialogue.update(record["meta"])
+        return False
+    if dialogue is None:
+        return False
+    if record["type"] == "end":
+        return True
+    apply_record(dialogue["history"], record)
+    return False
+
+
+# DialogueWriter写出的记录，键的顺序是固定的，直接用正则取出dialogue_id，不必解析整行
+_DIALOGUE_ID_PREFIX = re.compile(rb'\{"type": "\w+", "dialogue_id": "([^"\\]*)"')
+
+
+def _last_lines(path: str) -> Tuple[int, Dict[int, str]]:
+    """
+    第一遍扫描：每个对话最后一条记录在第几行
+    :return: (总行数, 行号 -> 在这一行结束的dialogue_id)
+    """
+    last: Dict[str, int] = {}
+    n = 0
+    for n, line in enumerate(_iter_lines(path), 1):
+        match = _DIALOGUE_ID_PREFIX.match(line)
+        if match:
+            last[match.group(1).decode()] = n - 1
+            continue
+        record = _parse(line)
+        if record is not None:
+            last[record["dialogue_id"]] = n - 1
+    return n, {line_no: dialogue_id for dialogue_id, line_no in last.items()}
+
+
+def iter_dialogues(path: str, include_incomplete: bool = False) -> Iterator[Tuple[str, Dict]]:
+    """
+    惰性读取对话，每个对话在它的最后一条记录处产出一次
+    加载保存的对话后继续聊天时，end之后还会追加消息、重新写入对话头，这些记录都应用在同一个对话上，
+    所以先扫一遍文件（只取出dialogue_id）找到每个对话的最后一条记录，第二遍才应用记录。
+    内存中只保留还没读到最后一条记录的对话，只读到第一遍扫描时的末尾
+    :param path:
+    :param include_incomplete: 是否在最后产出没有end记录的对话（如中途失败的任务、界面中持续追加的会话）
+    :return: (dialogue_id, history.json格式的对话)
+    """
+    total, last_lines = _last_lines(path)
+    dialogues: Dict[str, Dict] = {}
+    ended: Set[str] = set()
+    for n, line in enumerate(_iter_lines(path)):
+        if n >= total:
+            break
+        record = _parse(line)
+        if record is not None and _apply_to(dialogues, record):
+            ended.add(record["dialogue_id"])
+        dialogue_id = last_lines.get(n)
+        if dialogue_id in ended:
+            ended.discard(dialogue_id)
+            yield dialogue_id, dialogues.pop(dialogue_id)
+    if include_incomplete:
+        yield from dialogues.items()
+
+
+def load_progress(path: str) -> Tuple[Set[str], Dict[str, Dict]]:
+    """
+    读取数据集中各对话的进度，用于批量生成中断后续写
+    已完成（有end记录）的对话只记录id，不保留内容；end之后追加的记录不会让它变回未完成
+    :return: (已完成的对话id, 未完成的对话id -> history.json格式的对话)
+    """
+    complete: Set[str] = set()
+    pending: Dict[str, Dict] = {}
+    for record in iter_records(path):
+        dialogue_id = record["dialogue_id"]
+        if dialogue_id in complete:
+            continue
+        if _apply_to(pending, record):
+            del pending[dialogue_id]
+            complete.add(dialogue_id)
+    return complete, pending
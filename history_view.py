@@ -0,0 +1,187 @@
+"""
+对话历史的渲染
+
+streamlit每次rerun都会重新执行整个脚本，原先逐条st.markdown/st.image整个对话历史，耗时随历史长度线性增长；
+图片每次都要交给st.image检查格式和尺寸、计算md5后重新注册到media file manager，一张cogview的图片要几十毫秒。
+这里：
+- 只逐条渲染最近HISTORY_RENDER_RECENT条消息，更早的折叠起来，勾选展开时合并成一个markdown块
+- 每条消息折叠后的markdown按消息的哈希缓存，展开时只拼接
+- 本地缓存的图片缩小到HISTORY_IMAGE_WIDTH宽后缓存，st.image处理的字节数小得多
+- 新追加的消息可以直接用draw_message画在当前位置，不需要st.rerun重画整个历史
+缓存都在进程内（所有会话共享），不放在st.session_state里。
+
+可通过环境变量调整：
+HISTORY_RENDER_RECENT: 逐条渲染最近多少条消息
+HISTORY_IMAGE_WIDTH: 历史中的图片缩小到多宽（像素），0表示不缩小
+HISTORY_BLOCK_CACHE_SIZE: 缓存多少条消息折叠后的markdown
+HISTORY_THUMBNAIL_BYTES: 缩小后的图片在内存中最多缓存多少字节
+"""
+import collections
+import io
+import os
+import threading
+from typing import Dict, Mapping, Optional, Tuple
+
+import streamlit as st
+
+from data_types import ImageMsg, Msg
+from image_cache import image_cache
+from message_store import MessageStore
+
+HISTORY_RENDER_RECENT = int(os.getenv("HISTORY_RENDER_RECENT", "50"))
+HISTORY_IMAGE_WIDTH = int(os.getenv("HISTORY_IMAGE_WIDTH", "768"))
+HISTORY_BLOCK_CACHE_SIZE = int(os.getenv("HISTORY_BLOCK_CACHE_SIZE", "20000"))
+HISTORY_THUMBNAIL_BYTES = int(os.getenv("HISTORY_THUMBNAIL_BYTES", str(32 * 1024 * 1024)))
+
+
+def _freeze(value) -> object:
+    """ 图片、描述可能是列表，转成可哈希的tuple """
+    return tuple(value) if isinstance(value, list) else value
+
+
+def message_key(msg: Msg) -> int:
+    """ 消息内容的哈希，内容相同的消息渲染结果相同 """
+    if msg["role"] == "image":
+        return hash((msg["role"], _freeze(msg["image"]), _freeze(msg.get("caption")), msg.get("local_image")))
+    # 内容字符串会缓存自己的哈希值，重复计算很快
+    return hash((msg["role"], msg["content"]))
+
+
+class HistoryView(object):
+    """
+    用法：
+    ```python
+    history_view.draw(st.session_state["history"], names={"assistant": "A", "user": "B"})
+    ```
+    """
+
+    def __init__(self, recent: int = HISTORY_RENDER_RECENT, image_width: int = HISTORY_IMAGE_WIDTH,
+                 block_cache_size: int = HISTORY_BLOCK_CACHE_SIZE, thumbnail_bytes: int = HISTORY_THUMBNAIL_BYTES):
+        self.recent = recent
+        self.image_width = image_width
+        self.block_cache_size = block_cache_size
+        self.thumbnail_bytes = thumbnail_bytes
+        self._lock = threading.Lock()
+        # (消息哈希, 角色名) -> 折叠后的markdown
+        self._blocks: "collections.OrderedDict[Tuple[int, str], str]" = collections.OrderedDict()
+        # 本地图片文件名 -> 缩小后的图片
+        self._thumbnails: "collections.OrderedDict[str, bytes]" = collections.OrderedDict()
+        self._thumbnail_size = 0
+
+    # ---------- 折叠的历史 ----------
+
+    def _block(self, msg: Msg, name: str) -> str:
+        key = (message_key(msg), name)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                return block
+        if msg["role"] == "image":
+            caption = msg.get("caption") or ""
+            if isinstance(caption, list):
+                caption = "；".join(caption)
+            block = f"*[图片] {caption}*"
+        else:
+            block = f"**{name}**：{msg['content']}"
+        with self._lock:
+            self._blocks[key] = block
+            while len(self._blocks) > self.block_cache_size:
+                self._blocks.popitem(last=False)
+        return block
+
+    def older_markdown(self, history: MessageStore, stop: int, names: Mapping[str, str]) -> str:
+        """ history[:stop]折叠成的一个markdown块 """
+        return "\n\n".join(self._block(history[i], names.get(history[i]["role"], ""))
+                           for i in range(stop))
+
+    # ---------- 图片 ----------
+
+    def _thumbnail(self, ref: str, content: bytes) -> bytes:
+        """ 缩小到image_width宽，已经足够小或无法解析时返回原图 """
+        with self._lock:
+            thumbnail = self._thumbnails.get(ref)
+            if thumbnail is not None:
+                self._thumbnails.move_to_end(ref)
+                return thumbnail
+
+        from PIL import Image
+
+        try:
+            image = Image.open(io.BytesIO(content))
+            if image.width <= self.image_width:
+                thumbnail = content
+            else:
+                image.thumbnail((self.image_width, image.height * self.image_width // image.width + 1))
+                buffer = io.BytesIO()
+                if image.mode in ("RGB", "L"):
+                    image.save(buffer, format="JPEG", quality=90)
+                else:
+                    image.save(buffer, format="PNG")
+                thumbnail = buffer.getvalue()
+        except Exception as e:
+            print(f"thumbnail failed: {ref}, {type(e).__name__}")
+            thumbnail = content
+
+        with self._lock:
+            if ref not in self._thumbnails:
+                self._thumbnails[ref] = thumbnail
+                self._thumbnail_size += len(thumbnail)
+                while self._thumbnail_size > self.thumbnail_bytes and len(self._thumbnails) > 1:
+                    _, evicted = self._thumbnails.popitem(last=False)
+                    self._thumbnail_size -= len(evicted)
+        return thumbnail
+
+    def resolve_image(self, msg: ImageMsg) -> Tuple[object, Optional[str]]:
+        """ 同image_cache.resolve，本地缓存的图片换成缩小后的 """
+        image, local_image = image_cache.resolve(msg)
+        if local_image and isinstance(image, bytes) and self.image_width:
+            image = self._thumbnail(local_image, image)
+        return image, local_image
+
+    # ---------- 渲染 ----------
+
+    def draw_message(self, history: MessageStore, index: int):
+        """ 渲染history[index]，图片下载到本地后把文件名记到消息上 """
+        msg = history[index]
+        if msg["role"] == "user":
+            with st.chat_message(name="user", avatar="user"):
+                st.markdown(msg["content"])
+        elif msg["role"] == "assistant":
+            with st.chat_message(name="assistant", avatar="assistant"):
+                st.markdown(msg["content"])
+        elif msg["role"] == "image":
+            # 已下载到本地的直接读取缓存，否则先展示远程url并在后台下载
+            image, local_image = self.resolve_image(msg)
+            if local_image and msg.get("local_image") != local_image:
+                # 换成新的消息对象（而不是原地修改），保存时会重新写入这条消息
+                msg = history[index] = ImageMsg(msg, local_image=local_image)
+            with st.chat_message(name="assistant", avatar="assistant"):
+                st.image(image, caption=msg.get("caption", None))
+        else:
+            raise Exception("Invalid role")
+
+    def draw(self, history: MessageStore, names: Optional[Mapping[str, str]] = None, key: str = "history"):
+        """
+        渲染对话历史，较早的消息默认折叠
+        :param names: 折叠后显示的角色名，{"assistant": ..., "user": ...}
+        :param key: 展开按钮的key，同一页面有多个对话历史时区分
+        """
+        start = max(0, len(history) - self.recent)
+        if start:
+            if st.checkbox(f"显示更早的{start}条消息", key=f"{key}_show_older"):
+                with st.container(border=True):
+                    st.markdown(self.older_markdown(history, start, names or {}))
+        for i in range(start, len(history)):
+            self.draw_message(history, i)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "blocks": len(self._blocks),
+                "thumbnails": len(self._thumbnails),
+                "thumbnail_bytes": self._thumbnail_size,
+            }
+
+
+history_view = HistoryView()
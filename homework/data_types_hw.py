@@ -1,17 +1,20 @@
 """
 相关数据类型的定义
 """
-from typing import Literal, TypedDict, List, Union, Optional, TYPE_CHECKING
+from typing import Literal, TypedDict, List, Union, Optional, Iterable
+import contextlib
 import dataclasses
+import gc
 
 import pydantic
+from typing_extensions import Annotated
 
 # pydantic 是一个 Python 库，用于数据解析和校验，它使用 Python 类型提示来验证数据。
 # pydantic 的核心功能是提供一个 BaseModel 类，用户可以继承这个类来创建自己的数据模型，并利用类型提示来指定数据类型和校验规则
 
-
-if TYPE_CHECKING:
-    import streamlit.elements.image
+# streamlit的ImageOrImageList还包括numpy数组、PIL图片等，pydantic无法校验，而且只在TYPE_CHECKING时导入，
+# 直接作为字段类型时模型无法完成定义（class-not-fully-defined）。对话历史中保存的只有url/本地路径或图片内容
+ImageData = Union[str, bytes, List[Union[str, bytes]]]
 
 
 class TextMsg(pydantic.BaseModel):
@@ -27,14 +30,17 @@ class TextMsg(pydantic.BaseModel):
 class ImageMsg(pydantic.BaseModel):
     """图片消息"""
     role: Literal["image"]
-    image: "streamlit.elements.image.ImageOrImageList"
+    image: ImageData
     """图片内容"""
     caption: Optional[Union[str, List[str]]]
     """说明文字"""
+    local_image: Optional[str] = None
+    """图片下载到本地缓存后的文件名"""
 
 
 # 定义一个类型别名，它是一个列表，列表中的元素是TextMsg或ImageMsg
-Msg = Union[TextMsg, ImageMsg]
+# 按role字段区分（discriminated union），校验时直接选中对应的模型，不用逐个尝试
+Msg = Annotated[Union[TextMsg, ImageMsg], pydantic.Field(discriminator="role")]
 
 # 定义一个类型别名，它是一个列表，列表中的元素是TextMsg
 TextMsgList = List[TextMsg]
@@ -61,7 +67,81 @@ def filter_text_msg(messages: MsgList) -> TextMsgList:
     :param messages:
     :return:
     """
-    return [m for m in messages if m["role"] != "image"]
+    return [m for m in messages if m.role != "image"]
+
+
+# 批量校验：TypeAdapter只构建一次校验器，整个列表在pydantic-core中一次校验完，
+# 比逐条调用TextMsg.model_validate少了每条消息在python层的调用开销
+MsgListAdapter = pydantic.TypeAdapter(MsgList)
+CharacterMetaListAdapter = pydantic.TypeAdapter(List[CharacterMeta])
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """
+    批量创建对象时暂停分代垃圾回收
+    一次创建上百万个模型会反复触发gc扫描所有存活对象，耗时可能超过校验本身；消息模型之间没有循环引用，暂停是安全的
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def validate_messages(messages: Iterable[dict]) -> MsgList:
+    """
+    校验一批dict格式的消息（如json.load得到的history）
+    :param messages:
+    :return:
+    """
+    with gc_paused():
+        return MsgListAdapter.validate_python(messages)
+
+
+def validate_messages_json(data: Union[str, bytes]) -> MsgList:
+    """
+    直接从json字节串解析并校验消息列表，不经过json.loads生成中间的dict
+    :param data: 如history.json中history字段的原始内容
+    :return:
+    """
+    with gc_paused():
+        return MsgListAdapter.validate_json(data)
+
+
+def validate_metas(metas: Iterable[dict]) -> List[CharacterMeta]:
+    """
+    校验一批人设，如数据集中每个对话的meta
+    :param metas:
+    :return:
+    """
+    with gc_paused():
+        return CharacterMetaListAdapter.validate_python(metas)
+
+
+def construct_messages(messages: Iterable[dict]) -> MsgList:
+    """
+    不做校验，直接构造模型，只用于可信的来源（如本程序自己写入的数据集）
+    字段缺失或类型错误时不会报错，调用方需自行保证数据正确。
+    注意pydantic 2中model_construct在python层逐个字段赋值，并不比validate_messages快（见benchmarks/bench_data_types.py），
+    只在数据不完全符合模型、又不想报错时使用
+    :param messages:
+    :return:
+    """
+    with gc_paused():
+        return [ImageMsg.model_construct(**m) if m["role"] == "image" else TextMsg.model_construct(**m)
+                for m in messages]
+
+
+def dump_messages_json(messages: MsgList) -> bytes:
+    """
+    把消息列表序列化成json字节串，与validate_messages_json互逆（没有设置过的可选字段如local_image不输出）
+    :param messages:
+    :return:
+    """
+    return MsgListAdapter.dump_json(messages, exclude_unset=True)
 
 
 # dataclasses 是 Python 3.7 引入的一个标准库，它提供了一种简洁的方式来自动生成特殊方法，
@@ -1,82 +1,11 @@
-import aiohttp
 import asyncio
 import os
-from typing import AsyncGenerator, Dict, TextIO, Optional
-from data_types import TextMsgList, CharacterMeta
-import jwt
-import time
+import sys
 
-# 智谱开放平台API key，参考 https://open.bigmodel.cn/usercenter/apikeys
-API_KEY: str = os.getenv("API_KEY", "")
+# 复用仓库根目录的异步api（async_api.py）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-
-def generate_token(apikey: str, exp_seconds: int) -> str:
-    """
-    生成智谱开放平台API的token
-    # reference: https://open.bigmodel.cn/dev/api#nosdk
-    :param apikey:
-    :param exp_seconds:
-    :return:
-    """
-
-    try:
-        id, secret = apikey.split(".")
-    except Exception as e:
-        raise Exception("invalid apikey", e)
-
-    payload = {
-        "api_key": id,
-        "exp": int(round(time.time() * 1000)) + exp_seconds * 1000,
-        "timestamp": int(round(time.time() * 1000)),
-    }
-
-    return jwt.encode(
-        payload,
-        secret,
-        algorithm="HS256",
-        headers={"alg": "HS256", "sign_type": "SIGN"},
-    )
-
-
-class ApiKeyNotSet(ValueError):
-    pass
-
-
-def verify_api_key_not_empty():
-    if not API_KEY:
-        raise ApiKeyNotSet
-
-
-async def get_characterglm_response(messages: TextMsgList, meta: CharacterMeta) -> AsyncGenerator[str, None]:
-    """ 通过http调用characterglm (异步版本) """
-    verify_api_key_not_empty()
-    url = "https://open.bigmodel.cn/api/paas/v3/model-api/charglm-3/sse-invoke"
-    headers = {
-        "Authorization": generate_token(API_KEY, 1800)
-    }
-    data = {
-        "model": "charglm-3",
-        "meta": meta,
-        "prompt": messages,
-        "incremental": True
-    }
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as resp:
-            resp.raise_for_status()
-            async for line in resp.content:
-                line = line.decode()
-                if not line or line.startswith(':'):
-                    continue
-                ret = line.split(':')
-                if len(ret) != 2:
-                    continue
-                field = ret[0]
-                value = ret[1]
-                if field == 'event':
-                    last_event = value.strip()
-                elif field == 'data' and last_event == 'add':
-                    yield value.strip()
+from async_api import get_characterglm_response, close_session
 
 
 async def characterglm_example():
@@ -92,8 +21,11 @@ async def characterglm_example():
         {"role": "user", "content": "（微信）怎么会呢？医生说你的病情已经好转了"}
     ]
 
-    async for response in get_characterglm_response(messages, character_meta):
-        print(response)
+    try:
+        async for response in get_characterglm_response(messages, character_meta):
+            print(response)
+    finally:
+        await close_session()
 
 
 if __name__ == '__main__':
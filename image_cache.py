@@ -0,0 +1,240 @@
+"""
+cogview图片的本地缓存
+
+cogview返回的是会过期的远程url，直接交给st.image时，每次rerun浏览器都要重新拉取一遍历史中的所有图片。
+这里在后台线程池中把图片下载到本地（同一url只下载一次），文件名为图片内容的sha256，
+之后从内存/磁盘读取，ImageMsg中记录本地文件名（local_image），保存的对话不再依赖远程url。
+
+内存和磁盘都按大小上限淘汰最久未使用的图片，可通过环境变量调整：
+IMAGE_CACHE_DIR: 缓存目录
+IMAGE_CACHE_MAX_BYTES: 磁盘缓存上限
+IMAGE_CACHE_MEMORY_BYTES: 内存缓存上限
+IMAGE_CACHE_WORKERS: 同时下载的图片数
+"""
+import collections
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import api
+from data_types import ImageMsg
+from retry import default_policy
+
+IMAGE_CACHE_DIR: str = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MAX_BYTES: int = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+IMAGE_CACHE_MEMORY_BYTES: int = int(os.getenv("IMAGE_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+IMAGE_CACHE_WORKERS: int = int(os.getenv("IMAGE_CACHE_WORKERS", "4"))
+# 下载失败（如url已过期）后，多久之内展示时不再重新下载（秒）
+FAILED_RETRY_INTERVAL = 300
+
+_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+
+
+def is_remote_image(image) -> bool:
+    return isinstance(image, str) and image.startswith(("http://", "https://"))
+
+
+class ImageCache(object):
+    """ 内容寻址的图片缓存，线程安全 """
+
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+                 memory_bytes: int = IMAGE_CACHE_MEMORY_BYTES, workers: int = IMAGE_CACHE_WORKERS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image_cache")
+        self._lock = threading.Lock()
+        # 本地文件名 -> 图片内容
+        self._memory: "collections.OrderedDict[str, bytes]" = collections.OrderedDict()
+        self._memory_size = 0
+        # 正在下载的url
+        self._pending: Dict[str, Future] = {}
+        # 已下载的url -> 本地文件名
+        self._refs: Dict[str, str] = {}
+        # 下载失败的url -> 失败时间
+        self._failed: Dict[str, float] = {}
+        # 启动时统计一次已有的缓存大小，之后增量维护
+        self._disk_size = sum(entry.stat().st_size for entry in self._scan())
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.downloads = 0
+        self.failures = 0
+
+    def local_path(self, ref: str) -> str:
+        return os.path.join(self.directory, ref)
+
+    def prefetch(self, url: str) -> Future:
+        """
+        在后台下载url，同一url同时只下载一次
+        :return: 结果为本地文件名的Future
+        """
+        with self._lock:
+            future = self._pending.get(url)
+            if future is None:
+                ref = self._refs.get(url)
+                if ref is not None and os.path.exists(self.local_path(ref)):
+                    future = Future()
+                    future.set_result(ref)
+                    return future
+                future = self._pending[url] = self._executor.submit(self._download, url)
+        return future
+
+    def fetch(self, url: str, timeout: Optional[float] = None) -> str:
+        """ 下载url并等待完成，返回本地文件名 """
+        return self.prefetch(url).result(timeout)
+
+    def _download(self, url: str) -> str:
+        try:
+            def request():
+                resp = api.get_http_session().get(url, timeout=api.HTTP_TIMEOUT)
+                resp.raise_for_status()
+                return resp
+
+            resp = default_policy.call(request)
+            content = resp.content
+            content_type = resp.headers.get("Content-Type", "").split(";")[0].strip()
+            ext = _EXTENSIONS.get(content_type) or os.path.splitext(url.split("?")[0])[1] or ".img"
+            ref = hashlib.sha256(content).hexdigest() + ext
+            path = self.local_path(ref)
+            if not os.path.exists(path):
+                os.makedirs(self.directory, exist_ok=True)
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+                with self._lock:
+                    self._disk_size += len(content)
+                    self._evict_disk(keep=ref)
+            with self._lock:
+                self._refs[url] = ref
+                self._remember(ref, content)
+                self.downloads += 1
+            return ref
+        except Exception:
+            with self._lock:
+                self.failures += 1
+                self._failed[url] = time.monotonic()
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(url, None)
+
+    def _scan(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith(".tmp")]
+
+    def _evict_disk(self, keep: str):
+        """ 超出上限时按最后访问时间删除，不删除刚写入的keep """
+        if self._disk_size <= self.max_bytes:
+            return
+        entries = sorted(self._scan(), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._disk_size <= self.max_bytes:
+                break
+            if entry.name == keep:
+                continue
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self._disk_size -= size
+            self._forget(entry.name)
+
+    def _remember(self, ref: str, content: bytes):
+        if len(content) > self.memory_bytes:
+            return
+        old = self._memory.pop(ref, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[ref] = content
+        self._memory_size += len(content)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _forget(self, ref: str):
+        content = self._memory.pop(ref, None)
+        if content is not None:
+            self._memory_size -= len(content)
+
+    def load(self, ref: str) -> Optional[bytes]:
+        """ 读取本地图片，不存在（如已被淘汰）时返回None """
+        content = self._load(ref)
+        if content is None:
+            with self._lock:
+                self.misses += 1
+        return content
+
+    def _load(self, ref: str) -> Optional[bytes]:
+        """ 同load，只统计命中，未命中由调用方统计（resolve中一次展示最多记一次未命中） """
+        with self._lock:
+            content = self._memory.get(ref)
+            if content is not None:
+                self._memory.move_to_end(ref)
+                self.memory_hits += 1
+                return content
+        path = self.local_path(ref)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            # 用mtime记录最后访问时间，磁盘淘汰时参考
+            os.utime(path)
+        except OSError:
+            return None
+        with self._lock:
+            self._remember(ref, content)
+            self.disk_hits += 1
+        return content
+
+    def resolve(self, msg: ImageMsg) -> Tuple[object, Optional[str]]:
+        """
+        取得图片消息用于展示的内容
+        本地有缓存时返回图片内容，否则返回原始的url并在后台开始下载（记一次未命中）
+        :return: (交给st.image的图片, 本地文件名)
+        """
+        ref = msg.get("local_image")
+        if ref:
+            content = self._load(ref)
+            if content is not None:
+                return content, ref
+        url = msg["image"]
+        if not is_remote_image(url):
+            return url, None
+        ref = self._refs.get(url)
+        if ref is not None:
+            content = self._load(ref)
+            if content is not None:
+                return content, ref
+        with self._lock:
+            self.misses += 1
+        failed_at = self._failed.get(url)
+        if failed_at is None or time.monotonic() - failed_at > FAILED_RETRY_INTERVAL:
+            self.prefetch(url)
+        return url, None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "downloads": self.downloads,
+                "failures": self.failures,
+                "pending": len(self._pending),
+                "memory_bytes": self._memory_size,
+                "disk_bytes": self._disk_size,
+            }
+
+
+image_cache = ImageCache()
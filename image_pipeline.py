@@ -0,0 +1,106 @@
+"""
+图片生成流水线：先用chatglm生成场景描写作为prompt，再调用cogview生成图片
+
+每次生成是一个在后台线程中执行的ImageJob，页面只需要轮询它的状态：
+- prompt: 正在生成prompt，ImageJob.prompt随流式输出不断变长
+- image: 正在调用cogview
+- done: 完成，ImageJob.image_url为图片url（已开始下载到本地缓存）
+- error: 失败，ImageJob.error为错误信息
+多个角色的图片在线程池中并行生成，不阻塞页面上的对话。
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from api import generate_chat_scene_prompt, generate_role_appearance, generate_cogview_image
+from context_window import SCENE_CONTEXT_BUDGET, context_window
+from data_types import TextMsgList, CharacterMeta
+from image_cache import image_cache
+
+logger = logging.getLogger(__name__)
+
+# 同时进行的图片生成任务数，实际调用频率还受scheduler.py中cogview-3的限额约束
+IMAGE_PIPELINE_WORKERS: int = int(os.getenv("IMAGE_PIPELINE_WORKERS", "4"))
+
+DEFAULT_IMAGE_STYLE = "二次元风格"
+
+
+class ImageJob(object):
+    """ 一次图片生成，状态由后台线程更新，页面只读 """
+
+    def __init__(self, name: str, messages: TextMsgList, meta: CharacterMeta, image_style: str,
+                 names: Optional[Tuple[str, str]] = None):
+        """
+        :param name: 任务名，如生成哪个角色的图片
+        :param messages: 对话历史，为空时只根据角色人设生成
+        :param meta: 图片中的角色为meta中的bot
+        :param image_style: 图片风格
+        :param names: 对话历史中(assistant的名字, user的名字)，用于复用对话的概要，默认取自meta
+        """
+        self.name = name
+        self.messages = messages
+        self.meta = meta
+        self.names = names or (meta["bot_name"], meta["user_name"])
+        self.image_style = image_style or DEFAULT_IMAGE_STYLE
+        self.status = "pending"
+        self.prompt = ""
+        self.image_url: Optional[str] = None
+        self.error: Optional[str] = None
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "error")
+
+    def run(self):
+        try:
+            self.status = "prompt"
+            if self.messages:
+                # 若有对话历史，则结合角色人设和对话历史生成图片
+                # 较早的对话用已有的概要代替，与对话请求共用同一份概要
+                context = context_window.build(self.messages, self.names, budget=SCENE_CONTEXT_BUDGET)
+                stream = generate_chat_scene_prompt(context.recent, meta=self.meta, summary=context.summary)
+            else:
+                # 若没有对话历史，则根据角色人设生成图片
+                stream = generate_role_appearance(self.meta["bot_info"])
+            chunks = []
+            for chunk in stream:
+                chunks.append(chunk)
+                self.prompt = "".join(chunks)
+            if not self.prompt:
+                self.error = "调用chatglm生成Cogview prompt出错"
+                self.status = "error"
+                return
+            self.prompt = f'生成风格: {self.image_style}。' + self.prompt.strip()
+            print(f"image_prompt = {self.prompt}")
+
+            self.status = "image"
+            self.image_url = generate_cogview_image(self.prompt)
+            # 在后台下载到本地，之后rerun时不再从远程拉取
+            image_cache.prefetch(self.image_url)
+            self.status = "done"
+        except Exception as e:
+            # 只记异常类型和状态码，异常的repr中可能带有请求头里的API_KEY
+            logger.warning("图片任务%s失败: %s %s", self.name, type(e).__name__, getattr(e, "status", ""))
+            self.error = "又失败啦，点击【生成图片】按钮可再次重试"
+            self.status = "error"
+        finally:
+            self.finished = time.monotonic()
+
+
+class ImagePipeline(object):
+    def __init__(self, workers: int = IMAGE_PIPELINE_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image_pipeline")
+
+    def submit(self, name: str, messages: TextMsgList, meta: CharacterMeta, image_style: str = "",
+               names: Optional[Tuple[str, str]] = None) -> ImageJob:
+        """ 提交一次图片生成，立即返回 """
+        job = ImageJob(name, messages, meta, image_style, names)
+        self._executor.submit(job.run)
+        return job
+
+
+image_pipeline = ImagePipeline()
@@ -0,0 +1,640 @@
+"""
+api调用的耗时与token统计
+
+api.py、async_api.py的每个入口都通过metrics.start_call开始一次调用记录：
+- 首token延迟（TTFT，从调用开始算，包含排队和重试）、token间隔、总耗时
+- 流式输出的token数和字节数（utf-8）
+- 重试次数、出错次数（按http状态码或异常类型）
+- 正在进行的调用数
+连接层另外记录DNS解析、TCP连接、TLS握手的耗时：
+- requests：InstrumentedHTTPAdapter替换urllib3的连接类
+- aiohttp：aiohttp_trace_config()，aiohttp不区分TCP连接和TLS握手，两者合计记为connect
+- zhipuai sdk（httpx）拿不到连接层的事件，只有调用层的统计
+
+流式循环中每个token只做一次计时和计数，token间隔先存在本次调用的局部列表里，结束时一次性加锁写入直方图。
+
+导出：
+- metrics.to_prometheus(): Prometheus文本格式
+- metrics.summary(): 按模型汇总的json
+- metrics.live(session): 供界面展示的实时统计，TTFT、tokens/s的分位数来自蓄水池采样，比直方图的插值准确；
+  通过metrics.bind_session绑定会话后，该会话的调用另外单独统计（不作为Prometheus标签，避免标签数无限增长）
+
+可通过环境变量调整：
+METRICS_ENABLED: 为no时不记录，start_call返回什么都不做的记录器
+METRICS_RESERVOIR_SIZE: 每个模型（每个会话）保留的样本数
+METRICS_MAX_SESSIONS: 最多单独统计多少个会话，超出时丢弃最久没有调用的会话
+"""
+import bisect
+import collections
+import contextvars
+import json
+import math
+import os
+import random
+import socket
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError
+
+from retry import get_status
+
+T = TypeVar("T")
+
+METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "yes").lower() in ("1", "yes", "y", "true", "t", "on")
+METRICS_RESERVOIR_SIZE = int(os.getenv("METRICS_RESERVOIR_SIZE", "1024"))
+METRICS_MAX_SESSIONS = int(os.getenv("METRICS_MAX_SESSIONS", "256"))
+
+# 调用耗时、首token延迟的直方图分桶（秒）
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# token间隔的分桶（秒）
+GAP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+# DNS/连接/TLS耗时的分桶（秒）
+CONNECT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram(object):
+    """ Prometheus风格的累计分桶直方图，非线程安全，由MetricsRegistry加锁 """
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """ 按分桶线性插值估算分位数，并限制在观测到的最小/最大值之间 """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                lower = max(lower, self.min)
+                upper = min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.max
+
+    def copy(self) -> "Histogram":
+        other = Histogram(self.buckets)
+        other.counts, other.sum, other.count = list(self.counts), self.sum, self.count
+        other.min, other.max = self.min, self.max
+        return other
+
+
+class Reservoir(object):
+    """ 蓄水池采样（Algorithm R），保留至多size个均匀抽样的样本，非线程安全 """
+
+    _random = random.Random()
+
+    def __init__(self, size: int = METRICS_RESERVOIR_SIZE):
+        self.size = size
+        self.samples: List[float] = []
+        self.count = 0
+
+    def add(self, value: float):
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            i = self._random.randrange(self.count)
+            if i < self.size:
+                self.samples[i] = value
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class LiveStats(object):
+    """ 一个模型（在一个会话中）的实时统计，非线程安全，由MetricsRegistry加锁 """
+
+    __slots__ = ("calls", "errors", "in_flight", "tokens", "stream_seconds", "ttft", "tokens_per_second",
+                 "last_call")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.tokens = 0
+        self.stream_seconds = 0.0
+        self.ttft = Reservoir()
+        self.tokens_per_second = Reservoir()
+        self.last_call = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "tokens": self.tokens,
+            "ttft_p50": self.ttft.quantile(0.5),
+            "ttft_p95": self.ttft.quantile(0.95),
+            "ttft_p99": self.ttft.quantile(0.99),
+            # 所有流式调用合计，以及单次调用的中位数
+            "tokens_per_second": self.tokens / self.stream_seconds if self.stream_seconds else 0.0,
+            "tokens_per_second_p50": self.tokens_per_second.quantile(0.5),
+        }
+
+
+# 当前绑定的会话id，CallRecorder创建时读取
+_current_session: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("metrics_session", default=None)
+
+
+class MetricsRegistry(object):
+    """ 进程内的指标，线程安全 """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (指标名, 标签) -> 值
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._gauges: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._help: Dict[str, Tuple[str, str]] = {}
+        # 模型 -> 全局的实时统计；会话id -> 模型 -> 该会话的实时统计，按最近调用排序
+        self._live: Dict[str, LiveStats] = {}
+        self._sessions: "collections.OrderedDict[str, Dict[str, LiveStats]]" = collections.OrderedDict()
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_gauge(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = LATENCY_BUCKETS, **labels: str):
+        self.observe_many(name, (value,), buckets, **labels)
+
+    def observe_many(self, name: str, values: Sequence[float], buckets: Sequence[float] = LATENCY_BUCKETS,
+                     **labels: str):
+        if not values:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            for value in values:
+                histogram.observe(value)
+
+    def start_call(self, model: str, endpoint: str) -> "CallRecorder":
+        """ 开始记录一次api调用 """
+        if not METRICS_ENABLED:
+            return _NULL_RECORDER
+        return CallRecorder(self, model, endpoint)
+
+    @staticmethod
+    def bind_session(session: Optional[str]):
+        """ 之后在当前线程（协程）中开始的调用计入该会话 """
+        _current_session.set(session)
+
+    def _live_stats(self, model: str, session: Optional[str]) -> List[LiveStats]:
+        """ 调用需要更新的实时统计：全局的，以及绑定了会话时该会话的，需要持有self._lock """
+        entries = [self._live.get(model) or self._live.setdefault(model, LiveStats())]
+        if session is not None:
+            models = self._sessions.get(session)
+            if models is None:
+                models = self._sessions[session] = {}
+                while len(self._sessions) > METRICS_MAX_SESSIONS:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session)
+            entries.append(models.get(model) or models.setdefault(model, LiveStats()))
+        return entries
+
+    def _live_begin(self, model: str, session: Optional[str]):
+        now = time.time()
+        with self._lock:
+            for stats in self._live_stats(model, session):
+                stats.calls += 1
+                stats.in_flight += 1
+                stats.last_call = now
+
+    def _live_end(self, model: str, session: Optional[str], failed: bool, first_token: Optional[float],
+                  tokens: int, stream_seconds: float):
+        with self._lock:
+            for stats in self._live_stats(model, session):
+                stats.in_flight -= 1
+                stats.errors += failed
+                if first_token is not None:
+                    stats.ttft.add(first_token)
+                    stats.tokens += tokens
+                    stats.stream_seconds += stream_seconds
+                    if stream_seconds > 0 and tokens > 1:
+                        stats.tokens_per_second.add(tokens / stream_seconds)
+
+    def live(self, session: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        按模型的实时统计，session为None时是全局的
+        {"charglm-3": {"calls": ..., "in_flight": ..., "ttft_p50": ..., "tokens_per_second": ..., ...}}
+        """
+        with self._lock:
+            if session is None:
+                models = self._live
+            else:
+                models = self._sessions.get(session, {})
+            return {model: stats.to_dict() for model, stats in models.items()}
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+            self._live.clear()
+            self._sessions.clear()
+
+    # ---------- 导出 ----------
+
+    def snapshot(self) -> Tuple[Dict, Dict, Dict]:
+        """ (counters, gauges, histograms)的副本 """
+        with self._lock:
+            histograms = {key: h.copy() for key, h in self._histograms.items()}
+            return dict(self._counters), dict(self._gauges), histograms
+
+    @staticmethod
+    def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+        items = list(labels) + ([extra] if extra else [])
+        if not items:
+            return ""
+        escaped = (k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                   for k, v in items)
+        return "{" + ",".join(escaped) + "}"
+
+    def to_prometheus(self) -> str:
+        """ Prometheus文本格式（text/plain; version=0.0.4） """
+        counters, gauges, histograms = self.snapshot()
+        lines: List[str] = []
+        described = set()
+
+        def header(name: str, kind: str):
+            if name in described:
+                return
+            described.add(name)
+            text = self._help.get(name, (kind, ""))[1]
+            if text:
+                lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+        for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(list(histogram.buckets) + [math.inf], histogram.counts):
+                cumulative += n
+                le = "+Inf" if bound == math.inf else f"{bound:g}"
+                lines.append(f"{name}_bucket{self._format_labels(labels, ('le', le))} {cumulative}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram.sum:g}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        按模型汇总：
+        {"models": {"charglm-3": {"calls": ..., "errors": ..., "ttft": {"p50": ..., ...}, ...}},
+         "connections": {"requests open.bigmodel.cn": {"dns": {...}, "connect": {...}, "tls": {...}}}}
+        """
+        counters, gauges, histograms = self.snapshot()
+        models: Dict[str, Dict[str, Any]] = {}
+        connections: Dict[str, Dict[str, Any]] = {}
+
+        def model_entry(labels: Labels) -> Dict[str, Any]:
+            model = dict(labels).get("model", "")
+            return models.setdefault(model, {
+                "calls": 0, "errors": 0, "retries": 0, "tokens": 0, "bytes": 0, "in_flight": 0,
+            })
+
+        short_names = {
+            "zhipu_calls_total": "calls", "zhipu_errors_total": "errors", "zhipu_retries_total": "retries",
+            "zhipu_stream_tokens_total": "tokens", "zhipu_stream_bytes_total": "bytes",
+        }
+        for (name, labels), value in counters.items():
+            if name in short_names:
+                entry = model_entry(labels)
+                entry[short_names[name]] += value
+        for (name, labels), value in gauges.items():
+            if name == "zhipu_in_flight":
+                model_entry(labels)["in_flight"] += value
+
+        for (name, labels), histogram in histograms.items():
+            stats = {
+                "count": histogram.count,
+                "avg": histogram.sum / histogram.count if histogram.count else 0.0,
+                "p50": histogram.quantile(0.5),
+                "p95": histogram.quantile(0.95),
+                "p99": histogram.quantile(0.99),
+            }
+            if name.startswith("http_"):
+                label_dict = dict(labels)
+                conn = connections.setdefault(f"{label_dict.get('client', '')} {label_dict.get('host', '')}", {})
+                conn[name[len("http_"):-len("_seconds")]] = stats
+            elif name.startswith("zhipu_"):
+                model_entry(labels)[name[len("zhipu_"):-len("_seconds")]] = stats
+
+        for entry in models.values():
+            # 所有流式调用的token总数 / 第一个token之后的总时长
+            duration = entry.get("stream_duration")
+            stream_time = duration["avg"] * duration["count"] if duration else 0.0
+            entry["tokens_per_second"] = entry["tokens"] / stream_time if stream_time else 0.0
+        return {"models": models, "connections": connections}
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), ensure_ascii=False, indent=2)
+
+
+class CallRecorder(object):
+    """ 一次api调用的记录，只在创建它的调用中使用 """
+
+    __slots__ = ("registry", "model", "endpoint", "session", "started", "first_token", "tokens", "bytes", "gaps",
+                 "retries", "failed", "_finished")
+
+    def __init__(self, registry: MetricsRegistry, model: str, endpoint: str):
+        self.registry = registry
+        self.model = model
+        self.endpoint = endpoint
+        self.session = _current_session.get()
+        self.started = time.perf_counter()
+        self.first_token: Optional[float] = None
+        self.tokens = 0
+        self.bytes = 0
+        self.gaps: List[float] = []
+        self.retries = 0
+        self.failed = False
+        self._finished = False
+        registry.inc("zhipu_calls_total", model=model, endpoint=endpoint)
+        registry.add_gauge("zhipu_in_flight", 1, model=model)
+        registry._live_begin(model, self.session)
+
+    def retry(self, exc: BaseException):
+        """ 作为RetryPolicy的on_retry回调 """
+        self.retries += 1
+        self.registry.inc("zhipu_retries_total", model=self.model, kind=_error_kind(exc))
+
+    def error(self, exc: BaseException):
+        self.failed = True
+        self.registry.inc("zhipu_errors_total", model=self.model, kind=_error_kind(exc))
+
+    def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        registry, model = self.registry, self.model
+        duration = time.perf_counter() - self.started
+        registry.add_gauge("zhipu_in_flight", -1, model=model)
+        registry.observe("zhipu_call_duration_seconds", duration, model=model)
+        if self.first_token is not None:
+            registry.observe("zhipu_ttft_seconds", self.first_token, model=model)
+            registry.observe("zhipu_stream_duration_seconds", duration - self.first_token, model=model)
+            registry.observe_many("zhipu_inter_token_seconds", self.gaps, GAP_BUCKETS, model=model)
+            registry.inc("zhipu_stream_tokens_total", self.tokens, model=model)
+            registry.inc("zhipu_stream_bytes_total", self.bytes, model=model)
+        stream_seconds = duration - self.first_token if self.first_token is not None else 0.0
+        registry._live_end(model, self.session, self.failed, self.first_token, self.tokens, stream_seconds)
+
+    def stream(self, chunks: Iterator[str]) -> Iterator[str]:
+        """ 包装流式输出，记录首token延迟、token间隔、token数和字节数 """
+        perf_counter = time.perf_counter
+        gaps = self.gaps
+        last = None
+        tokens = nbytes = 0
+        try:
+            for chunk in chunks:
+                now = perf_counter()
+                if last is None:
+                    self.first_token = now - self.started
+                else:
+                    gaps.append(now - last)
+                last = now
+                if chunk:
+                    tokens += 1
+                    nbytes += len(chunk.encode())
+                yield chunk
+        except Exception as e:
+            self.error(e)
+            raise
+        finally:
+            self.tokens, self.bytes = tokens, nbytes
+            self.finish()
+
+    async def astream(self, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+        """ stream的异步版本 """
+        perf_counter = time.perf_counter
+        gaps = self.gaps
+        last = None
+        tokens = nbytes = 0
+        try:
+            async for chunk in chunks:
+                now = perf_counter()
+                if last is None:
+                    self.first_token = now - self.started
+                else:
+                    gaps.append(now - last)
+                last = now
+                if chunk:
+                    tokens += 1
+                    nbytes += len(chunk.encode())
+                yield chunk
+        except Exception as e:
+            self.error(e)
+            raise
+        finally:
+            self.tokens, self.bytes = tokens, nbytes
+            self.finish()
+
+    def run(self, func: Callable[[], T]) -> T:
+        """ 记录一次非流式调用 """
+        try:
+            return func()
+        except Exception as e:
+            self.error(e)
+            raise
+        finally:
+            self.finish()
+
+    async def arun(self, func: Callable[[], Awaitable[T]]) -> T:
+        try:
+            return await func()
+        except Exception as e:
+            self.error(e)
+            raise
+        finally:
+            self.finish()
+
+
+class _NullRecorder(CallRecorder):
+    """ METRICS_ENABLED=no时使用，不做任何记录 """
+
+    def __init__(self):
+        pass
+
+    def retry(self, exc: BaseException):
+        pass
+
+    def stream(self, chunks: Iterator[str]) -> Iterator[str]:
+        return chunks
+
+    def astream(self, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+        return chunks
+
+    def run(self, func: Callable[[], T]) -> T:
+        return func()
+
+    async def arun(self, func: Callable[[], Awaitable[T]]) -> T:
+        return await func()
+
+
+_NULL_RECORDER = _NullRecorder()
+
+
+def _error_kind(exc: BaseException) -> str:
+    status = get_status(exc)
+    return str(status) if status is not None else type(exc).__name__
+
+
+metrics = MetricsRegistry()
+metrics.describe("zhipu_calls_total", "counter", "api调用次数")
+metrics.describe("zhipu_errors_total", "counter", "最终失败的api调用次数")
+metrics.describe("zhipu_retries_total", "counter", "重试次数")
+metrics.describe("zhipu_in_flight", "gauge", "正在进行的api调用数")
+metrics.describe("zhipu_call_duration_seconds", "histogram", "api调用的总耗时")
+metrics.describe("zhipu_ttft_seconds", "histogram", "从调用开始到收到第一个token的时间，包含排队和重试")
+metrics.describe("zhipu_stream_duration_seconds", "histogram", "第一个token到流结束的时间")
+metrics.describe("zhipu_inter_token_seconds", "histogram", "相邻两个token的间隔")
+metrics.describe("zhipu_stream_tokens_total", "counter", "流式输出的token（chunk）数")
+metrics.describe("zhipu_stream_bytes_total", "counter", "流式输出的字节数（utf-8）")
+metrics.describe("http_dns_seconds", "histogram", "DNS解析耗时")
+metrics.describe("http_connect_seconds", "histogram", "TCP连接耗时（aiohttp包含TLS握手）")
+metrics.describe("http_tls_seconds", "histogram", "TLS握手耗时")
+
+
+# ---------- requests（urllib3）的连接层计时 ----------
+
+class _TimedConnectionMixin(object):
+    """ 先单独解析域名并计时，再用解析出的地址逐个尝试连接 """
+
+    _connect_time = 0.0
+
+    def _new_conn(self):
+        host = self._dns_host
+        started = time.perf_counter()
+        try:
+            infos = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)
+        except OSError:
+            # 交给urllib3按原有方式抛出NameResolutionError
+            return super()._new_conn()
+        resolved = time.perf_counter()
+        last_exc: Optional[Exception] = None
+        sock = None
+        for info in infos:
+            self._dns_host = info[4][0]
+            try:
+                sock = super()._new_conn()
+                break
+            except ConnectTimeoutError as e:
+                last_exc = e
+            finally:
+                self._dns_host = host
+        if sock is None:
+            raise last_exc
+        connected = time.perf_counter()
+        self._connect_time = connected - started
+        metrics.observe("http_dns_seconds", resolved - started, CONNECT_BUCKETS, client="requests", host=self.host)
+        metrics.observe("http_connect_seconds", connected - resolved, CONNECT_BUCKETS,
+                        client="requests", host=self.host)
+        return sock
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        tls = time.perf_counter() - started - self._connect_time
+        metrics.observe("http_tls_seconds", tls, CONNECT_BUCKETS, client="requests", host=self.host)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class InstrumentedHTTPAdapter(HTTPAdapter):
+    """ 记录新建连接的DNS/TCP/TLS耗时的HTTPAdapter，复用的keep-alive连接不产生记录 """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+# ---------- aiohttp的连接层计时 ----------
+
+def aiohttp_trace_config():
+    """ 记录aiohttp新建连接的DNS和连接耗时，传给ClientSession(trace_configs=[...]) """
+    import aiohttp
+
+    async def on_dns_start(session, ctx, params):
+        ctx.dns_started = time.perf_counter()
+
+    async def on_dns_end(session, ctx, params):
+        ctx.dns_time = time.perf_counter() - ctx.dns_started
+        metrics.observe("http_dns_seconds", ctx.dns_time, CONNECT_BUCKETS, client="aiohttp", host=params.host)
+
+    async def on_request_start(session, ctx, params):
+        ctx.host = params.url.host
+
+    async def on_connection_start(session, ctx, params):
+        ctx.connect_started = time.perf_counter()
+        ctx.dns_time = 0.0
+
+    async def on_connection_end(session, ctx, params):
+        # 连接过程包含DNS解析，减去单独记录的部分（命中aiohttp的DNS缓存时为0）
+        elapsed = time.perf_counter() - ctx.connect_started - ctx.dns_time
+        metrics.observe("http_connect_seconds", elapsed, CONNECT_BUCKETS, client="aiohttp", host=ctx.host)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_dns_resolvehost_start.append(on_dns_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_end)
+    trace_config.on_connection_create_start.append(on_connection_start)
+    trace_config.on_connection_create_end.append(on_connection_end)
+    return trace_config
@@ -0,0 +1,168 @@
+"""
+批量生成对话的任务库（SQLite），每生成一条消息就写入一次检查点
+
+对话任务按输入（两个角色的人设、开场话题、轮数）的哈希去重，相同的任务只生成一次。
+进程崩溃或被杀后重新运行：已完成的任务直接跳过，未完成的从最后一条写入的消息继续，
+已经生成（已付费）的消息不会重新请求。
+
+- jobs: 任务的输入、状态（pending/running/done/failed）、尝试次数、最后一次的错误
+- turns: 每个任务已生成的消息，(job_id, index)为主键，同一条消息重新生成时覆盖
+
+WAL模式、synchronous=NORMAL：每条检查点是一个事务，进程被杀不会丢失已提交的消息，
+只有断电时可能丢失最后几条（重新生成即可）。
+
+用法：
+```python
+job_store = JobStore("output/dialogues.jobs.sqlite3")
+job_id = job_store.add(job, rounds=5)
+job, rounds, history = job_store.load(job_id)
+```
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Mapping, Optional, Set, Tuple
+
+from data_types import Msg, MsgList
+
+# 任务的状态
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# 参与哈希的任务字段，人设来源素材、图片风格等不影响生成的对话
+KEY_FIELDS = ("bot_a_name", "bot_a_info", "bot_b_name", "bot_b_info", "topic")
+
+
+def job_key(job: Mapping, rounds: int) -> str:
+    """ 任务输入的哈希，作为job_id """
+    payload = json.dumps({"job": {key: job.get(key, "") for key in KEY_FIELDS}, "rounds": rounds},
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+class JobStore(object):
+    """ 线程安全，run_batch在事件循环线程中同步写入，单条检查点在毫秒以内 """
+
+    def __init__(self, path: str):
+        """
+        :param path: SQLite文件路径，不存在时创建
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, job TEXT NOT NULL, rounds INTEGER NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, created REAL NOT NULL, updated REAL NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS turns ("
+            "job_id TEXT NOT NULL, idx INTEGER NOT NULL, message TEXT NOT NULL, PRIMARY KEY (job_id, idx))")
+
+    # ---------- 任务 ----------
+
+    def add(self, job: Mapping, rounds: int) -> str:
+        """
+        添加任务，已有相同输入的任务时不重复添加
+        :return: job_id
+        """
+        job_id = job_key(job, rounds)
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO jobs (job_id, job, rounds, status, created, updated) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             (job_id, json.dumps(dict(job), ensure_ascii=False), rounds, PENDING, now, now))
+        return job_id
+
+    def status(self, job_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def job_ids(self, status: Optional[str] = None) -> Set[str]:
+        with self._lock:
+            if status is None:
+                rows = self._db.execute("SELECT job_id FROM jobs").fetchall()
+            else:
+                rows = self._db.execute("SELECT job_id FROM jobs WHERE status = ?", (status,)).fetchall()
+        return {row[0] for row in rows}
+
+    def load(self, job_id: str) -> Tuple[Dict, int, MsgList]:
+        """
+        :return: (任务, 轮数, 已生成的消息)
+        """
+        with self._lock:
+            row = self._db.execute("SELECT job, rounds FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                raise KeyError(job_id)
+            turns = self._db.execute("SELECT message FROM turns WHERE job_id = ? ORDER BY idx",
+                                     (job_id,)).fetchall()
+        return json.loads(row[0]), row[1], [json.loads(message) for message, in turns]
+
+    def history(self, job_id: str) -> MsgList:
+        return self.load(job_id)[2]
+
+    # ---------- 进度 ----------
+
+    def begin(self, job_id: str):
+        """ 开始（或重新开始）生成，记一次尝试 """
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, updated = ? WHERE job_id = ?",
+                             (RUNNING, time.time(), job_id))
+
+    def checkpoint(self, job_id: str, index: int, message: Msg):
+        """ 第index条消息生成完成 """
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute("INSERT OR REPLACE INTO turns VALUES (?, ?, ?)",
+                                 (job_id, index, json.dumps(message, ensure_ascii=False)))
+                # 重新生成第index条时，丢弃它之后的旧消息
+                self._db.execute("DELETE FROM turns WHERE job_id = ? AND idx > ?", (job_id, index))
+                self._db.execute("UPDATE jobs SET updated = ? WHERE job_id = ?", (time.time(), job_id))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def finish(self, job_id: str):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = ?, error = NULL, updated = ? WHERE job_id = ?",
+                             (DONE, time.time(), job_id))
+
+    def fail(self, job_id: str, error: str):
+        """ 已生成的消息保留，下次运行时继续 """
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = ?, error = ?, updated = ? WHERE job_id = ?",
+                             (FAILED, error, time.time(), job_id))
+
+    def turns(self, job_id: str) -> int:
+        """ 已生成的消息数 """
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM turns WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counts = dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            turns = self._db.execute("SELECT COUNT(*) FROM turns").fetchone()[0]
+        return {"jobs": sum(counts.values()), **{status: counts.get(status, 0)
+                                                 for status in (PENDING, RUNNING, DONE, FAILED)}, "turns": turns}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
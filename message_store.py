@@ -0,0 +1,263 @@
+"""
+紧凑的对话历史存储
+
+对话历史原先是TypedDict组成的list，每条文本消息都是一个完整的dict（2个键时约200字节，还不算内容本身），
+filter_text_msg每轮对话、每次生成图片都要复制一遍整个列表。长时间的对话里这两部分都随轮数线性增长。
+
+MessageStore按列存储：
+- 每条消息一个字节的类型码（user/assistant/其他），和它在对应列中的下标
+- 文本消息只保存内容字符串和一个字节的role，不再为每条消息创建dict
+- 图片等其他消息原样保存（保持对象身份，collect_new_images等按对象比较的逻辑不受影响）
+
+text_view()返回文本消息的只读视图，不复制任何数据，替代filter_text_msg。
+视图创建时记下文本消息的条数，之后追加的消息对它不可见；删除、替换文本消息时整列复制一份新的（写时复制），
+已创建的视图仍指向旧的列。所以视图可以安全地交给后台线程（如图片生成、概要），追加消息的常见路径不产生任何复制。
+
+读取单条消息、to_list()时按需构造与原先相同的dict，保存的json格式不变。
+"""
+from array import array
+from typing import Iterable, Iterator, List, MutableSequence, Optional, Sequence, Union, overload
+
+from data_types import Msg, MsgList, TextMsg, TextMsgList
+
+ROLE_USER = 0
+ROLE_ASSISTANT = 1
+ROLE_OTHER = 2
+TEXT_ROLES = ("user", "assistant")
+ROLE_CODES = {"user": ROLE_USER, "assistant": ROLE_ASSISTANT}
+
+
+def _is_compact_text(msg: Msg) -> bool:
+    """ 只有role和content两个字段的文本消息按列存储，其他消息原样保存 """
+    return msg["role"] in ROLE_CODES and len(msg) == 2 and "content" in msg
+
+
+class TextView(Sequence[TextMsg]):
+    """
+    文本消息的只读视图，读取、切片、比较的行为与filter_text_msg返回的list相同
+    视图本身不能直接json序列化，要发给接口时先交给context_window.build，或切片/list()得到list
+    """
+
+    __slots__ = ("_roles", "_contents", "_start", "_stop")
+
+    def __init__(self, roles: array, contents: List[str], start: int = 0, stop: Optional[int] = None):
+        self._roles = roles
+        self._contents = contents
+        self._start = start
+        self._stop = len(contents) if stop is None else stop
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+    @overload
+    def __getitem__(self, index: int) -> TextMsg: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> TextMsgList: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # 与list相同，切片得到新的list（切出来的部分通常就是要发送的内容）
+            start, stop, step = index.indices(len(self))
+            return [self._make(self._start + i) for i in range(start, stop, step)]
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("TextView index out of range")
+        return self._make(self._start + index)
+
+    def _make(self, i: int) -> TextMsg:
+        return TextMsg(role=TEXT_ROLES[self._roles[i]], content=self._contents[i])
+
+    def __iter__(self) -> Iterator[TextMsg]:
+        roles, contents = self._roles, self._contents
+        for i in range(self._start, self._stop):
+            yield TextMsg(role=TEXT_ROLES[roles[i]], content=contents[i])
+
+    def contents(self) -> Iterator[str]:
+        """ 只遍历内容，不构造dict """
+        for i in range(self._start, self._stop):
+            yield self._contents[i]
+
+    def view(self, start: int = 0, stop: Optional[int] = None) -> "TextView":
+        """ 不复制的子视图 """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        return TextView(self._roles, self._contents, self._start + start, self._start + max(start, stop))
+
+    def to_list(self) -> TextMsgList:
+        return list(self)
+
+    def __add__(self, other: Iterable[TextMsg]) -> TextMsgList:
+        return list(self) + list(other)
+
+    def __radd__(self, other: Iterable[TextMsg]) -> TextMsgList:
+        return list(other) + list(self)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, (TextView, list)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self) -> str:
+        return f"TextView({self.to_list()!r})"
+
+
+class MessageStore(MutableSequence[Msg]):
+    """
+    按列存储的对话历史，可直接替换原先的MsgList：
+    ```python
+    history = MessageStore(meta["history"])
+    history.append(TextMsg({"role": "user", "content": query}))
+    context = context_window.build(history.text_view(), (meta["bot_name"], meta["user_name"]))
+    get_characterglm_response(context.messages, meta)
+    json.dump(history.to_list(), f)
+    ```
+    """
+
+    def __init__(self, messages: Iterable[Msg] = ()):
+        self._clear()
+        self.extend(messages)
+
+    def _clear(self):
+        # 每条消息：类型码，以及在_contents或_others中的下标
+        self._kinds = array("b")
+        self._slots = array("l")
+        # 文本消息的列
+        self._text_roles = array("b")
+        self._contents: List[str] = []
+        # 其他消息（图片等）原样保存
+        self._others: List[Msg] = []
+
+    def __len__(self) -> int:
+        return len(self._kinds)
+
+    def _make(self, i: int) -> Msg:
+        slot = self._slots[i]
+        if self._kinds[i] == ROLE_OTHER:
+            return self._others[slot]
+        return TextMsg(role=TEXT_ROLES[self._text_roles[slot]], content=self._contents[slot])
+
+    @overload
+    def __getitem__(self, index: int) -> Msg: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> MsgList: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._make(i) for i in range(*index.indices(len(self)))]
+        return self._make(self._index(index))
+
+    def _index(self, index: int) -> int:
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("MessageStore index out of range")
+        return index
+
+    def __iter__(self) -> Iterator[Msg]:
+        for i in range(len(self)):
+            yield self._make(i)
+
+    def append(self, msg: Msg):
+        if _is_compact_text(msg):
+            self._kinds.append(ROLE_CODES[msg["role"]])
+            self._slots.append(len(self._contents))
+            self._text_roles.append(ROLE_CODES[msg["role"]])
+            self._contents.append(msg["content"])
+        else:
+            self._kinds.append(ROLE_OTHER)
+            self._slots.append(len(self._others))
+            self._others.append(msg)
+
+    def extend(self, messages: Iterable[Msg]):
+        for msg in messages:
+            self.append(msg)
+
+    def __setitem__(self, index, msg):
+        if isinstance(index, slice):
+            messages = self[:]
+            messages[index] = msg
+            self._rebuild(messages)
+            return
+        index = self._index(index)
+        if self._kinds[index] == ROLE_OTHER and not _is_compact_text(msg):
+            # 替换图片消息（如记录本地缓存的文件名）不涉及文本列
+            self._others[self._slots[index]] = msg
+            return
+        messages = self[:]
+        messages[index] = msg
+        self._rebuild(messages)
+
+    def __delitem__(self, index):
+        if not isinstance(index, slice):
+            index = self._index(index)
+            if index == len(self) - 1:
+                self._pop_last()
+                return
+            if self._kinds[index] == ROLE_OTHER:
+                # 删除图片消息（如重新生成时替换末尾的图片）不涉及文本列
+                del self._others[self._slots[index]]
+                del self._kinds[index]
+                del self._slots[index]
+                for i in range(index, len(self)):
+                    if self._kinds[i] == ROLE_OTHER:
+                        self._slots[i] -= 1
+                return
+        messages = self[:]
+        del messages[index]
+        self._rebuild(messages)
+
+    def _pop_last(self):
+        kind = self._kinds.pop()
+        self._slots.pop()
+        if kind == ROLE_OTHER:
+            self._others.pop()
+        else:
+            # 写时复制，已创建的视图不受影响
+            self._text_roles = self._text_roles[:-1]
+            self._contents = self._contents[:-1]
+
+    def insert(self, index: int, msg: Msg):
+        if index >= len(self):
+            self.append(msg)
+            return
+        messages = self[:]
+        messages.insert(index, msg)
+        self._rebuild(messages)
+
+    def clear(self):
+        self._clear()
+
+    def _rebuild(self, messages: MsgList):
+        """ 重新建立所有列，已创建的视图仍指向旧的列 """
+        self._clear()
+        self.extend(messages)
+
+    def text_view(self) -> TextView:
+        """ 所有文本消息的只读视图，替代filter_text_msg，不复制 """
+        return TextView(self._text_roles, self._contents)
+
+    def copy(self) -> "MessageStore":
+        """ 浅复制，只复制各列，不复制内容字符串 """
+        store = MessageStore.__new__(MessageStore)
+        store._kinds = array("b", self._kinds)
+        store._slots = array("l", self._slots)
+        store._text_roles = array("b", self._text_roles)
+        store._contents = list(self._contents)
+        store._others = list(self._others)
+        return store
+
+    def to_list(self) -> MsgList:
+        """ 转成原先的list格式，用于保存为json """
+        return list(self)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, (MessageStore, list)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self) -> str:
+        return f"MessageStore({self.to_list()!r})"
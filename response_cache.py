@@ -0,0 +1,203 @@
+"""
+chatglm辅助调用（人设、外貌描写、场景描写）的响应缓存
+
+相同的模型和prompt得到相同的缓存键（sha256），重复点击"生成角色人设"、"生成图片"时直接复用上一次的结果。
+两级缓存：
+- 内存：LRU，按条数淘汰
+- 磁盘（可选）：SQLite，按总大小淘汰最久未访问的条目，进程重启后仍然有效
+两级都有过期时间（TTL）。
+
+可通过环境变量调整：
+RESPONSE_CACHE_SIZE: 内存中缓存的条数，0表示不缓存
+RESPONSE_CACHE_TTL: 过期时间（秒）
+RESPONSE_CACHE_PATH: SQLite文件路径，为空时只用内存
+RESPONSE_CACHE_MAX_BYTES: 磁盘缓存的总大小上限
+"""
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from data_types import TextMsgList
+
+RESPONSE_CACHE_SIZE: int = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL: float = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_PATH: str = os.getenv("RESPONSE_CACHE_PATH", "")
+RESPONSE_CACHE_MAX_BYTES: int = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+def make_key(model: str, messages: TextMsgList) -> str:
+    """ 模型和prompt的内容哈希 """
+    payload = json.dumps({"model": model, "messages": messages}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache(object):
+    """ 线程安全的两级响应缓存 """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 path: Optional[str] = RESPONSE_CACHE_PATH or None, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        """
+        :param max_entries: 内存中缓存的条数，0表示不缓存（同时也不用磁盘缓存）
+        :param ttl: 过期时间（秒）
+        :param path: SQLite文件路径，None表示只用内存
+        :param max_bytes: 磁盘缓存的总大小上限
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (过期时间, 值)
+        self._memory: "collections.OrderedDict[str, Tuple[float, str]]" = collections.OrderedDict()
+        self.path = path if max_entries else None
+        self._db: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    def _database(self) -> Optional[sqlite3.Connection]:
+        """ 在持有锁时调用：第一次用到磁盘缓存时才打开（不存在时创建）SQLite文件，只import不会产生文件 """
+        if self._db is None and self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expire_at REAL NOT NULL, "
+                "accessed REAL NOT NULL, size INTEGER NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._db = db
+        return self._db
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                if item[0] > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                del self._memory[key]
+            db = self._database()
+            if db is not None:
+                row = db.execute("SELECT value, expire_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, expire_at = row
+                    if expire_at > now:
+                        db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                        self._remember(key, expire_at, value)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return value
+                    db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.misses += 1
+            return None
+
+    def peek(self, key: str) -> Optional[str]:
+        """ 只查看有没有未过期的值：不计入命中率，不调整LRU顺序和磁盘缓存的访问时间 """
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None and item[0] > now:
+                return item[1]
+            db = self._database()
+            if db is not None:
+                row = db.execute("SELECT value FROM responses WHERE key = ? AND expire_at > ?", (key, now)).fetchone()
+                if row is not None:
+                    return row[0]
+        return None
+
+    def _remember(self, key: str, expire_at: float, value: str):
+        self._memory[key] = (expire_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def put(self, key: str, value: str):
+        if not self.enabled:
+            return
+        now = time.time()
+        expire_at = now + self.ttl
+        with self._lock:
+            self._remember(key, expire_at, value)
+            db = self._database()
+            if db is not None:
+                db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                 (key, value, expire_at, now, len(value.encode())))
+                self._evict_disk(now)
+
+    def _evict_disk(self, now: float):
+        """ 先删过期的，总大小仍超出上限时按最久未访问的顺序删除 """
+        self._db.execute("DELETE FROM responses WHERE expire_at <= ?", (now,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            db = self._database()
+            if db is not None:
+                db.execute("DELETE FROM responses")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            db = self._database()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": db.execute("SELECT COUNT(*) FROM responses").fetchone()[0] if db is not None else 0,
+            }
+
+    def cached_call(self, key: str, func: Callable[[], str]) -> str:
+        """ 命中时直接返回，否则调用func并缓存非空结果 """
+        value = self.get(key)
+        if value is None:
+            value = func()
+            if value:
+                self.put(key, value)
+        return value
+
+    def cached_stream(self, key: str, make_stream: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """
+        流式调用的缓存：命中时一次性产出完整文本；
+        未命中时边产出边收集，流正常读完后缓存拼接的文本（中途出错或被放弃的不缓存）
+        """
+        value = self.get(key)
+        if value is not None:
+            yield value
+            return
+        chunks = []
+        for chunk in make_stream():
+            if chunk:
+                chunks.append(chunk)
+            yield chunk
+        if chunks:
+            self.put(key, "".join(chunks))
+
+
+response_cache = ResponseCache()
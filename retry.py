@@ -0,0 +1,234 @@
+"""
+模型调用的重试策略
+
+只重试暂时性的错误：429、5xx等状态码，以及连接失败、超时等传输层错误；鉴权失败、参数错误等直接抛出。
+两次重试之间按指数退避并加随机抖动（full jitter），服务端返回Retry-After时按它等待；
+所有尝试加起来不超过deadline秒，超出时放弃并抛出最后一次的错误。
+
+流式请求只在收到第一个token之前重试，已经输出的内容无法撤回，之后的错误直接抛出。
+
+同时支持requests、aiohttp和zhipuai sdk抛出的异常，按属性识别，不依赖具体的库。
+"""
+import asyncio
+import email.utils
+import functools
+import logging
+import os
+import random
+import time
+from typing import AsyncGenerator, Awaitable, Callable, FrozenSet, Generator, Iterator, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 可重试的http状态码
+RETRY_STATUSES: FrozenSet[int] = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+
+@functools.lru_cache(maxsize=None)
+def _transport_errors() -> Tuple[type, ...]:
+    """ 各http库的连接/超时错误，只收集已安装的库 """
+    errors = [ConnectionError, TimeoutError, asyncio.TimeoutError]
+    try:
+        import requests
+        errors += [requests.ConnectionError, requests.Timeout]
+    except ImportError:
+        pass
+    try:
+        import aiohttp
+        errors += [aiohttp.ClientConnectionError, aiohttp.ClientPayloadError]
+    except ImportError:
+        pass
+    try:
+        import httpx
+        errors.append(httpx.TransportError)
+    except ImportError:
+        pass
+    try:
+        from zhipuai import APITimeoutError
+        errors.append(APITimeoutError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+def get_status(exc: BaseException) -> Optional[int]:
+    """ 异常对应的http状态码，没有时返回None """
+    # aiohttp.ClientResponseError.status / zhipuai.APIStatusError.status_code / requests.HTTPError.response
+    for attr in ("status_code", "status"):
+        status = getattr(exc, attr, None)
+        if isinstance(status, int):
+            return status
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def get_retry_after(exc: BaseException) -> Optional[float]:
+    """ 解析响应头中的Retry-After（秒数或http日期），没有时返回None """
+    headers = getattr(exc, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(exc, "response", None), "headers", None)
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy(object):
+    """
+    ```python
+    policy = RetryPolicy(max_attempts=4, deadline=60)
+    result = policy.call(send_request, payload)
+    for chunk in policy.stream(lambda: open_stream(payload)):
+        ...
+    ```
+    """
+
+    def __init__(self, max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 8.0,
+                 deadline: Optional[float] = 60.0, retry_statuses: FrozenSet[int] = RETRY_STATUSES):
+        """
+        :param max_attempts: 最多尝试几次（含第一次）
+        :param base_delay: 第一次重试前退避的上限（秒），之后每次翻倍
+        :param max_delay: 单次退避的上限（秒）
+        :param deadline: 从第一次尝试开始的总时间预算（秒），None表示不限制
+        :param retry_statuses: 可重试的http状态码
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_statuses = retry_statuses
+
+    def is_retryable(self, exc: BaseException) -> bool:
+        status = get_status(exc)
+        if status is not None:
+            return status in self.retry_statuses
+        return isinstance(exc, _transport_errors())
+
+    def backoff(self, attempt: int) -> float:
+        """ 第attempt次失败后的退避时间，在[0, min(max_delay, base_delay * 2^attempt))中随机取 """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def next_delay(self, attempt: int, exc: BaseException, started: float,
+                   on_retry: Optional[Callable[[BaseException], None]] = None) -> Optional[float]:
+        """
+        :param attempt: 已经失败的次数-1
+        :param exc: 本次失败的异常
+        :param started: 第一次尝试的时间（time.monotonic）
+        :param on_retry: 决定重试时调用，如记录重试次数（见instrumentation.py）
+        :return: 重试前等待的秒数，None表示不再重试
+        """
+        if attempt + 1 >= self.max_attempts or not self.is_retryable(exc):
+            return None
+        delay = get_retry_after(exc)
+        if delay is None:
+            delay = self.backoff(attempt)
+        if self.deadline is not None and time.monotonic() - started + delay > self.deadline:
+            return None
+        # 不打印异常本身：aiohttp的异常里带着请求头（含鉴权token）
+        logger.warning("第%d次请求失败（%s），%.2f秒后重试", attempt + 1, get_status(exc) or type(exc).__name__, delay)
+        if on_retry is not None:
+            on_retry(exc)
+        return delay
+
+    def call(self, func: Callable[..., T], *args, on_retry: Optional[Callable[[BaseException], None]] = None,
+             **kwargs) -> T:
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                delay = self.next_delay(attempt, e, started, on_retry)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, func: Callable[..., Awaitable[T]], *args,
+                    on_retry: Optional[Callable[[BaseException], None]] = None, **kwargs) -> T:
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                delay = self.next_delay(attempt, e, started, on_retry)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stream(self, make_stream: Callable[[], Generator[T, None, None]],
+               on_retry: Optional[Callable[[BaseException], None]] = None) -> Iterator[T]:
+        """
+        流式请求的重试，只在产出第一个元素之前重试
+        :param make_stream: 每次尝试调用一次，返回新的流
+        :param on_retry: 同next_delay
+        :return:
+        """
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            stream = make_stream()
+            try:
+                first = next(stream)
+            except StopIteration:
+                return
+            except Exception as e:
+                delay = self.next_delay(attempt, e, started, on_retry)
+                if delay is None:
+                    raise
+            else:
+                break
+            time.sleep(delay)
+            attempt += 1
+        try:
+            yield first
+            yield from stream
+        finally:
+            # 调用方提前退出时及时关闭底层连接
+            stream.close()
+
+    async def astream(self, make_stream: Callable[[], AsyncGenerator[T, None]],
+                      on_retry: Optional[Callable[[BaseException], None]] = None) -> AsyncGenerator[T, None]:
+        """ stream的异步版本 """
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            stream = make_stream()
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                delay = self.next_delay(attempt, e, started, on_retry)
+                if delay is None:
+                    raise
+            else:
+                break
+            await asyncio.sleep(delay)
+            attempt += 1
+        try:
+            yield first
+            async for item in stream:
+                yield item
+        finally:
+            await stream.aclose()
+
+
+# 默认策略，可通过环境变量调整
+default_policy = RetryPolicy(
+    max_attempts=int(os.getenv("RETRY_MAX_ATTEMPTS", "4")),
+    base_delay=float(os.getenv("RETRY_BASE_DELAY", "0.5")),
+    max_delay=float(os.getenv("RETRY_MAX_DELAY", "8")),
+    deadline=float(os.getenv("RETRY_DEADLINE", "60")),
+)
@@ -0,0 +1,298 @@
+"""
+模型调用的限流调度
+
+每个模型一条通道：令牌桶限制每秒请求数（rps/burst），信号量限制同时进行的请求数（max_concurrency）。
+排队的请求按优先级放行，交互式的对话（INTERACTIVE）总是先于后台的图片、人设生成（BACKGROUND），
+同一优先级先到先得。同步（线程）和异步（协程）调用共用同一套通道状态。
+排队的请求不轮询：释放并发名额、调整限额、队首出队或取消时只唤醒新的队首；
+队首只差令牌时按令牌桶算出的时间睡眠，到时再检查。
+
+限额可以通过环境变量SCHEDULER_LIMITS（json）覆盖，例如：
+SCHEDULER_LIMITS='{"cogview-3": {"rps": 2, "burst": 2, "max_concurrency": 4}}'
+"""
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from enum import IntEnum
+from typing import Deque, Dict, List, Optional, Tuple, TypedDict
+
+
+class Priority(IntEnum):
+    """数字越小越先执行"""
+    INTERACTIVE = 0
+    """用户正在等待的对话回复"""
+    BACKGROUND = 1
+    """图片、人设、场景描写等后台生成"""
+
+
+class ModelLimit(TypedDict):
+    rps: float
+    """每秒放行的请求数"""
+    burst: float
+    """令牌桶容量，允许的瞬时突发请求数"""
+    max_concurrency: int
+    """同时进行的请求数上限（流式请求在读完之前一直占用）"""
+
+
+DEFAULT_LIMITS: Dict[str, ModelLimit] = {
+    "charglm-3": {"rps": 5, "burst": 10, "max_concurrency": 20},
+    "glm-3-turbo": {"rps": 5, "burst": 10, "max_concurrency": 20},
+    "cogview-3": {"rps": 1, "burst": 2, "max_concurrency": 4},
+}
+# 未配置的模型使用的限额
+FALLBACK_LIMIT: ModelLimit = {"rps": 10, "burst": 10, "max_concurrency": 20}
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """ 还要等多久才有一个令牌 """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self):
+        self.tokens -= 1
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Ticket(object):
+    __slots__ = ("priority", "enqueued", "cancelled", "loop", "future")
+
+    def __init__(self, priority: Priority, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.cancelled = False
+        # 协程排队时所在的事件循环，和正在等待的future（线程排队时为None，等cond的通知）
+        self.loop = loop
+        self.future: Optional[asyncio.Future] = None
+
+
+class ModelLane(object):
+    """ 一个模型的限流通道 """
+
+    def __init__(self, model: str, limit: ModelLimit):
+        self.model = model
+        self.bucket = TokenBucket(limit["rps"], limit["burst"])
+        self.max_concurrency = limit["max_concurrency"]
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int, _Ticket]] = []
+        self._seq = itertools.count()
+        # 统计
+        self.requests = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.recent_waits: Deque[float] = collections.deque(maxlen=1000)
+
+    def configure(self, limit: ModelLimit):
+        with self.cond:
+            self.bucket.rate = limit["rps"]
+            self.bucket.capacity = limit["burst"]
+            self.max_concurrency = limit["max_concurrency"]
+            # 等待令牌的线程按新的速率重新计算等待时间
+            self.cond.notify_all()
+            self._wake_head()
+
+    def _enqueue(self, priority: Priority, loop: Optional[asyncio.AbstractEventLoop] = None) -> _Ticket:
+        ticket = _Ticket(priority, loop)
+        heapq.heappush(self._waiters, (int(priority), next(self._seq), ticket))
+        return ticket
+
+    def _wake_head(self):
+        """
+        在持有锁时调用：队首可能可以出队了（名额释放、限额调整、前一个队首出队或取消），只唤醒队首
+        协程的future可能属于其他线程的事件循环，通过call_soon_threadsafe唤醒
+        """
+        waiters = self._waiters
+        while waiters and waiters[0][2].cancelled:
+            heapq.heappop(waiters)
+        if not waiters:
+            return
+        head = waiters[0][2]
+        if head.loop is None:
+            self.cond.notify_all()
+        elif head.future is not None and not head.future.done():
+            try:
+                head.loop.call_soon_threadsafe(_wake, head.future)
+            except RuntimeError:
+                # 事件循环已关闭，排队的协程不会再运行
+                pass
+
+    def _try_acquire(self, ticket: _Ticket) -> Tuple[bool, Optional[float]]:
+        """
+        在持有锁时调用
+        :return: (是否拿到, 拿不到时建议等待的秒数，None表示等通知)
+        """
+        waiters = self._waiters
+        while waiters and waiters[0][2].cancelled:
+            heapq.heappop(waiters)
+        if waiters[0][2] is not ticket or self.in_flight >= self.max_concurrency:
+            return False, None
+        now = time.monotonic()
+        wait = self.bucket.wait_time(now)
+        if wait > 0:
+            # rps为0时没有令牌，等configure调整限额时的通知
+            return False, wait if wait != float("inf") else None
+        heapq.heappop(waiters)
+        self.bucket.take()
+        self.in_flight += 1
+        waited = now - ticket.enqueued
+        self.requests += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        self.recent_waits.append(waited)
+        return True, None
+
+    def _cancel(self, ticket: _Ticket):
+        ticket.cancelled = True
+        self._wake_head()
+
+    def _release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self._wake_head()
+
+    def acquire(self, priority: Priority):
+        with self.cond:
+            ticket = self._enqueue(priority)
+            try:
+                while True:
+                    acquired, wait = self._try_acquire(ticket)
+                    if acquired:
+                        # 唤醒下一个排在队首的请求
+                        self._wake_head()
+                        return
+                    self.cond.wait(wait)
+            except BaseException:
+                self._cancel(ticket)
+                raise
+
+    async def acquire_async(self, priority: Priority):
+        loop = asyncio.get_running_loop()
+        with self.cond:
+            ticket = self._enqueue(priority, loop)
+        try:
+            while True:
+                with self.cond:
+                    acquired, wait = self._try_acquire(ticket)
+                    if acquired:
+                        self._wake_head()
+                        return
+                    # 在锁内挂上future，之后的状态变化都会唤醒它
+                    future = ticket.future = loop.create_future()
+                # 不是队首或没有名额时等唤醒；只差令牌时睡到令牌桶补满一个令牌
+                timer = loop.call_later(wait, _wake, future) if wait is not None else None
+                try:
+                    await future
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+        except BaseException:
+            with self.cond:
+                self._cancel(ticket)
+            raise
+
+    def stats(self) -> Dict:
+        with self.cond:
+            queued = collections.Counter(t.priority.name for _, _, t in self._waiters if not t.cancelled)
+            return {
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "rps": self.bucket.rate,
+                "queue_depth": sum(queued.values()),
+                "queue_depth_by_priority": {p.name: queued.get(p.name, 0) for p in Priority},
+                "requests": self.requests,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+                "wait_seconds_avg": self.wait_seconds_total / self.requests if self.requests else 0.0,
+            }
+
+
+class Scheduler(object):
+    """
+    所有模型调用的入口：
+    ```python
+    with scheduler.slot("charglm-3", Priority.INTERACTIVE):
+        ...  # 发请求、读完流式响应
+    async with scheduler.aslot("cogview-3", Priority.BACKGROUND):
+        ...
+    ```
+    """
+
+    def __init__(self, limits: Optional[Dict[str, ModelLimit]] = None):
+        self._lanes: Dict[str, ModelLane] = {}
+        self._lock = threading.Lock()
+        for model, limit in (limits or {}).items():
+            self._lanes[model] = ModelLane(model, limit)
+
+    def lane(self, model: str) -> ModelLane:
+        lane = self._lanes.get(model)
+        if lane is None:
+            with self._lock:
+                lane = self._lanes.get(model)
+                if lane is None:
+                    lane = self._lanes[model] = ModelLane(model, dict(FALLBACK_LIMIT))
+        return lane
+
+    def configure(self, model: str, rps: Optional[float] = None, burst: Optional[float] = None,
+                  max_concurrency: Optional[int] = None):
+        """ 调整模型的限额，未传的保持不变 """
+        lane = self.lane(model)
+        lane.configure({
+            "rps": lane.bucket.rate if rps is None else rps,
+            "burst": lane.bucket.capacity if burst is None else burst,
+            "max_concurrency": lane.max_concurrency if max_concurrency is None else max_concurrency,
+        })
+
+    @contextlib.contextmanager
+    def slot(self, model: str, priority: Priority = Priority.INTERACTIVE):
+        lane = self.lane(model)
+        lane.acquire(priority)
+        try:
+            yield
+        finally:
+            lane._release()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, model: str, priority: Priority = Priority.INTERACTIVE):
+        lane = self.lane(model)
+        await lane.acquire_async(priority)
+        try:
+            yield
+        finally:
+            lane._release()
+
+    def stats(self) -> Dict[str, Dict]:
+        """ 各模型的排队深度、在途请求数、等待时间 """
+        return {model: lane.stats() for model, lane in list(self._lanes.items())}
+
+
+def _load_limits() -> Dict[str, ModelLimit]:
+    limits = {model: dict(limit) for model, limit in DEFAULT_LIMITS.items()}
+    for model, limit in json.loads(os.getenv("SCHEDULER_LIMITS", "{}")).items():
+        limits[model] = dict(limits.get(model, FALLBACK_LIMIT), **limit)
+    return limits
+
+
+scheduler = Scheduler(_load_limits())
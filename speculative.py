@@ -0,0 +1,102 @@
+"""
+角色扮演对话的下一轮预生成
+
+一轮回复完成后，在后台提前生成下一位角色的回复。用户点击该角色时直接取用（还没生成完的部分继续流式输出），
+对话历史或人设有变化时丢弃。预生成按后台优先级调度，不会抢占用户正在等待的请求。
+
+预生成结果以(对话历史, 人设)的指纹为键，只有指纹完全一致时才会被取用。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
+
+from api import get_characterglm_response
+from data_types import TextMsgList, CharacterMeta
+from scheduler import Priority
+
+# 同时进行的预生成数
+SPECULATIVE_WORKERS: int = int(os.getenv("SPECULATIVE_WORKERS", "4"))
+
+
+def history_fingerprint(messages: TextMsgList, meta: CharacterMeta) -> str:
+    payload = json.dumps({"messages": list(messages), "meta": meta}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class Speculation(object):
+    """ 一次预生成，后台线程写入，取用方通过stream()读取 """
+
+    def __init__(self, messages: TextMsgList, meta: CharacterMeta, key: Optional[str] = None):
+        """
+        :param messages: 发送给模型的对话历史
+        :param meta: 回复的角色
+        :param key: 取用时比对的指纹，默认为history_fingerprint(messages, meta)；
+            发送的历史经过裁剪/概要时，应传入完整历史的指纹
+        """
+        self.key = key or history_fingerprint(messages, meta)
+        self.messages = messages
+        self.meta = meta
+        self.chunks: List[str] = []
+        self.done = False
+        self.cancelled = False
+        self.error: Optional[Exception] = None
+        self.started = time.monotonic()
+        self._cond = threading.Condition()
+
+    def run(self):
+        try:
+            if self.cancelled:
+                return
+            for chunk in get_characterglm_response(self.messages, self.meta, priority=Priority.BACKGROUND):
+                if self.cancelled:
+                    break
+                with self._cond:
+                    self.chunks.append(chunk)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+    @property
+    def failed(self) -> bool:
+        """ 出错且没有产出任何内容，取用方应改为直接调用 """
+        return self.error is not None and not self.chunks
+
+    def cancel(self):
+        self.cancelled = True
+
+    def stream(self) -> Iterator[str]:
+        """ 先产出已生成的部分，再跟随后台线程继续产出，直到生成结束 """
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self.chunks) and not self.done:
+                    self._cond.wait()
+                new_chunks = self.chunks[i:]
+                finished = self.done and i + len(new_chunks) >= len(self.chunks)
+            i += len(new_chunks)
+            yield from new_chunks
+            if finished:
+                break
+        if self.error is not None:
+            raise self.error
+
+
+class Speculator(object):
+    def __init__(self, workers: int = SPECULATIVE_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="speculative")
+
+    def start(self, messages: TextMsgList, meta: CharacterMeta, key: Optional[str] = None) -> Speculation:
+        speculation = Speculation(messages, meta, key)
+        self._executor.submit(speculation.run)
+        return speculation
+
+
+speculator = Speculator()
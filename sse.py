@@ -0,0 +1,185 @@
+"""
+增量式sse（server-sent events）解析
+# reference: https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+
+SSEDecoder直接吃网络层的原始字节块（bytes/bytearray/memoryview），块的边界可以落在任意位置。
+在缓冲区上原地扫描，不为每行复制出bytes、解码出str：常见的单行data事件由预编译的正则一次匹配，
+只复制出字段值；其余的行由同一个正则逐行匹配。data只在事件结束时解码一次。
+
+同步/异步两种传输都用同一个解码器：
+- requests: iter_sse_events(resp.iter_content(chunk_size=None))
+- aiohttp: aiter_sse_events(resp.content.iter_any())
+"""
+import re
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List, NamedTuple, Optional, Union
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+_LF = 0x0A
+_CR = 0x0D
+_CR_BYTE = b"\r"
+_BOM = b"\xef\xbb\xbf"
+# 一个只有一行data的完整事件（charglm-3的add/finish事件都是这种），event、id行可选且值非空；
+# 或者任意一行（以\n结尾，用来区分两种匹配）
+_VALUE = rb"(?: (?=[^\n])|(?=[^ \n]))([^\n]*)\n"
+_ID_VALUE = rb"(?: (?=[^\n])|(?=[^ \n]))([^\n\0]*)\n"
+_TOKEN_RE = re.compile(rb"(?:event:" + _VALUE + rb")?(?:id:" + _ID_VALUE + rb")?data: ?([^\n]*)\n\n|([^\n]*\n)")
+
+
+class SSEEvent(NamedTuple):
+    """一个完整的sse事件"""
+    event: str
+    """事件类型，未指定时为message"""
+    data: str
+    """多行data以\\n拼接"""
+    id: str
+    """最近一次收到的事件id（last event id）"""
+    retry: Optional[int]
+    """服务端建议的重连间隔（毫秒）"""
+
+
+# 跳过NamedTuple生成的__new__，直接构造tuple
+_new_event = tuple.__new__
+
+
+class SSEDecoder(object):
+    __slots__ = ("_buf", "_data", "_event", "_event_names", "_last_id", "_last_id_raw", "_retry", "_skip_lf",
+                 "_bom_checked")
+
+    def __init__(self):
+        self._buf = bytearray()
+        # 当前事件的data行，事件结束时才拼接、解码
+        self._data: List[bytes] = []
+        self._event = b""
+        # 事件名只有少数几种（add/finish/...），解码结果缓存起来
+        self._event_names = {}
+        self._last_id = ""
+        self._last_id_raw = b""
+        self._retry: Optional[int] = None
+        # 上一块以\r结尾时，下一块开头的\n属于同一个换行
+        self._skip_lf = False
+        self._bom_checked = False
+
+    @property
+    def last_event_id(self) -> str:
+        return self._last_id
+
+    @property
+    def retry(self) -> Optional[int]:
+        return self._retry
+
+    def feed(self, chunk: BytesLike) -> List[SSEEvent]:
+        """
+        喂入一块原始字节，返回这块数据中结束的所有事件
+        :param chunk:
+        :return:
+        """
+        buf = self._buf
+        buf += chunk
+        if not self._bom_checked:
+            if len(buf) < len(_BOM) and _BOM.startswith(buf):
+                return []
+            if buf.startswith(_BOM):
+                del buf[:len(_BOM)]
+            self._bom_checked = True
+        if self._skip_lf and buf:
+            if buf[0] == _LF:
+                del buf[:1]
+            self._skip_lf = False
+        if _CR_BYTE in buf:
+            # 少见的\r\n、\r换行统一换成\n（留在缓冲区的半行里不会再有\r）
+            self._skip_lf = buf[-1] == _CR
+            buf[:] = buf.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+        # 只处理到最后一个换行符为止，剩下的半行留在缓冲区等下一块
+        last = buf.rfind(b"\n")
+        if last < 0:
+            return []
+        events: List[SSEEvent] = []
+        append = events.append
+        data = self._data
+        event_names, current, last_id_raw, last_id, retry = \
+            self._event_names, self._event, self._last_id_raw, self._last_id, self._retry
+        # 正则在C层原地扫描缓冲区，不切出整行：常见的完整事件整个匹配为一项，只复制出event/id/data的值，
+        # 其余每行（注释、retry、多行data、空值字段等）匹配为一项，逐行处理
+        for event, event_id, value, line in _TOKEN_RE.findall(buf, 0, last + 1):
+            if line:
+                if line == b"\n":
+                    # 空行：事件结束
+                    if data:
+                        name = event_names.get(current)
+                        if name is None:
+                            name = self._event_name(current)
+                        append(_new_event(SSEEvent, (
+                            name, (data[0] if len(data) == 1 else b"\n".join(data)).decode("utf-8", "replace"),
+                            last_id, retry)))
+                        data.clear()
+                    current = b""
+                    continue
+                field, _, line_value = line[:-1].partition(b":")
+                if not field:
+                    # 冒号开头的是注释行
+                    continue
+                if line_value and line_value[0] == 32:
+                    line_value = line_value[1:]
+                if field == b"data":
+                    data.append(line_value)
+                elif field == b"event":
+                    current = line_value
+                elif field == b"id":
+                    if line_value != last_id_raw and b"\0" not in line_value:
+                        last_id_raw = line_value
+                        last_id = line_value.decode("utf-8", "replace")
+                elif field == b"retry":
+                    if line_value.isdigit():
+                        retry = int(line_value)
+                continue
+            # 完整事件：event、id只在值非空（id不含\0）时匹配到这里
+            if event:
+                current = event
+            if event_id and event_id != last_id_raw:
+                last_id_raw = event_id
+                last_id = event_id.decode("utf-8", "replace")
+            name = event_names.get(current)
+            if name is None:
+                name = self._event_name(current)
+            if data:
+                # 前面还有逐行处理的data行
+                data.append(value)
+                value = b"\n".join(data)
+                data.clear()
+            append(_new_event(SSEEvent, (name, value.decode("utf-8", "replace"), last_id, retry)))
+            current = b""
+        self._event, self._last_id_raw, self._last_id, self._retry = current, last_id_raw, last_id, retry
+        del buf[:last + 1]
+        return events
+
+    def _event_name(self, event: bytes) -> str:
+        name = self._event_names[event] = event.decode("utf-8", "replace") if event else "message"
+        return name
+
+    def close(self):
+        """
+        流结束。按规范，没有以空行结束的事件直接丢弃
+        :return:
+        """
+        self._buf.clear()
+        self._data.clear()
+        self._event = b""
+
+
+def iter_sse_events(chunks: Iterable[BytesLike]) -> Iterator[SSEEvent]:
+    """ 从同步字节流中解析sse事件 """
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    decoder.close()
+
+
+async def aiter_sse_events(chunks: AsyncIterable[BytesLike]) -> AsyncIterator[SSEEvent]:
+    """ 从异步字节流中解析sse事件 """
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        for event in decoder.feed(chunk):
+            yield event
+    decoder.close()
@@ -0,0 +1,72 @@
+"""
+流式回复的节流渲染
+
+原先每收到一个token就把累积的全文重新markdown一次，渲染总量是回复长度的平方，
+并且每个token都要通过websocket推一次前端。
+StreamRenderer把token先攒起来，按帧率上限（时间预算）或攒够一定字数（大小预算）才渲染一次。
+"""
+import os
+import time
+from typing import Iterator, List
+
+# 每秒最多渲染几次
+STREAM_RENDER_FPS: float = float(os.getenv("STREAM_RENDER_FPS", "10"))
+# 攒够多少个字符时不等帧间隔直接渲染
+STREAM_RENDER_MAX_PENDING: int = int(os.getenv("STREAM_RENDER_MAX_PENDING", "400"))
+
+
+class StreamRenderer(object):
+    """
+    把流式回复节流后渲染到streamlit的placeholder（st.empty()）上
+    第一个token到达时立即渲染，之后按帧率合并；render_count和bytes_pushed记录实际推送给前端的次数和字节数
+    """
+
+    def __init__(self, placeholder, fps: float = STREAM_RENDER_FPS, max_pending: int = STREAM_RENDER_MAX_PENDING):
+        self.placeholder = placeholder
+        self.interval = 1 / fps if fps > 0 else 0
+        self.max_pending = max_pending
+        self._parts: List[str] = []
+        self._pending = 0
+        self._last_render = 0.0
+        self.render_count = 0
+        self.bytes_pushed = 0
+        self.chunk_count = 0
+
+    @property
+    def text(self) -> str:
+        # 合并成一个字符串，下次join只需拼接新增的部分
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def feed(self, chunk: str):
+        if not chunk:
+            return
+        self._parts.append(chunk)
+        self._pending += len(chunk)
+        self.chunk_count += 1
+        if self._pending >= self.max_pending or time.monotonic() - self._last_render >= self.interval:
+            self.render()
+
+    def render(self):
+        text = self.text
+        self.placeholder.markdown(text)
+        self.render_count += 1
+        self.bytes_pushed += len(text.encode())
+        self._pending = 0
+        self._last_render = time.monotonic()
+
+    def finish(self) -> str:
+        """ 流结束，把剩余的内容渲染出来，返回全文 """
+        if self._pending:
+            self.render()
+        return self.text
+
+
+def render_stream(response_stream: Iterator[str], placeholder, **kwargs) -> StreamRenderer:
+    """ 边接收边渲染，返回renderer，全文为renderer.text """
+    renderer = StreamRenderer(placeholder, **kwargs)
+    for chunk in response_stream:
+        renderer.feed(chunk)
+    renderer.finish()
+    return renderer
@@ -0,0 +1,36 @@
+"""
+重新生成角色图片时替换上一张，而不是追加一张重复的
+
+运行方式（仓库根目录）：
+```bash
+python -m pytest tests
+```
+"""
+from characterglm_autochat import Tools
+from data_types import ImageMsg, TextMsg
+from message_store import MessageStore
+
+
+def image(url: str, caption: str) -> ImageMsg:
+    return ImageMsg({"role": "image", "image": url, "caption": caption})
+
+
+def test_regenerate_after_redraw():
+    history = MessageStore([TextMsg({"role": "user", "content": "你好"})])
+    first_a, first_b = image("https://img/a1.png", "a"), image("https://img/b1.png", "b")
+    Tools.put_image(history, None, first_a)
+    Tools.put_image(history, None, first_b)
+    # history_view画出图片后，把消息换成带local_image的新对象
+    for i in (1, 2):
+        history[i] = ImageMsg(history[i], local_image=f"{i}.png")
+
+    second_a = image("https://img/a2.png", "a")
+    Tools.put_image(history, first_a, second_a)
+    assert [msg.get("image") for msg in history] == [None, "https://img/b1.png", "https://img/a2.png"]
+
+
+def test_previous_image_no_longer_at_tail():
+    first = image("https://img/a1.png", "a")
+    history = MessageStore([first, TextMsg({"role": "user", "content": "你好"})])
+    Tools.put_image(history, first, image("https://img/a2.png", "a"))
+    assert len(history) == 3
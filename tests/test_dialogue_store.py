@@ -0,0 +1,52 @@
+"""
+dialogue_store的读取端：加载保存的对话后继续追加时，end之后的记录仍应用在同一个对话上
+
+运行方式（仓库根目录）：
+```bash
+python -m pytest tests
+```
+"""
+import pytest
+
+from dialogue_index import DialogueArchive
+from dialogue_store import DialogueWriter, apply_record, iter_dialogues, load_progress
+
+META = {"bot_name": "苏梦远", "user_name": "陆星辰"}
+MESSAGES = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"消息{i}"} for i in range(4)]
+
+
+def write_reopened(path: str):
+    """ 写入、结束，再像界面保存那样只追加新消息并重新写入对话头 """
+    with DialogueWriter(path) as writer:
+        writer.write_dialogue(dict(META, history=MESSAGES[:2]), "d1")
+        writer.write_dialogue(dict(META, history=MESSAGES[:1]), "d2")
+    with DialogueWriter(path) as writer:
+        writer.write_turn("d1", 2, MESSAGES[2])
+        writer.begin_dialogue(dict(META, bot_name="苏梦远（新）"), "d1")
+        writer.write_turn("d1", 3, MESSAGES[3])
+
+
+@pytest.mark.parametrize("name", ["dialogues.jsonl", "dialogues.jsonl.gz"])
+def test_iter_dialogues_after_reopen(tmp_path, name):
+    path = str(tmp_path / name)
+    write_reopened(path)
+    dialogues = list(iter_dialogues(path, include_incomplete=True))
+    assert [dialogue_id for dialogue_id, _ in dialogues] == ["d2", "d1"]
+    d1 = dict(dialogues)["d1"]
+    assert d1["history"] == MESSAGES
+    assert d1["bot_name"] == "苏梦远（新）"
+    assert d1["user_name"] == META["user_name"]
+
+
+def test_readers_agree_after_reopen(tmp_path):
+    path = str(tmp_path / "dialogues.jsonl")
+    write_reopened(path)
+    assert dict(iter_dialogues(path))["d1"] == DialogueArchive(path).get("d1")
+    assert load_progress(path) == ({"d1", "d2"}, {})
+
+
+def test_apply_record_refuses_gap():
+    history = [MESSAGES[0]]
+    with pytest.raises(ValueError):
+        apply_record(history, {"type": "turn", "dialogue_id": "d1", "index": 2, "message": MESSAGES[2]})
+    assert history == [MESSAGES[0]]